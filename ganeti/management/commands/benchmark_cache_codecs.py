@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+import zlib
+import time
+import cPickle as pickle
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ganetimgr.ganeti.management.commands.benchmark_instances import \
+    bench_environment, populate, listing_payload
+from redis_cache.codecs import Codec, SERIALIZERS, COMPRESSORS
+from util.fakerapi import generate_nodes
+
+DEFAULT_SIZE = 10000
+DEFAULT_REPEAT = 3
+DEFAULT_LEVELS = "1,6"
+
+
+class LegacyCodec(object):
+    '''The encoding of the cache backend before codecs were pluggable.'''
+
+    def encode(self, value, plain=False):
+        value = '!pickle!' + pickle.dumps(value)
+        if len(value) > 1000:
+            value = '!zlib!' + zlib.compress(value)
+        return value
+
+    def decode(self, value):
+        return Codec().decode(value)
+
+
+def best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Compares encode and decode times and encoded sizes of the'
+            ' cache codecs on synthetic instance and node listings.')
+    option_list = BaseCommand.option_list + (
+        make_option('--size', dest='size', type='int', default=DEFAULT_SIZE,
+                    help='Number of instances (default: %d)' % DEFAULT_SIZE),
+        make_option('--repeat', dest='repeat', type='int',
+                    default=DEFAULT_REPEAT,
+                    help='Runs per codec, the best one is kept'
+                         ' (default: %d)' % DEFAULT_REPEAT),
+        make_option('--levels', dest='levels', default=DEFAULT_LEVELS,
+                    help='Comma separated zlib levels to try'
+                         ' (default: %s)' % DEFAULT_LEVELS),
+    )
+
+    def handle(self, *args, **options):
+        size = options['size']
+        repeat = options['repeat']
+        if repeat < 1:
+            raise CommandError("--repeat must be at least 1")
+        levels = [int(l) for l in options['levels'].split(',')]
+
+        codecs = [("legacy (pickle/zlib 6)", LegacyCodec())]
+        for serializer in sorted(SERIALIZERS):
+            for compressor in sorted(COMPRESSORS):
+                if compressor == "zlib":
+                    for level in levels:
+                        codecs.append(("%s/zlib %d" % (serializer, level),
+                                       Codec(serializer, compressor, level)))
+                else:
+                    codecs.append(("%s/%s" % (serializer, compressor),
+                                   Codec(serializer, compressor)))
+
+        with bench_environment():
+            cluster, nusers, ngroups, norgs = populate(size)
+            # Both are plain data, see CacheClass._pack_value
+            payloads = [
+                ("instances", listing_payload(cluster, size, nusers,
+                                              ngroups, norgs)),
+                ("nodes", generate_nodes(cluster.hostname, 200)),
+            ]
+            self.stdout.write("%d instances, %d users, %d groups\n\n" %
+                              (size, nusers, ngroups))
+            self.stdout.write("%-12s %-24s %10s %10s %10s\n" %
+                              ("payload", "codec", "encode ms", "decode ms",
+                               "bytes"))
+            for name, value in payloads:
+                for codec_name, codec in codecs:
+                    encode, data = best_time(
+                        lambda: codec.encode(value, True), repeat)
+                    decode, decoded = best_time(
+                        lambda: codec.decode(data), repeat)
+                    if decoded != value:
+                        raise CommandError("%s does not round trip %s" %
+                                           (codec_name, name))
+                    self.stdout.write("%-12s %-24s %10.1f %10.1f %10d\n" %
+                                      (name, codec_name, encode * 1000,
+                                       decode * 1000, len(data)))
+                self.stdout.write("\n")
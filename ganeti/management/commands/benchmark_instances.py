@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+import gc
+import time
+import json
+import resource
+from contextlib import contextmanager
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.cache import get_cache
+from django.db import connection
+from django.conf import settings
+from django.contrib.auth.models import User, Group, Permission
+
+from ganetimgr.apply.models import Organization
+from ganetimgr.ganeti import models
+from ganetimgr.ganeti.views import generate_json, generate_json_light
+from ganetimgr.settings import GANETI_TAG_PREFIX
+from util.fakerapi import generate_instances
+
+DEFAULT_SIZES = "1000,10000,50000"
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.25
+
+
+def measure(fn, repeat):
+    '''Returns the best time of fn over repeat runs and the number of
+    objects allocated by it that were still alive when it returned.
+    '''
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        start = time.time()
+        result = fn()
+        best = time.time() - start
+        objects = len(gc.get_objects()) - before
+        del result
+        for i in range(repeat - 1):
+            start = time.time()
+            fn()
+            best = min(best, time.time() - start)
+    finally:
+        gc.enable()
+    return best, objects
+
+
+@contextmanager
+def bench_environment():
+    '''Runs the enclosed block against a throwaway test database and a
+    local memory cache.
+    '''
+    settings.DEBUG = False
+    try:
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+    except ImportError:
+        pass
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    real_cache = models.cache
+    models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+    try:
+        yield
+    finally:
+        models.cache = real_cache
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def populate(size):
+    '''Creates the users, groups and organizations the synthetic
+    instances are tagged with and returns the cluster to use.
+    '''
+    nusers = max(size / 10, 50)
+    ngroups = max(nusers / 10, 5)
+    norgs = 20
+    User.objects.all().delete()
+    Group.objects.all().delete()
+    Organization.objects.all().delete()
+    models.Cluster.objects.all().delete()
+    User.objects.bulk_create([User(username="user%04d" % i,
+                                   email="user%04d@example.org" % i)
+                              for i in range(nusers)])
+    Group.objects.bulk_create([Group(name="group%03d" % i)
+                               for i in range(ngroups)])
+    Organization.objects.bulk_create([Organization(title="org%02d" % i,
+                                                   tag="org%02d" % i)
+                                      for i in range(norgs)])
+    users = list(User.objects.order_by('username'))
+    groups = list(Group.objects.order_by('name'))
+    # Every user is a member of one group, every fifth of a second
+    membership = User.groups.through
+    rows = [membership(user_id=u.pk, group_id=groups[i % ngroups].pk)
+            for i, u in enumerate(users)]
+    rows.extend([membership(user_id=u.pk,
+                            group_id=groups[(i + 1) % ngroups].pk)
+                 for i, u in enumerate(users) if i % 5 == 0])
+    membership.objects.bulk_create(rows)
+
+    cluster = models.Cluster.objects.create(slug="bench",
+                                            hostname="bench.example.org")
+    models.Network.objects.create(description="bench", cluster=cluster,
+                                  link="br0", mode="routed",
+                                  ipv6_prefix="2001:db8:1::/64")
+    return cluster, nusers, ngroups, norgs
+
+
+def listing_payload(cluster, size, nusers, ngroups, norgs):
+    '''Returns a synthetic bulk instance listing, as cached by
+    Cluster.get_instances.
+    '''
+    payload = []
+    for info in generate_instances(cluster.hostname, size,
+                                   users=nusers, groups=ngroups,
+                                   orgs=norgs,
+                                   tag_prefix=GANETI_TAG_PREFIX):
+        payload.append(dict((f, info[f]) for f in
+                            models.INSTANCE_LISTING_FIELDS))
+    return payload
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Benchmarks building and serializing instance listings on'
+            ' synthetic bulk RAPI payloads. Runs against a throwaway test'
+            ' database and a local memory cache.')
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default=DEFAULT_SIZES,
+                    help='Comma separated instance counts (default: %s)' %
+                         DEFAULT_SIZES),
+        make_option('--repeat', dest='repeat', type='int',
+                    default=DEFAULT_REPEAT,
+                    help='Runs per function, the best one is kept'
+                         ' (default: %d)' % DEFAULT_REPEAT),
+        make_option('--save-baseline', dest='save_baseline', metavar='FILE',
+                    help='Save the results as a baseline'),
+        make_option('--baseline', dest='baseline', metavar='FILE',
+                    help='Fail if the results regress against a baseline'),
+        make_option('--tolerance', dest='tolerance', type='float',
+                    default=DEFAULT_TOLERANCE,
+                    help='Allowed slowdown or extra allocations over the'
+                         ' baseline (default: %s)' % DEFAULT_TOLERANCE),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        repeat = options['repeat']
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        results = {}
+        with bench_environment():
+            for size in sizes:
+                models.cache.clear()
+                results[str(size)] = self.run_size(size, repeat)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if baseline is not None:
+            self.compare(results, baseline, options['tolerance'])
+
+    def run_size(self, size, repeat):
+        cluster, nusers, ngroups, norgs = populate(size)
+        payload = listing_payload(cluster, size, nusers, ngroups, norgs)
+        cluster._cache_snapshot(
+            cluster._instances_cache_key(models.INSTANCE_LISTING_FIELDS),
+            payload, 3600, 3600, cluster._owners_index)
+
+        superuser = User.objects.create(username="bench-admin",
+                                        is_superuser=True)
+        staff = User.objects.create(username="bench-staff")
+        staff.user_permissions.add(
+            Permission.objects.get(codename="view_instances"))
+        staff = User.objects.get(pk=staff.pk)
+        # The heaviest owner, see fakerapi._pick_owner
+        owner = User.objects.get(username="user0000")
+
+        # The users of the previous size are gone
+        models.principals.clear()
+        users, orgs, groups, instanceapps, networks = \
+            models.principals.resolve(payload)
+        instances = cluster._build_instances(payload)
+
+        def build():
+            return [models.Instance(cluster, info['name'], info,
+                                    listusers=users, listorganizations=orgs,
+                                    listgroups=groups,
+                                    listinstanceapplications=instanceapps,
+                                    networks=networks)
+                    for info in payload]
+
+        def ipv6():
+            return [i.generate_ipv6(networks['br0'], mac)
+                    for i in instances for mac in i.nic_macs]
+
+        def user_instances(user):
+            return lambda: cluster.get_user_instances(
+                user, models.INSTANCE_LISTING_FIELDS)
+
+        def json_listing(fn, user):
+            return lambda: [fn(i, user) for i in instances]
+
+        benchmarks = [
+            ("PrincipalResolver.resolve",
+             lambda: models.PrincipalResolver().resolve(payload)),
+            ("Instance.__init__", build),
+            ("Instance.generate_ipv6", ipv6),
+            ("get_user_instances (superuser)", user_instances(superuser)),
+            ("get_user_instances (view_instances)", user_instances(staff)),
+            ("get_user_instances (owner)", user_instances(owner)),
+            ("generate_json (superuser)",
+             json_listing(generate_json, superuser)),
+            ("generate_json (owner)", json_listing(generate_json, owner)),
+            ("generate_json_light (superuser)",
+             json_listing(generate_json_light, superuser)),
+        ]
+
+        self.stdout.write("%d instances, %d users, %d groups\n" %
+                          (size, nusers, ngroups))
+        self.stdout.write("%-38s %10s %10s %10s\n" %
+                          ("function", "ms", "us/inst", "objects"))
+        results = {}
+        for name, fn in benchmarks:
+            seconds, objects = measure(fn, repeat)
+            results[name] = {"seconds": seconds, "objects": objects}
+            self.stdout.write("%-38s %10.1f %10.1f %10d\n" %
+                              (name, seconds * 1000, seconds * 1e6 / size,
+                               objects))
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stdout.write("peak RSS %d KB\n\n" % rss)
+        return results
+
+    def compare(self, results, baseline, tolerance):
+        regressions = []
+        for size, functions in sorted(results.items()):
+            for name, result in sorted(functions.items()):
+                base = baseline.get(size, {}).get(name)
+                if base is None:
+                    continue
+                for metric in ("seconds", "objects"):
+                    if (base[metric] > 0 and
+                            result[metric] > base[metric] * (1 + tolerance)):
+                        regressions.append("%s @%s: %s %s -> %s" %
+                                           (name, size, metric,
+                                            base[metric], result[metric]))
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n%s" %
+                               "\n".join(regressions))
+        self.stdout.write("No regressions against the baseline\n")
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.cache import cache
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Shows cache hits, misses, value sizes and (de)serialization'
+            ' times by key family, as recorded by all processes since the'
+            ' last reset. Needs the redis_cache backend with stats=1.')
+    option_list = BaseCommand.option_list + (
+        make_option('--json', action='store_true', dest='json',
+                    default=False, help='Print the statistics as JSON'),
+        make_option('--reset', action='store_true', dest='reset',
+                    default=False,
+                    help='Reset the statistics after printing them'),
+    )
+
+    def handle(self, *args, **options):
+        if not hasattr(cache, 'get_stats'):
+            raise CommandError("The cache backend does not keep statistics")
+        stats = cache.get_stats()
+        if stats is None:
+            raise CommandError("Cache statistics are not enabled, add"
+                               " stats=1 to CACHE_BACKEND")
+
+        if options['json']:
+            self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
+            self.stdout.write("\n")
+        else:
+            self.stdout.write("%-14s %9s %9s %6s %9s %10s %9s %10s %9s %9s\n"
+                              % ("family", "hits", "misses", "hit%",
+                                 "local", "avg read", "writes", "avg write",
+                                 "dec ms", "enc ms"))
+            for family, counts in sorted(stats.items()):
+                if family == "redis":
+                    continue
+                self.stdout.write(
+                    "%-14s %9d %9d %6.1f %9d %10d %9d %10d %9.1f %9.1f\n" %
+                    (family, counts.get("hits", 0), counts.get("misses", 0),
+                     counts.get("hit_ratio", 0) * 100,
+                     counts.get("local_hits", 0),
+                     counts.get("avg_bytes_read", 0),
+                     counts.get("writes", 0),
+                     counts.get("avg_bytes_written", 0),
+                     counts.get("decode_time", 0) * 1000,
+                     counts.get("encode_time", 0) * 1000))
+            redis = stats.get("redis", {})
+            reads = redis.get("reads", 0)
+            writes = redis.get("writes", 0)
+            self.stdout.write("\nRedis round trips: %d reads (avg %.2f ms),"
+                              " %d writes (avg %.2f ms)\n" %
+                              (reads, reads and
+                               redis.get("read_time", 0) * 1000 / reads,
+                               writes, writes and
+                               redis.get("write_time", 0) * 1000 / writes))
+
+        if options['reset']:
+            cache.reset_stats()
@@ -24,21 +24,91 @@ from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 from django.conf import settings
 from datetime import datetime, timedelta
 from socket import gethostbyname
-from time import sleep
+from time import sleep, time
 
-from gevent.pool import Pool
+from gevent import spawn
 from gevent.timeout import Timeout
 
 from util import vapclient
-from util.ganeti_client import GanetiRapiClient, GanetiApiError
+from util.ganeti_client import GanetiRapiClient, GanetiApiError, \
+    SingleFlight, FanOut, DEFAULT_POOL_SIZE, DEFAULT_BREAKER_THRESHOLD, \
+    DEFAULT_BREAKER_COOLDOWN, DEFAULT_FANOUT_SIZE, QFILTER_OR, \
+    QFILTER_EQUAL, QFILTER_CONTAINS
 from ganetimgr.settings import RAPI_CONNECT_TIMEOUT, RAPI_RESPONSE_TIMEOUT, GANETI_TAG_PREFIX
 import re
 import random
 import sha
 import ipaddr
+import logging
+
+logger = logging.getLogger(__name__)
 
 RAPI_TIMEOUT = settings.RAPI_TIMEOUT
 
+# Instance fields needed to build an Instance object
+INSTANCE_BASE_FIELDS = ('name', 'tags', 'admin_state', 'oper_state',
+                        'ctime', 'mtime', 'nic.links', 'nic.modes',
+                        'nic.ips', 'nic.macs')
+
+# Instance fields requested in bulk by each listing family. Every family is
+# cached separately, see Cluster._instances_cache_key
+INSTANCE_LISTING_FIELDS = INSTANCE_BASE_FIELDS + ('pnode', 'beparams',
+                                                  'hvparams', 'disk.sizes',
+                                                  'oper_ram')
+INSTANCE_STATS_FIELDS = INSTANCE_BASE_FIELDS + ('beparams', 'disk.sizes')
+
+INSTANCE_FIELD_SETS = (None, INSTANCE_LISTING_FIELDS, INSTANCE_STATS_FIELDS)
+
+# Cluster snapshots are fresh for *_CACHE_TIMEOUT seconds and kept for
+# *_STALE_TIMEOUT seconds. Stale snapshots are served at once while a single
+# worker refreshes them in the background, see Cluster._cached. Without any
+# snapshot, one worker fetches it while the others wait for it up to
+# INSTANCES_LEASE_WAIT seconds.
+INSTANCES_CACHE_TIMEOUT = 45
+INSTANCES_STALE_TIMEOUT = 600
+INSTANCES_LEASE_WAIT = 3
+NODES_CACHE_TIMEOUT = 180
+NODES_STALE_TIMEOUT = 900
+
+def cache_has_hashes():
+    '''Whether the cache backend keeps hashes, as the bundled redis_cache
+    does. Other backends get instance locks through a key per lock, and no
+    index of instance names.
+    '''
+    return hasattr(cache, 'hgetall')
+
+# Hash mapping instance names to the slug of their cluster, updated whenever
+# an instance listing is cached. Entries expire with the listing, or go away
+# once the cluster lists the instance no more, see Cluster._index_instances and InstanceManager.filter
+INSTANCE_CLUSTERS_KEY = "instances:clusters"
+
+# Coalesces concurrent refreshes of the same listing within the process
+instances_flight = SingleFlight()
+
+# Users, groups, organizations and applications named in instance tags are
+# looked up in batches of PRINCIPALS_BATCH instances (or names, per query)
+# and memoized for PRINCIPALS_TIMEOUT seconds, see PrincipalResolver
+PRINCIPALS_BATCH = 500
+PRINCIPALS_TIMEOUT = 30
+# Bumped to make every process forget the principals it knows, see
+# PrincipalResolver.invalidate
+PRINCIPALS_GENERATION_KEY = "principals:generation"
+# Generations (see advance_generation) are kept for GENERATION_TIMEOUT seconds
+GENERATION_TIMEOUT = 86400
+
+# Up to IPV6_MEMO_SIZE derived IPv6 addresses are memoized, see eui64_address
+IPV6_MEMO_SIZE = 100000
+
+# Tags ganetimgr reads, see Instance._hydrate_tags
+GROUP_PFX = "%s:group:" % GANETI_TAG_PREFIX
+USER_PFX = "%s:user:" % GANETI_TAG_PREFIX
+ORG_PFX = "%s:org:" % GANETI_TAG_PREFIX
+APP_PFX = "%s:application:" % GANETI_TAG_PREFIX
+SERV_PFX = "%s:service:" % GANETI_TAG_PREFIX
+ADMINLOCK_TAG = "%s:adminlock" % GANETI_TAG_PREFIX
+ISOLATE_TAG = "%s:isolate" % GANETI_TAG_PREFIX
+WHITELIST_PFX = "%s:whitelist_ip:" % GANETI_TAG_PREFIX
+
 SHA1_RE = re.compile('^[a-f0-9]{40}$')
 
 try:
@@ -46,6 +116,31 @@ try:
 except ImportError:
     BEANSTALK_TUBE = None
 
+try:
+    from ganetimgr.settings import RAPI_CONNECTION_POOL_SIZE
+except ImportError:
+    RAPI_CONNECTION_POOL_SIZE = DEFAULT_POOL_SIZE
+
+try:
+    from ganetimgr.settings import RAPI_BREAKER_THRESHOLD
+except ImportError:
+    RAPI_BREAKER_THRESHOLD = DEFAULT_BREAKER_THRESHOLD
+
+try:
+    from ganetimgr.settings import RAPI_BREAKER_COOLDOWN
+except ImportError:
+    RAPI_BREAKER_COOLDOWN = DEFAULT_BREAKER_COOLDOWN
+
+try:
+    from ganetimgr.settings import RAPI_FANOUT_SIZE
+except ImportError:
+    RAPI_FANOUT_SIZE = DEFAULT_FANOUT_SIZE
+
+try:
+    from ganetimgr.settings import RAPI_FANOUT_PER_CLUSTER
+except ImportError:
+    RAPI_FANOUT_PER_CLUSTER = RAPI_CONNECTION_POOL_SIZE
+
 from util import beanstalkc
 
 try:
@@ -53,60 +148,123 @@ try:
 except ImportError:
     import simplejson as json
 
+# Calls made to every cluster on behalf of a request share these limits,
+# see map_clusters
+cluster_fanout = FanOut(RAPI_FANOUT_SIZE, RAPI_FANOUT_PER_CLUSTER)
+
+
+def user_group_names(user):
+    '''Returns the names of the groups of the user, see
+    Cluster.get_user_instances.
+    '''
+    if user.is_superuser:
+        # Sees every instance anyway
+        return []
+    return list(user.groups.values_list('name', flat=True))
+
+
+def map_clusters(fn, clusters=None, timeout=RAPI_TIMEOUT):
+    '''Calls fn(cluster) concurrently for every cluster, or the given ones,
+    within the limits of cluster_fanout. Returns the results of the
+    clusters that replied within timeout seconds and the clusters that
+    failed or did not.
+    '''
+    if clusters is None:
+        clusters = Cluster.objects.all()
+    return cluster_fanout.Map(fn, clusters, key=lambda c: c.slug,
+                              timeout=timeout, errors=(GanetiApiError,))
+
+
 class InstanceManager(object):
 
     def all(self):
-        users, orgs, groups, instanceapps, networks = preload_instance_data()
-        p = Pool(20)
-        instances = []
-        bad_clusters = []
+        return self._all()
 
+    def _all(self, tags=None):
         def _get_instances(cluster):
-            t = Timeout(RAPI_TIMEOUT)
-            t.start()
-            try:
-                instances.extend(cluster.get_instances())
-            except (GanetiApiError, Timeout):
-                pass
-            finally:
-                t.cancel()
-        clusters = Cluster.objects.all()
-        p.imap(_get_instances, clusters)
-        p.join()
-        return instances
+            if tags:
+                return cluster.get_tagged_instances(tags,
+                                                    INSTANCE_LISTING_FIELDS)
+            return cluster.get_instances(INSTANCE_LISTING_FIELDS)
+        results, bad_clusters = map_clusters(_get_instances)
+        return [i for instances in results for i in instances]
+
+    def _named(self, name):
+        '''Returns the named instance, in a list, from the cluster the
+        index of instance names says it is on, or an empty list if that
+        cluster no longer has it. Returns None, to fall back to scanning
+        all clusters, if the index does not know the instance or the
+        cluster could not answer.
+        '''
+        if not cache_has_hashes():
+            return None
+        slug = cache.hget(INSTANCE_CLUSTERS_KEY, name)
+        if slug is None:
+            return None
+        t = Timeout(RAPI_TIMEOUT)
+        t.start()
+        try:
+            cluster = Cluster.objects.get(slug=slug)
+            # Not get_instance_info, it takes any error for a missing instance
+            info = cluster._client.GetInstance(name)
+        except Cluster.DoesNotExist:
+            return None
+        except GanetiApiError, err:
+            if err.code == 404:
+                cache.hdel(INSTANCE_CLUSTERS_KEY, name)
+                return []
+            return None
+        except Timeout:
+            return None
+        finally:
+            t.cancel()
+        return cluster._build_instances([info])
 
     def filter(self, **kwargs):
-        users, orgs, groups, instanceapps, networks = preload_instance_data()
+        # Let the clusters do the filtering on the user tag, if possible
+        tags = None
+        if 'user' in kwargs:
+            if isinstance(kwargs['user'], User):
+                username = kwargs['user'].username
+            else:
+                username = kwargs['user']
+            tags = ["%s:user:%s" % (GANETI_TAG_PREFIX, username)]
         if 'cluster' in kwargs:
             results = []
             if isinstance(kwargs['cluster'], Cluster):
                 cluster = kwargs['cluster']
             else:
                 try:
-                    cluster = Cluster.object.get(slug=kwargs['cluster'])
+                    cluster = Cluster.objects.get(slug=kwargs['cluster'])
                 except:
                     return []
             try:
-                results = cluster.get_instances()
+                if tags:
+                    results = cluster.get_tagged_instances(tags,
+                                                INSTANCE_LISTING_FIELDS)
+                else:
+                    results = cluster.get_instances(INSTANCE_LISTING_FIELDS)
             except GanetiApiError:
                 results = []
             del kwargs['cluster']
         else:
-            results = self.all()
+            results = None
+            if 'name' in kwargs:
+                results = self._named(kwargs['name'])
+            if results is None:
+                results = self._all(tags)
 
         for arg, val in kwargs.items():
             if arg == 'user':
                 if not isinstance(val, User):
-                    try:
-                        val = users[val]
-                    except:
+                    val = principals.get('user', val)
+                    if val is None:
                         return []
                 results = [result for result in results if val in result.users]
             elif arg == 'group':
                 if not isinstance(val, Group):
-                    try:
-                        val = group[val]
-                    except:
+                    val = principals.get('group', val)
+                    if val is None:
                         return []
                 results = [result for result in results if val in result.groups]
             elif arg == 'name':
@@ -129,141 +287,254 @@ class InstanceManager(object):
             raise ObjectDoesNotExist("Could not find an instance")
 
 
+_ipv6_prefixes = {}
+_ipv6_addresses = {}
+
+
+def _compress_ipv6(address):
+    '''Formats an IPv6 address given as an integer like
+    ipaddr.IPv6Address.compressed does.
+    '''
+    hextets = ['%x' % ((address >> shift) & 0xffff)
+               for shift in range(112, -16, -16)]
+    best_start = best_len = 0
+    start = None
+    for i, hextet in enumerate(hextets + ['']):
+        if hextet == '0':
+            if start is None:
+                start = i
+        elif start is not None:
+            if i - start > best_len:
+                best_start, best_len = start, i - start
+            start = None
+    if best_len > 1:
+        hextets[best_start:best_start + best_len] = ['']
+        if best_start == 0:
+            hextets.insert(0, '')
+        if best_start + best_len == 8:
+            hextets.append('')
+    return ':'.join(hextets)
+
+
+def eui64_address(prefix, mac):
+    '''Returns the EUI-64 address of mac within the first 64 bits of the
+    network prefix, or False if either is invalid. Results are memoized,
+    instances are rebuilt from every new snapshot with the same NICs.
+    '''
+    key = (prefix, mac)
+    address = _ipv6_addresses.get(key)
+    if address is not None:
+        return address
+    network = _ipv6_prefixes.get(prefix)
+    try:
+        if network is None:
+            network = int(ipaddr.IPv6Network(prefix).network) >> 64
+            _ipv6_prefixes[prefix] = network
+        parts = mac.split(":")
+        if len(parts) != 6:
+            raise ValueError(mac)
+        mac = 0
+        for part in parts:
+            octet = int(part, 16)
+            if not 0 <= octet <= 0xff:
+                raise ValueError(part)
+            mac = (mac << 8) | octet
+    except Exception:
+        address = False
+    else:
+        # ff:fe in the middle of the MAC, universal/local bit flipped
+        iid = ((mac >> 24) << 40) | (0xfffe << 24) | (mac & 0xffffff)
+        address = _compress_ipv6((network << 64) | (iid ^ (1 << 57)))
+    if len(_ipv6_addresses) >= IPV6_MEMO_SIZE:
+        _ipv6_addresses.clear()
+        _ipv6_prefixes.clear()
+    _ipv6_addresses[key] = address
+    return address
+
+
 class Instance(object):
+    '''An instance, as listed by RAPI.
+
+    The fields ganetimgr uses are kept in slots, with dots in their names
+    replaced by underscores. Any other RAPI field is looked up in the raw
+    info dict (see raw) when it is accessed, e.g. instance.disk_template.
+
+    Fields derived from the tags, the networks or the timestamps are
+    computed on first access only, see _hydrators, so listings pay just
+    for the fields they use.
+    '''
+    __slots__ = (
+        # RAPI fields
+        'tags', 'admin_state', 'oper_state', 'ctime', 'mtime', 'pnode',
+        'beparams', 'hvparams', 'disk_sizes', 'nic_ips', 'nic_macs',
+        'nic_links', 'nic_modes',
+        # derived from the tags and the networks
+        'cluster', 'name', 'organization', 'application', 'services',
+        'users', 'groups', 'links', 'ipv6s', 'adminlock', 'isolate',
+        'whitelistip',
+        # set by the views
+        'admin_view_only', 'joblock', 'cpu_url', 'net_url', 'netw',
+        '_info', '_fields', '_lookups',
+    )
+    # (slot, RAPI field) of the fields copied as is
+    _rapi_slots = [(f, f.replace("nic_", "nic.").replace("disk_", "disk."))
+                   for f in __slots__[:13]
+                   if f not in ('admin_state', 'ctime', 'mtime', 'nic_ips')]
     objects = InstanceManager()
 
     def __init__(self, cluster, name, info=None, listusers=None, listorganizations=None, listgroups=None, listinstanceapplications=None, networks=None):
         self.cluster = cluster
         self.name = name
-        self.listusers = listusers
-        self.listorganizations = listorganizations
-        self.listgroups = listgroups
-        self.listinstanceapplications = listinstanceapplications
-        self.networks = networks
-        self.organization = None
-        self.application = None
-        self.services = []
-        self.users = []
-        self.groups = []
-        self.links = []
-        self.ipv6s = []
         self.admin_view_only = False
-        self.adminlock = False
-        self.isolate = False
-        self.whitelistip = None
         self.joblock = False
-        self._update(info)
-
-    def _update(self, info=None):
-        user_cache = {}
-        group_cache = {}
-        org_cache = {}
-        app_cache = {}
-        serv_cache = {}
+        self._fields = None
         if not info:
             info = self.cluster.get_instance_info(self.name)
-        for attr in info:
-            self.__dict__[attr.replace(".", "_")] = info[attr]
-        for tag in self.tags:
-            group_pfx = "%s:group:" % GANETI_TAG_PREFIX
-            user_pfx = "%s:user:" % GANETI_TAG_PREFIX
-            org_pfx = "%s:org:" % GANETI_TAG_PREFIX
-            app_pfx = "%s:application:" % GANETI_TAG_PREFIX
-            serv_pfx = "%s:service:" % GANETI_TAG_PREFIX
-            adminlock_tag = "%s:adminlock" % GANETI_TAG_PREFIX
-            isolate_tag = "%s:isolate" % GANETI_TAG_PREFIX
-            whitelist_pfx = "%s:whitelist_ip:" % GANETI_TAG_PREFIX
-            if tag.startswith(group_pfx):
-                group = tag.replace(group_pfx,'')
-                if group not in group_cache:
-                    try:
-                        g = self.listgroups[group]
-                    except:
-                        g = None
-                    group_cache[group] = g
-                if group_cache[group] is not None:
-                    self.groups.append(group_cache[group])
-            elif tag.startswith(user_pfx):
-                user = tag.replace(user_pfx,'')
-                if user not in user_cache:
-                    try:
-                        u = self.listusers[user]
-                    except:
-                        u = None
-                    user_cache[user] = u
-                if user_cache[user] is not None:
-                    self.users.append(user_cache[user])
-            elif tag.startswith(org_pfx):
-                org = tag.replace(org_pfx,'')
-                if org not in org_cache:
-                    try:
-                        o = self.listorganizations[org]
-                    except:
-                        o = None
-                    org_cache[org] = o
-                if org_cache[org] is not None:
-                    self.organization = org_cache[org]
-            elif tag.startswith(app_pfx):
-                app = tag.replace(app_pfx,'')
-                if app not in app_cache:
-                    try:
-                        a = self.listinstanceapplications[app]
-                    except:
-                        a = None
-                    app_cache[app] = a
-                if app_cache[app] is not None:
-                    self.application = app_cache[app]
-            elif tag.startswith(serv_pfx):
-                serv = tag.replace(serv_pfx,'')
-                if serv not in serv_cache:
-                    serv_cache[serv] = serv
-                if serv_cache[serv] is not None:
-                    self.services.append(serv_cache[serv])
-            elif tag == adminlock_tag:
-                self.adminlock = True
-            elif tag == isolate_tag:
-                self.isolate = True
-            elif tag.startswith(whitelist_pfx):
-                self.whitelistip = tag.replace(whitelist_pfx,'')
-        if getattr(self, 'ctime', None):
-            self.ctime = datetime.fromtimestamp(self.ctime)
-        if getattr(self, 'mtime', None):
-            self.mtime = datetime.fromtimestamp(self.mtime)
-        for nlink in self.nic_links:
+        self._info = info
+        # Shared by the instances of a listing, see PrincipalResolver
+        self._lookups = (listusers, listorganizations, listgroups,
+                         listinstanceapplications, networks)
+        for slot, field in self._rapi_slots:
+            if field in info:
+                setattr(self, slot, info[field])
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set
+        if name in ('_info', '_fields', '_lookups') or name.startswith('__'):
+            raise AttributeError(name)
+        hydrate = self._hydrators.get(name)
+        if hydrate is not None:
             try:
-                self.links.append(self.networks[nlink])
-            except Exception as e:
-                pass
-        for i in range(len(self.nic_modes)):
-            if self.nic_modes[i] == 'bridged':
-                self.nic_ips[i] = None
-        for i in range(len(self.links)):
-            try:
-                ipv6addr = self.generate_ipv6(self.links[i], self.nic_macs[i])
-                if not ipv6addr:
-                    continue
-                self.ipv6s.append("%s"%(ipv6addr))
-            except Exception as e:
-                pass
-        if self.admin_state == 'up':
-            self.admin_state = True
-        if self.admin_state == 'down':
-            self.admin_state = False
+                hydrate(self)
+            except KeyError:
+                # Not in the fields fetched
+                raise AttributeError(name)
+            return object.__getattribute__(self, name)
+        fields = self._fields
+        if fields is None:
+            fields = self._fields = dict((f.replace(".", "_"), f)
+                                         for f in self._info)
+        try:
+            return self._info[fields[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def raw(self):
+        '''The RAPI info dict of the instance. It may be shared with other
+        instances and the cache, so it must not be modified.
+        '''
+        return self._info
+
+    def _hydrate_admin_state(self):
+        state = self._info['admin_state']
+        if state == 'up':
+            state = True
+        elif state == 'down':
+            state = False
+        self.admin_state = state
+
+    def _hydrate_ctime(self):
+        ctime = self._info['ctime']
+        if ctime:
+            ctime = datetime.fromtimestamp(ctime)
+        self.ctime = ctime
+
+    def _hydrate_mtime(self):
+        mtime = self._info['mtime']
+        if mtime:
+            mtime = datetime.fromtimestamp(mtime)
+        self.mtime = mtime
+
+    def _hydrate_nic_ips(self):
+        nic_ips = self._info['nic.ips']
+        if 'bridged' in self.nic_modes:
+            # Copy, the info dict may be shared
+            nic_ips = list(nic_ips)
+            for i in range(len(self.nic_modes)):
+                if self.nic_modes[i] == 'bridged':
+                    nic_ips[i] = None
+        self.nic_ips = nic_ips
+
+    def _hydrate_tags(self):
+        listusers, listorganizations, listgroups, listinstanceapplications = \
+            [l or {} for l in self._lookups[:4]]
+        users = []
+        groups = []
+        services = []
+        organization = None
+        application = None
+        adminlock = False
+        isolate = False
+        whitelistip = None
+        for tag in self.tags:
+            if tag.startswith(GROUP_PFX):
+                group = listgroups.get(tag[len(GROUP_PFX):])
+                if group is not None:
+                    groups.append(group)
+            elif tag.startswith(USER_PFX):
+                user = listusers.get(tag[len(USER_PFX):])
+                if user is not None:
+                    users.append(user)
+            elif tag.startswith(ORG_PFX):
+                org = listorganizations.get(tag[len(ORG_PFX):])
+                if org is not None:
+                    organization = org
+            elif tag.startswith(APP_PFX):
+                app = listinstanceapplications.get(tag[len(APP_PFX):])
+                if app is not None:
+                    application = app
+            elif tag.startswith(SERV_PFX):
+                services.append(tag[len(SERV_PFX):])
+            elif tag == ADMINLOCK_TAG:
+                adminlock = True
+            elif tag == ISOLATE_TAG:
+                isolate = True
+            elif tag.startswith(WHITELIST_PFX):
+                whitelistip = tag[len(WHITELIST_PFX):]
+        self.users = users
+        self.groups = groups
+        self.services = services
+        self.organization = organization
+        self.application = application
+        self.adminlock = adminlock
+        self.isolate = isolate
+        self.whitelistip = whitelistip
+
+    def _hydrate_links(self):
+        # The IPv6 prefixes of the networks of the NICs, None if unset
+        networks = self._lookups[4] or {}
+        self.links = [networks[link] for link in self.nic_links
+                      if link in networks]
+
+    def _hydrate_ipv6s(self):
+        ipv6s = []
+        for prefix, mac in zip(self.links, self.nic_macs):
+            ipv6addr = self.generate_ipv6(prefix, mac)
+            if ipv6addr:
+                ipv6s.append("%s" % ipv6addr)
+        self.ipv6s = ipv6s
+
+    # slot -> method setting it, and possibly others, on first access
+    _hydrators = {
+        'admin_state': _hydrate_admin_state,
+        'ctime': _hydrate_ctime,
+        'mtime': _hydrate_mtime,
+        'nic_ips': _hydrate_nic_ips,
+        'users': _hydrate_tags,
+        'groups': _hydrate_tags,
+        'services': _hydrate_tags,
+        'organization': _hydrate_tags,
+        'application': _hydrate_tags,
+        'adminlock': _hydrate_tags,
+        'isolate': _hydrate_tags,
+        'whitelistip': _hydrate_tags,
+        'links': _hydrate_links,
+        'ipv6s': _hydrate_ipv6s,
+    }
 
     def generate_ipv6(self, prefix, mac):
-        try:
-            prefix = ipaddr.IPv6Network(prefix)
-            mac_parts = mac.split(":")
-            prefix_parts = prefix.network.exploded.split(':')
-            eui64 = mac_parts[:3] + [ "ff", "fe" ] + mac_parts[3:]
-            eui64[0] = "%02x" % (int(eui64[0], 16) ^ 0x02)
-            ip = ":".join(prefix_parts[:4])
-            for l in range(0, len(eui64), 2):
-                ip += ":%s" % "".join(eui64[l:l+2])
-            ip = ipaddr.IPAddress(ip).compressed
-            return ip
-        except:
-            return False
+        return eui64_address(prefix, mac)
         
     def set_params(self, **kwargs):
         job_id = self.cluster._client.ModifyInstance(self.name, **kwargs)
@@ -275,14 +546,11 @@ class Instance(object):
     def __unicode__(self):
         return self.name
 
-    def get_lock_key(self):
-        return self.cluster._instance_lock_key(self.name)
-
     def lock(self, reason="locked", timeout=30, job_id=None):
         self.cluster._lock_instance(self.name, reason, timeout, job_id)
 
     def is_locked(self):
-        return cache.get(self.get_lock_key())
+        return self.cluster.is_instance_locked(self.name)
 
     def set_admin_view_only_True(self):
         self.admin_view_only = True
@@ -345,7 +613,11 @@ class Cluster(models.Model):
         models.Model.__init__(self, *args, **kwargs)
         self._client = GanetiRapiClient(host=self.hostname,
                                         username=self.username,
-                                        password=self.password)
+                                        password=self.password,
+                                        pool_size=RAPI_CONNECTION_POOL_SIZE,
+                                        breaker_store=cache,
+                                        breaker_threshold=RAPI_BREAKER_THRESHOLD,
+                                        breaker_cooldown=RAPI_BREAKER_COOLDOWN)
 
     def __unicode__(self):
         return self.hostname
@@ -353,19 +625,43 @@ class Cluster(models.Model):
     def _instance_cache_key(self, instance):
         return "cluster:%s:instance:%s" % (self.slug, instance)
 
+    def _locks_key(self):
+        return "cluster:%s:locks" % self.slug
+
     def _instance_lock_key(self, instance):
         return "cluster:%s:instance:%s:lock" % (self.slug, instance)
 
+    def _instances_cache_key(self, fields=None):
+        if fields is None:
+            return "cluster:%s:instances" % self.slug
+        fields_hash = sha.new(",".join(sorted(fields))).hexdigest()[:10]
+        return "cluster:%s:instances:%s" % (self.slug, fields_hash)
+
+    def clear_instances_cache(self):
+        keys = [self._instances_cache_key(fields)
+                for fields in INSTANCE_FIELD_SETS]
+        cache.delete_many(keys + [self._owners_key(k) for k in keys])
+
+    def _generation_key(self):
+        return "cluster:%s:generation" % self.slug
+
+    def bump_generation(self):
+        '''Invalidates every cached per-user listing that includes this
+        cluster, see clusters_generation.
+        '''
+        advance_generation(self._generation_key())
+
     def _lock_instance(self, instance, reason="locked",
                        timeout=30, job_id=None):
-        lock_key = self._instance_lock_key(instance)
-        cache.set(lock_key, reason, timeout)
-        locked_instances = cache.get('locked_instances')
-        if locked_instances is not None:
-            locked_instances["%s"%instance]=reason
-            cache.set('locked_instances', locked_instances, 90)
+        if cache_has_hashes():
+            cache.hset(self._locks_key(), instance, reason, timeout)
         else:
-            cache.set('locked_instances', {'%s'%instance:"%s"%reason}, 90)
+            # A key per lock, along with the instances that may be locked
+            locked = self.get_locked_instances().keys()
+            if instance not in locked:
+                locked.append(instance)
+            cache.set(self._instance_lock_key(instance), reason, timeout)
+            cache.set(self._locks_key(), locked, 86400)
         if job_id is not None:
             b = None
             for i in range(5):
@@ -383,9 +679,32 @@ class Cluster(models.Model):
                               "cluster": self.slug,
                               "instance": instance,
                               "job_id": job_id,
-                              "lock_key": lock_key,
                               "flush_keys": [self._instance_cache_key(instance)]}))
 
+    def unlock_instance(self, instance):
+        if cache_has_hashes():
+            cache.hdel(self._locks_key(), instance)
+        else:
+            cache.delete(self._instance_lock_key(instance))
+
+    def is_instance_locked(self, instance):
+        '''Returns the reason the instance is locked for, or None.'''
+        if cache_has_hashes():
+            return cache.hget(self._locks_key(), instance)
+        return cache.get(self._instance_lock_key(instance))
+
+    def get_locked_instances(self):
+        '''Returns the reasons the instances of the cluster are locked
+        for, by instance name, in a single round trip (two without
+        hashes).
+        '''
+        if cache_has_hashes():
+            return cache.hgetall(self._locks_key())
+        keys = dict((self._instance_lock_key(instance), instance)
+                    for instance in cache.get(self._locks_key()) or [])
+        return dict((keys[key], reason)
+                    for key, reason in cache.get_many(keys.keys()).items())
+
     @classmethod
     def get_all_instances(cls):
         instances = []
@@ -397,7 +716,8 @@ class Cluster(models.Model):
         info = self.get_instance_info(name)
         if info is None:
             raise Http404()
-        users, orgs, groups, instanceapps, networks = preload_instance_data()
+        users, orgs, groups, instanceapps, networks = \
+            principals.resolve([info])
         return Instance(self, info["name"], info, listusers = users, listorganizations = orgs, listgroups = groups, listinstanceapplications = instanceapps, networks = networks)
 
     def get_instance_or_404(self, name):
@@ -409,53 +729,278 @@ class Cluster(models.Model):
             else:
                 raise
 
-    def get_instances(self):
-        instances_min = []
+    def _build_instances(self, infos, collect=None):
+        '''Builds the instances of a listing. A streamed listing is built
+        in batches of PRINCIPALS_BATCH instances while the rest of it is
+        still being received.
+        '''
+        if isinstance(infos, list):
+            return self._build_batch(infos, collect)
         retinstances = []
-        instances = cache.get("cluster:%s:instances" % self.slug)
-        if instances is None:
-            instances = self._client.GetInstances(bulk=True)
-            cache.set("cluster:%s:instances" % self.slug, instances, 45)
-        users, orgs, groups, instanceapps, networks = preload_instance_data()
-        retinstances = [Instance(self, info['name'], info, listusers = users, listorganizations = orgs, listgroups = groups, listinstanceapplications = instanceapps, networks = networks) for info in instances]
+        batch = []
+        for info in infos:
+            batch.append(info)
+            if len(batch) == PRINCIPALS_BATCH:
+                retinstances.extend(self._build_batch(batch, collect))
+                batch = []
+        retinstances.extend(self._build_batch(batch, collect))
         return retinstances
-    
+
+    def _build_batch(self, infos, collect=None):
+        users, orgs, groups, instanceapps, networks = \
+            principals.resolve(infos)
+        if collect is not None:
+            collect.extend(infos)
+        return [Instance(self, info['name'], info, listusers = users, listorganizations = orgs, listgroups = groups, listinstanceapplications = instanceapps, networks = networks)
+                for info in infos]
+
+    def _cache_snapshot(self, cache_key, value, fresh_timeout, stale_timeout,
+                        derived=None):
+        '''Caches a snapshot, along with the keys derived(cache_key, value)
+        returns, if given.
+        '''
+        data = {cache_key: value}
+        if derived is not None:
+            data.update(derived(cache_key, value))
+        cache.set_many(data, stale_timeout)
+        cache.set("%s:fresh" % cache_key, True, fresh_timeout)
+
+    def _revalidate(self, cache_key, fetch, fresh_timeout, stale_timeout,
+                    derived=None):
+        '''Refreshes a stale snapshot in a background greenlet, unless
+        another worker already holds the refresh lease.
+        '''
+        lease_key = "%s:lease" % cache_key
+        if not cache.add(lease_key, True, RAPI_TIMEOUT):
+            return
+
+        def _refresh():
+            try:
+                with Timeout(RAPI_TIMEOUT, False):
+                    self._cache_snapshot(cache_key, fetch(), fresh_timeout,
+                                         stale_timeout, derived)
+            except GanetiApiError, err:
+                logger.warning("Unable to refresh %s: %s" % (cache_key, err))
+            except Exception:
+                logger.exception("Unable to refresh %s" % cache_key)
+            finally:
+                cache.delete(lease_key)
+        spawn(_refresh)
+
+    def _cached(self, cache_key, fetch, fresh_timeout, stale_timeout,
+                derived=None, extra_keys=()):
+        '''Returns the snapshot cached under cache_key, or None if missing,
+        along with the values of extra_keys that are cached.
+
+        A stale snapshot is returned as is and refreshed in the background
+        through fetch.
+        '''
+        fresh_key = "%s:fresh" % cache_key
+        cached = cache.get_many([cache_key, fresh_key] + list(extra_keys))
+        value = cached.pop(cache_key, None)
+        if value is not None and cached.pop(fresh_key, None) is None:
+            self._revalidate(cache_key, fetch, fresh_timeout, stale_timeout,
+                             derived)
+        if extra_keys:
+            return value, cached
+        return value
+
+    def get_instances(self, fields=None):
+        cache_key = self._instances_cache_key(fields)
+        instances = self._cached(
+            cache_key,
+            lambda: self._client.GetInstances(bulk=True, fields=fields),
+            INSTANCES_CACHE_TIMEOUT, INSTANCES_STALE_TIMEOUT,
+            self._index_instances)
+        if instances is not None:
+            return self._build_instances(instances)
+        retinstances = []
+        instances = instances_flight.Do(cache_key, self._fetch_instances,
+                                        fields, cache_key, retinstances)
+        if retinstances:
+            return retinstances
+        return self._build_instances(instances)
+
+    def _fetch_instances(self, fields, cache_key, retinstances):
+        '''Fetches the instance listing from the cluster and caches it.
+
+        Only one worker at a time fetches a listing, holding a short lease.
+        The others wait for it for a while before fetching it themselves.
+        The built instances are appended to retinstances.
+        '''
+        lease_key = "%s:lease" % cache_key
+        leased = cache.add(lease_key, True, RAPI_TIMEOUT)
+        if not leased:
+            deadline = time() + INSTANCES_LEASE_WAIT
+            while time() < deadline:
+                sleep(0.2)
+                instances = cache.get(cache_key)
+                if instances is not None:
+                    return instances
+        try:
+            # Build the instances while the RAPI response is still being
+            # decoded
+            instances = []
+            retinstances.extend(self._build_instances(
+                self._client.GetInstances(bulk=True, fields=fields,
+                                          stream=True),
+                collect=instances))
+            self._cache_snapshot(cache_key, instances,
+                                 INSTANCES_CACHE_TIMEOUT,
+                                 INSTANCES_STALE_TIMEOUT,
+                                 self._index_instances)
+        finally:
+            if leased:
+                cache.delete(lease_key)
+        return instances
+
+    def get_tagged_instances(self, tags, fields=None):
+        '''Returns the instances carrying any of the given tags.
+
+        An already cached snapshot of the cluster is reused. Otherwise only
+        the matching instances are fetched through the RAPI query resource.
+        Clusters whose RAPI lacks the query resource get the full listing,
+        so the result may include instances without any of the tags.
+        '''
+        cache_key = self._instances_cache_key(fields)
+        noquery_key = "cluster:%s:noquery" % self.slug
+        instances = cache.get(cache_key)
+        if instances is None and not cache.get(noquery_key):
+            qfilter = [QFILTER_OR] + [[QFILTER_CONTAINS, "tags", tag]
+                                      for tag in tags]
+            try:
+                instances = instances_flight.Do(
+                    (cache_key, tuple(tags)), self._client.QueryInstances,
+                    list(fields or INSTANCE_LISTING_FIELDS), qfilter=qfilter)
+            except GanetiApiError, err:
+                if err.code not in (404, 405, 501):
+                    raise
+                cache.set(noquery_key, True, 3600)
+        if instances is None:
+            return self.get_instances(fields)
+        return self._build_instances(instances)
+
     def force_cluster_cache_refresh(self, instance):
         '''Used in cases of actions that could potentially lock the cluster
         thus preventing users from listing, even for some seconds, their instances
         and delay node listing for admins
         '''
-        retinstances = []        
-        instances = self._client.GetInstances(bulk=True)
+        self.clear_instances_cache()
+        instances = self._client.GetInstances(bulk=True,
+                                              fields=INSTANCE_LISTING_FIELDS)
         for i in instances:
             if i['name'] == instance:
                 i['action_lock'] = True
-        cache.set("cluster:%s:instances" % self.slug, instances, 45)
-        users, orgs, groups, instanceapps, networks = preload_instance_data()
-        retinstances = [Instance(self, info['name'], info, listusers = users, listorganizations = orgs, listgroups = groups, listinstanceapplications = instanceapps, networks = networks) for info in instances]
-        return retinstances
-
-    def get_user_instances(self, user):
-        instances = self.get_instances()
+        self._cache_snapshot(self._instances_cache_key(INSTANCE_LISTING_FIELDS),
+                             instances, INSTANCES_CACHE_TIMEOUT,
+                             INSTANCES_STALE_TIMEOUT, self._index_instances)
+        return self._build_instances(instances)
+
+    def _instance_names_key(self):
+        return "cluster:%s:instance_names" % self.slug
+
+    def _index_instances(self, cache_key, infos):
+        '''Records the cluster of each instance of a listing being cached
+        and returns its owners index, to be cached along with it.
+
+        The listings of all field sets name the same instances, so the
+        record is written only when the names of the cluster change, or
+        halfway to its expiry (INSTANCES_STALE_TIMEOUT) to renew it. The
+        names last recorded are kept per cluster, to drop those missing
+        from the listing (deleted or renamed instances).
+        '''
+        if not cache_has_hashes():
+            return self._owners_index(cache_key, infos)
+        names = set(info['name'] for info in infos)
+        indexed = cache.get(self._instance_names_key())
+        if (indexed is None or set(indexed[1]) != names or
+                indexed[0] < time() - INSTANCES_STALE_TIMEOUT / 2):
+            cache.hset_many(INSTANCE_CLUSTERS_KEY,
+                            dict.fromkeys(names, self.slug),
+                            INSTANCES_STALE_TIMEOUT)
+            if indexed is not None:
+                cache.hdel(INSTANCE_CLUSTERS_KEY,
+                           *set(indexed[1]).difference(names))
+            cache.set(self._instance_names_key(), (time(), sorted(names)),
+                      INSTANCES_STALE_TIMEOUT)
+        return self._owners_index(cache_key, infos)
+
+    def _owners_key(self, cache_key):
+        return "%s:owners" % cache_key
+
+    def _owners_index(self, cache_key, infos):
+        '''Indexes an instance listing by its user and group tags. Each tag
+        maps to the (position, name) of the instances carrying it. The index
+        is cached along with the listing, see get_user_instances.
+        '''
+        user_pfx = "%s:user:" % GANETI_TAG_PREFIX
+        group_pfx = "%s:group:" % GANETI_TAG_PREFIX
+        index = {}
+        for pos, info in enumerate(infos):
+            for tag in info.get('tags', ()):
+                if tag.startswith(user_pfx) or tag.startswith(group_pfx):
+                    index.setdefault(tag, []).append((pos, info['name']))
+        return {self._owners_key(cache_key): index}
+
+    def _select_owned(self, infos, owners, tags):
+        '''Returns the infos the owners index lists under any of the tags,
+        or None if the index does not match the listing.
+        '''
+        entries = set()
+        for tag in tags:
+            entries.update([tuple(e) for e in owners.get(tag, ())])
+        selected = []
+        for pos, name in sorted(entries):
+            if pos >= len(infos) or infos[pos]['name'] != name:
+                return None
+            selected.append(infos[pos])
+        return selected
+
+    def get_user_instances(self, user, fields=None, groups=None):
+        '''Returns the instances of the cluster the user may see. Callers
+        going through several clusters pass the names of the groups of the
+        user, see user_group_names, not to query them once per cluster.
+        '''
         if user.is_superuser:
-            return instances
-        elif user.has_perm('ganeti.view_instances'):
-            user = User.objects.filter(pk=user.pk).select_related('groups').get()
-            ugroups = []
-            for ug in user.groups.all():
-                ugroups.append(ug.pk)
-            user_inst = [i for i in instances if (user in i.users or
-                    len(list(set(ugroups).intersection(set([g.id for g in i.groups]))))> 0)]
-            other_inst = [i for i in instances if (i not in user_inst)]
-            map(lambda i: i.set_admin_view_only_True(), other_inst)
+            return self.get_instances(fields)
+        if groups is None:
+            groups = user_group_names(user)
+        tags = ["%s:user:%s" % (GANETI_TAG_PREFIX, user.username)]
+        tags.extend(["%s:group:%s" % (GANETI_TAG_PREFIX, name)
+                     for name in groups])
+        cache_key = self._instances_cache_key(fields)
+        owners_key = self._owners_key(cache_key)
+        if user.has_perm('ganeti.view_instances'):
+            instances = self.get_instances(fields)
+            owners = cache.get(owners_key)
+            if owners is not None:
+                owned = set([e[1] for tag in tags for e in owners.get(tag, ())])
+            else:
+                tagset = set(tags)
+                owned = set([i.name for i in instances
+                             if tagset.intersection(i.tags)])
+            user_inst = []
+            other_inst = []
+            for i in instances:
+                if i.name in owned:
+                    user_inst.append(i)
+                else:
+                    i.set_admin_view_only_True()
+                    other_inst.append(i)
             return user_inst + other_inst
         else:
-            user = User.objects.filter(pk=user.pk).select_related('groups').get()
-            ugroups = []
-            for ug in user.groups.all():
-                ugroups.append(ug.pk)
-            return [i for i in instances if (user in i.users or
-                   len(list(set(ugroups).intersection(set([g.id for g in i.groups]))))> 0)]
+            infos, extra = self._cached(
+                cache_key,
+                lambda: self._client.GetInstances(bulk=True, fields=fields),
+                INSTANCES_CACHE_TIMEOUT, INSTANCES_STALE_TIMEOUT,
+                self._index_instances, [owners_key])
+            if infos is not None and owners_key in extra:
+                selected = self._select_owned(infos, extra[owners_key], tags)
+                if selected is not None:
+                    return self._build_instances(selected)
+            instances = self.get_tagged_instances(tags, fields)
+            tagset = set(tags)
+            return [i for i in instances if tagset.intersection(i.tags)]
 
     def get_cluster_info(self):
         info = cache.get("cluster:%s:info" % self.slug)
@@ -471,10 +1016,13 @@ class Cluster(models.Model):
         return info
 
     def get_cluster_nodes(self):
-        info = cache.get("cluster:%s:nodes" % self.slug)
+        cache_key = "cluster:%s:nodes" % self.slug
+        info = self._cached(cache_key, self._client.GetNodes,
+                            NODES_CACHE_TIMEOUT, NODES_STALE_TIMEOUT)
         if info is None:
             info = self._client.GetNodes()
-            cache.set("cluster:%s:nodes" % self.slug, info, 180)
+            self._cache_snapshot(cache_key, info, NODES_CACHE_TIMEOUT,
+                                 NODES_STALE_TIMEOUT)
         return info
 
     def get_cluster_instances(self):
@@ -484,34 +1032,41 @@ class Cluster(models.Model):
         return self._client.GetInstances(bulk=True)
 
     def get_node_info(self, node):
-        info = cache.get("cluster:%s:node:%s" % (self.slug, node))
+        cache_key = "cluster:%s:node:%s" % (self.slug, node)
+        info = self._cached(cache_key, lambda: self._fetch_node_info(node),
+                            NODES_CACHE_TIMEOUT, NODES_STALE_TIMEOUT)
         if info is None:
-            info = self._client.GetNode(node)
-            info['cluster'] = self.slug
-            if info['mfree'] is None:
-                info['mfree'] = 0
-            if info['mtotal'] is None:
-                info['mtotal'] = 0
-            if info['dtotal'] is None:
-                info['dtotal'] = 0
-            if info['dfree'] is None:
-                info['dfree'] = 0
-            try:
-                info['mem_used'] = 100*(info['mtotal']-info['mfree'])/info['mtotal']
-            except ZeroDivisionError:
-                '''this is the case where the node is offline and reports none, thus it is 0'''
-                info['mem_used'] = 0
-            try:
-                info['disk_used'] = 100*(info['dtotal']-info['dfree'])/info['dtotal']
-            except ZeroDivisionError:
-                '''this is the case where the node is offline and reports none, thus it is 0'''
-                info['disk_used'] = 0
+            info = self._fetch_node_info(node)
+            self._cache_snapshot(cache_key, info, NODES_CACHE_TIMEOUT,
+                                 NODES_STALE_TIMEOUT)
+        return info
+
+    def _fetch_node_info(self, node):
+        info = self._client.GetNode(node)
+        info['cluster'] = self.slug
+        if info['mfree'] is None:
+            info['mfree'] = 0
+        if info['mtotal'] is None:
+            info['mtotal'] = 0
+        if info['dtotal'] is None:
+            info['dtotal'] = 0
+        if info['dfree'] is None:
+            info['dfree'] = 0
+        try:
+            info['mem_used'] = 100*(info['mtotal']-info['mfree'])/info['mtotal']
+        except ZeroDivisionError:
+            '''this is the case where the node is offline and reports none, thus it is 0'''
+            info['mem_used'] = 0
+        try:
+            info['disk_used'] = 100*(info['dtotal']-info['dfree'])/info['dtotal']
+        except ZeroDivisionError:
+            '''this is the case where the node is offline and reports none, thus it is 0'''
+            info['disk_used'] = 0
+        info['shared_storage'] = False
+        if self.default_disk_template in ['drbd', 'plain']:
             info['shared_storage'] = False
-            if self.default_disk_template in ['drbd', 'plain']:
-                info['shared_storage'] = False
-            if self.default_disk_template == 'sharedfile':
-                info['shared_storage'] = True
-            cache.set("cluster:%s:node:%s" % (self.slug, node), info, 180)
+        if self.default_disk_template == 'sharedfile':
+            info['shared_storage'] = True
         return info
 
     def get_instance_info(self, instance):
@@ -648,6 +1203,35 @@ class Cluster(models.Model):
     def get_job_status(self, job_id):
         return self._client.GetJobStatus(job_id)
 
+    def wait_for_job_change(self, job_id, fields, prev_job_info=None,
+                            prev_log_serial=None):
+        return self._client.WaitForJobChange(job_id, fields, prev_job_info,
+                                             prev_log_serial)
+
+    def get_jobs_status(self, job_ids, fields):
+        '''Returns the given fields of the given jobs, by job id.
+
+        Only these jobs are fetched, through the RAPI query resource. Jobs
+        it does not return (e.g. already archived) are left out. Clusters
+        whose RAPI lacks the query resource get every job queried on its
+        own.
+        '''
+        noquery_key = "cluster:%s:noquery" % self.slug
+        if not cache.get(noquery_key):
+            qfilter = [QFILTER_OR] + [[QFILTER_EQUAL, "id", int(job_id)]
+                                      for job_id in job_ids]
+            try:
+                return dict((int(info["id"]), info) for info in
+                            self._client.QueryJobs(list(fields),
+                                                   qfilter=qfilter)
+                            if info.get("status") is not None)
+            except GanetiApiError, err:
+                if err.code not in (404, 405, 501):
+                    raise
+                cache.set(noquery_key, True, 3600)
+        return dict((job_id, self.get_job_status(job_id))
+                    for job_id in job_ids)
+
     def get_default_network(self):
         try:
             return self.network_set.get(cluster_default=True)
@@ -684,51 +1268,147 @@ class Network(models.Model):
 
 
 
-def preload_instance_data():
-    networks = cache.get('networklist')
-    if not networks:
-        networks = Network.objects.select_related('cluster').all()
-        networkdict = {}
-        for network in networks:
-            networkdict[network.link] = network.ipv6_prefix
-        networks = networkdict
-        cache.set('networklist', networks, 30)
-    users = cache.get('userlist')
-    if not users:
-        users = User.objects.select_related('groups').all()
-        userdict = {}
-        for user in users:
-            userdict[user.username] = user
-        users = userdict
-        cache.set('userlist', users, 30)
-    orgs = cache.get('orgslist')
-    if not orgs:
-        orgs = Organization.objects.all()
-        orgsdict = {}
-        for org in orgs:
-            orgsdict[org.tag] = org
-        orgs = orgsdict
-        cache.set('orgslist', orgs, 30)
-    groups = cache.get('groupslist')
-    if not groups:
-        groups = Group.objects.all().select_related('user_set').all()
-        groupsdict = {}
-        for group in groups:
-            group.userset = group.user_set.all()
-            groupsdict[group.name] = group
-        groups = groupsdict
-        cache.set('groupslist', groups, 30)
-    instanceapps = cache.get('instaceapplist')
-    if not instanceapps:
-        instanceapps = InstanceApplication.objects.all()
-        instappdict= {}
-        for instapp in instanceapps:
-            instappdict[str(instapp.pk)] = instapp
-        instanceapps = instappdict
-        cache.set('instaceapplist', instanceapps, 30)
-    return users, orgs, groups, instanceapps, networks
-
-
+_last_generation = 0
+
+def _new_generation():
+    global _last_generation
+    _last_generation = max(int(time() * 1000000), _last_generation + 1)
+    return _last_generation
+
+
+def advance_generation(key):
+    '''Moves the generation kept under key to a value it never had. The
+    current time is used instead of a counter, which would restart from
+    the same value once the key expires or is evicted.
+    '''
+    cache.set(key, _new_generation(), GENERATION_TIMEOUT)
+
+
+def get_generations(keys):
+    '''Returns the generation kept under each of the keys. Missing ones
+    (never bumped, expired or evicted) get a new generation, so that they
+    cannot repeat one readers have already seen.
+    '''
+    generations = cache.get_many(keys)
+    for key in keys:
+        if generations.get(key) is None:
+            generation = _new_generation()
+            if not cache.add(key, generation, GENERATION_TIMEOUT):
+                generation = cache.get(key)
+            generations[key] = generation
+    return generations
+
+
+def clusters_generation(clusters):
+    '''Returns a token that changes whenever any of the clusters bumps its
+    generation. Caches built from the clusters embed it in their keys, so
+    they are invalidated with a single write and age out through their TTL.
+    '''
+    keys = [c._generation_key() for c in clusters]
+    generations = get_generations(keys)
+    token = ",".join(["%s" % generations[k] for k in keys])
+    return sha.new(token).hexdigest()[:10]
+
+
+class PrincipalResolver(object):
+    '''Resolves the users, groups, organizations and applications named in
+    instance tags.
+
+    Only the names found in the tags are fetched, with a query per kind,
+    and kept for PRINCIPALS_TIMEOUT seconds along with the names that do not
+    exist. The lookups are shared by all the callers in the process and
+    must not be modified.
+    '''
+    kinds = ('user', 'group', 'org', 'application')
+
+    def __init__(self, timeout=PRINCIPALS_TIMEOUT):
+        self.timeout = timeout
+        self._generation = None
+        self.clear()
+
+    def clear(self):
+        '''Forgets the principals known to this process only, see
+        invalidate.
+        '''
+        self._expires = time() + self.timeout
+        self._lookups = dict((kind, {}) for kind in self.kinds)
+        self._networks = None
+
+    def invalidate(self):
+        '''Makes every process forget the principals it knows.'''
+        advance_generation(PRINCIPALS_GENERATION_KEY)
+        self.clear()
+
+    def _fresh(self):
+        generation = get_generations([PRINCIPALS_GENERATION_KEY])[
+            PRINCIPALS_GENERATION_KEY]
+        if time() > self._expires or generation != self._generation:
+            self.clear()
+            self._generation = generation
+        return self._lookups
+
+    def resolve(self, infos):
+        '''Fetches the principals named in the tags of the RAPI instance
+        infos that are not known yet. Returns the users, organizations,
+        groups, applications and network IPv6 prefixes by name (or link),
+        as the listusers, listorganizations, listgroups,
+        listinstanceapplications and networks arguments of Instance.
+        '''
+        lookups = self._fresh()
+        prefix = "%s:" % GANETI_TAG_PREFIX
+        names = dict((kind, set()) for kind in self.kinds)
+        for info in infos:
+            for tag in info.get('tags', ()):
+                if tag.startswith(prefix):
+                    kind, sep, name = tag[len(prefix):].partition(':')
+                    if sep and kind in names and name not in lookups[kind]:
+                        names[kind].add(name)
+        for kind in self.kinds:
+            if names[kind]:
+                self._fetch(kind, list(names[kind]), lookups[kind])
+        networks = self._networks
+        if networks is None:
+            networks = self._networks = dict(
+                Network.objects.values_list('link', 'ipv6_prefix'))
+        return (lookups['user'], lookups['org'], lookups['group'],
+                lookups['application'], networks)
+
+    def _fetch(self, kind, names, lookup):
+        found = {}
+        for i in range(0, len(names), PRINCIPALS_BATCH):
+            batch = names[i:i + PRINCIPALS_BATCH]
+            if kind == 'user':
+                for user in User.objects.filter(username__in=batch):
+                    found[user.username] = user
+            elif kind == 'group':
+                groups = {}
+                for group in Group.objects.filter(name__in=batch):
+                    group.userset = []
+                    groups[group.pk] = group
+                    found[group.name] = group
+                members = User.groups.through.objects.filter(
+                    group__in=groups.keys()).select_related('user')
+                for member in members:
+                    groups[member.group_id].userset.append(member.user)
+            elif kind == 'org':
+                for org in Organization.objects.filter(tag__in=batch):
+                    found[org.tag] = org
+            elif kind == 'application':
+                pks = [int(n) for n in batch if n.isdigit()]
+                for pk, app in InstanceApplication.objects.in_bulk(pks).items():
+                    found[str(pk)] = app
+        for name in names:
+            lookup[name] = found.get(name)
+
+    def get(self, kind, name):
+        '''Returns a single principal, or None if it does not exist.'''
+        lookup = self._fresh()[kind]
+        if name not in lookup:
+            self._fetch(kind, [name], lookup)
+        return lookup[name]
+
+
+principals = PrincipalResolver()
 
 
 REQUEST_ACTIONS = (
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+# Collected by "manage.py test ganeti"
+from ganetimgr.ganeti.tests.rapi_client import *
+from ganetimgr.ganeti.tests.cache import *
+from ganetimgr.ganeti.tests.models import *
+from ganetimgr.ganeti.tests.jobtracker import *
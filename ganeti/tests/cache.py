@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+import cPickle as pickle
+import time
+import zlib
+from datetime import datetime
+
+import redis
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.utils import unittest
+from gevent import joinall, sleep
+
+from ganetimgr.ganeti import models
+from ganetimgr.ganeti.tests.rapi_client import FakeRapiPool
+from redis_cache.cache import CacheClass, family_index_key
+from redis_cache.codecs import Codec, SERIALIZERS, COMPRESSORS, \
+    LEGACY_HEADERS
+from util import ganeti_client
+from util.fakerapi import FakeRapi
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def counted(calls, name, method):
+    '''Wraps method, appending name to calls on every call.'''
+    def _counted(*args, **kwargs):
+        calls.append(name)
+        return method(*args, **kwargs)
+    return _counted
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class RedisCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = CacheClass('127.0.0.1:6379', {'timeout': 60})
+        self.redis = self.cache._cache = fakeredis.FakeRedis()
+        self.redis.flushall()
+
+    def test_add_sets_expiry_with_the_key(self):
+        self.assertTrue(self.cache.add("cluster:c1:lease", True, 30))
+        self.assertFalse(self.cache.add("cluster:c1:lease", True, 30))
+        self.assertTrue(0 < self.redis.ttl("cluster:c1:lease") <= 30)
+
+    def test_add_is_atomic(self):
+        # Any round trip after the first one fails
+        def broken(*args, **kwargs):
+            raise redis.ConnectionError("connection lost")
+        self.redis.expire = broken
+        self.redis.pipeline = broken
+        self.assertTrue(self.cache.add("rapi:breaker:c1:probe", True, 30))
+        self.assertTrue(0 < self.redis.ttl("rapi:breaker:c1:probe") <= 30)
+
+    def _count(self, *methods):
+        calls = []
+        for name in methods:
+            setattr(self.redis, name,
+                    counted(calls, name, getattr(self.redis, name)))
+        return calls
+
+    def test_many_keys_in_one_round_trip(self):
+        calls = self._count("pipeline", "mget")
+        data = {"k1": 1, "k2": {"name": "vm1"}, "k3": "value"}
+        self.assertTrue(self.cache.set_many(data, 30))
+        self.assertEqual(self.cache.get_many(["k1", "k2", "k3", "k4"]), data)
+        self.assertEqual(calls, ["pipeline", "mget"])
+        for key in data:
+            self.assertTrue(0 < self.redis.ttl(key) <= 30)
+        self.cache.delete_many(["k1", "k2"])
+        self.assertEqual(self.cache.get_many(["k1", "k2", "k3"]),
+                         {"k3": "value"})
+
+    def test_hash_fields_expire_on_their_own(self):
+        self.cache.hset("cluster:c1:locks", "vm1", "reboot", 30)
+        self.cache.hset_many("cluster:c1:locks",
+                             {"vm2": "shutdown", "vm3": u"\u03b1"}, 300)
+        self.assertEqual(self.cache.hgetall("cluster:c1:locks"),
+                         {"vm1": "reboot", "vm2": "shutdown",
+                          "vm3": u"\u03b1"})
+        expiry, value = self.redis.hget("cluster:c1:locks", "vm1").split(":")
+        self.assertTrue(time.time() < int(expiry) <= time.time() + 30)
+        # The hash outlives its longest lived field
+        self.assertTrue(60 < self.redis.ttl("cluster:c1:locks") <= 300)
+        # A field that expired a while ago
+        self.redis.hset("cluster:c1:locks", "vm1",
+                        "%d:reboot" % (time.time() - 5))
+        self.assertEqual(self.cache.hget("cluster:c1:locks", "vm1"), None)
+        self.assertEqual(self.cache.hget("cluster:c1:locks", "vm2"),
+                         "shutdown")
+        self.assertEqual(sorted(self.cache.hgetall("cluster:c1:locks")),
+                         ["vm2", "vm3"])
+        self.cache.hdel("cluster:c1:locks", "vm2", "vm3")
+        self.assertEqual(self.cache.hgetall("cluster:c1:locks"), {})
+        self.assertEqual(self.cache.hget("cluster:c1:locks", "vm4"), None)
+
+    def test_family_index_drops_expired_keys(self):
+        index = family_index_key("cluster")
+        self.cache.set("cluster:c1:info", {"name": "c1"}, 60)
+        self.cache.set("cluster:c1:nodes", [], -1)
+        # A key that expired a while ago
+        self.redis.zadd(index, **{"cluster:c1:instance:vm1": time.time() - 5})
+        self.cache.set("cluster:c1:instance:vm2", {}, 3)
+        self.assertEqual(sorted(self.redis.zrange(index, 0, -1)),
+                         ["cluster:c1:info", "cluster:c1:instance:vm2",
+                          "cluster:c1:nodes"])
+        self.cache.delete_family("cluster")
+        self.assertEqual(self.cache.get("cluster:c1:info"), None)
+        self.assertEqual(self.cache.get("cluster:c1:nodes"), None)
+        self.assertFalse(self.redis.exists(index))
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class LocalCacheTest(SimpleTestCase):
+    key = "cluster:c1:instances"
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.redis.flushall()
+        self.calls = []
+        self.redis.mget = counted(self.calls, "mget", self.redis.mget)
+
+    def _cache(self):
+        cache = CacheClass('127.0.0.1:6379', {'timeout': 60, 'l1_size': 2})
+        cache._cache = cache._local._redis = self.redis
+        cache.get("missing")
+        for i in range(50):
+            if cache._local._listening:
+                break
+            sleep(0.02)
+        self.assertTrue(cache._local._listening)
+        return cache
+
+    def test_repeated_reads_stay_local(self):
+        cache = self._cache()
+        cache.set(self.key, [{"name": "vm1"}])
+        cache.set("cluster:c1:info", {"name": "c1"})
+        del self.calls[:]
+        for i in range(3):
+            self.assertEqual(cache.get(self.key), [{"name": "vm1"}])
+            self.assertEqual(cache.get("cluster:c1:info"), {"name": "c1"})
+        # Only the first read of the listing reaches Redis
+        self.assertEqual(self.calls, ["mget"] * 4)
+
+    def test_holds_at_most_size_entries(self):
+        cache = self._cache()
+        for i in range(3):
+            cache.set("cluster:c%d:instances" % i, [i])
+            cache.get("cluster:c%d:instances" % i)
+        self.assertEqual(cache._local._entries.keys(),
+                         ["cluster:c1:instances", "cluster:c2:instances"])
+
+    def test_changes_elsewhere_evict_it(self):
+        cache = self._cache()
+        other = self._cache()
+        cache.set(self.key, ["old"])
+        self.assertEqual(cache.get(self.key), ["old"])
+        other.set(self.key, ["new"])
+        for i in range(50):
+            if cache.get(self.key) == ["new"]:
+                break
+            sleep(0.02)
+        self.assertEqual(cache.get(self.key), ["new"])
+        other.delete(self.key)
+        for i in range(50):
+            if cache.get(self.key) is None:
+                break
+            sleep(0.02)
+        self.assertEqual(cache.get(self.key), None)
+
+    def test_nothing_is_kept_while_not_listening(self):
+        cache = self._cache()
+        cache._local._listening = False
+        cache.set(self.key, ["vm1"])
+        cache.get(self.key)
+        self.assertEqual(cache._local._entries, {})
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class CacheStatsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.redis.flushall()
+
+    def _cache(self):
+        cache = CacheClass('127.0.0.1:6379',
+                           {'timeout': 60, 'stats': 1,
+                            'stats_families': 'mine=cluster:c2:*'})
+        cache._cache = cache._stats._redis = self.redis
+        return cache
+
+    def test_counts_by_key_family_across_processes(self):
+        cache = self._cache()
+        other = self._cache()
+        cache.set("cluster:c1:instances", [{"name": "vm1"}])
+        cache.get("cluster:c1:instances")
+        other.get_many(["cluster:c1:instances", "cluster:c1:info",
+                        "cluster:c2:info", "bad_clusters"])
+        # As it does every STATS_FLUSH_INTERVAL seconds
+        other._stats.flush()
+        stats = cache.get_stats()
+        self.assertEqual(sorted(stats),
+                         ["cluster", "health", "instances", "mine", "redis"])
+        instances = stats["instances"]
+        self.assertEqual((instances["hits"], instances["writes"],
+                          instances["hit_ratio"]), (2, 1, 1.0))
+        self.assertEqual(instances["bytes_written"],
+                         instances["avg_bytes_read"])
+        for family in ("cluster", "health", "mine"):
+            self.assertEqual((stats[family]["misses"],
+                              stats[family]["hit_ratio"]), (1, 0.0))
+        self.assertEqual((stats["redis"]["reads"], stats["redis"]["writes"]),
+                         (2, 1))
+        cache.reset_stats()
+        self.assertEqual(other.get_stats(), {})
+
+    def test_disabled_by_default(self):
+        cache = CacheClass('127.0.0.1:6379', {'timeout': 60})
+        cache._cache = self.redis
+        cache.get("cluster:c1:instances")
+        self.assertEqual(cache.get_stats(), None)
+        self.assertEqual(self.redis.keys("cache:stats:*"), [])
+
+
+class CodecTest(SimpleTestCase):
+    values = [{"name": "vm1", "tags": [u"ganetimgr:user:\u03b1"],
+               "oper_state": True, "beparams": {"memory": 1024},
+               "ctime": 1300000000.5, "nic.ips": [None]},
+              [{"name": "vm%d" % i, "disk.sizes": [10240]}
+               for i in range(100)],
+              12, (1, 2), "!zlib!not a header", u"caf\u00e9",
+              datetime(2014, 1, 2, 3, 4, 5)]
+
+    def test_round_trips(self):
+        for serializer in SERIALIZERS:
+            for compressor in COMPRESSORS:
+                codec = Codec(serializer, compressor)
+                for value in self.values:
+                    for plain in (False, True):
+                        data = codec.encode(value, plain)
+                        self.assertTrue(isinstance(data, str))
+                        decoded = codec.decode(data)
+                        if isinstance(value, unicode):
+                            decoded = decoded.decode('utf-8')
+                        if serializer == "msgpack" and plain and \
+                                isinstance(value, tuple):
+                            value = list(value)
+                        self.assertEqual(decoded, value,
+                                         "%s %s %r" % (serializer,
+                                                       compressor, value))
+
+    def test_headers(self):
+        codec = Codec("marshal", "zlib", compress_min=1000)
+        self.assertEqual(codec.encode("vm1"), "vm1")
+        self.assertTrue(codec.encode({"name": "vm1"}, plain=True)
+                        .startswith("!v1:marshal:!"))
+        # Not plain data, whatever the caller says
+        self.assertTrue(codec.encode(datetime.now(), plain=True)
+                        .startswith("!v1:pickle:!"))
+        self.assertTrue(codec.encode(self.values[1], plain=True)
+                        .startswith("!v1:marshal:zlib!"))
+        self.assertTrue(codec.encode("x" * 2000).startswith("!v1:raw:zlib!"))
+        # Strings that could be taken for a header get one
+        self.assertEqual(codec.encode("!zlib!"), "!v1:raw:!!zlib!")
+        self.assertEqual(codec.decode("!v1:raw:!!zlib!"), "!zlib!")
+
+    def test_decodes_values_of_other_configurations(self):
+        value = self.values[1]
+        data = Codec("pickle", "zlib").encode(value, plain=True)
+        self.assertEqual(Codec("marshal", "zlib").decode(data), value)
+
+    def test_decodes_legacy_values(self):
+        codec = Codec()
+        value = {"name": "vm1", "ctime": datetime(2014, 1, 2)}
+        pickled = LEGACY_HEADERS['pickle'] + pickle.dumps(value)
+        self.assertEqual(codec.decode(pickled), value)
+        self.assertEqual(codec.decode(LEGACY_HEADERS['zlib'] +
+                                      zlib.compress(pickled)), value)
+        for raw in ("vm1", "!", "!v1:", "!v1:marshal", "!bang!"):
+            self.assertEqual(codec.decode(raw), raw)
+
+
+def fake_redis_cache():
+    cache = CacheClass('127.0.0.1:6379', {'timeout': 60})
+    cache._cache = fakeredis.FakeRedis()
+    cache._cache.flushall()
+    return cache
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class SnapshotCacheTest(SimpleTestCase):
+    key = "cluster:stale:nodes"
+
+    def setUp(self):
+        self._cache = models.cache
+        self._spawn = models.spawn
+        models.cache = fake_redis_cache()
+        self.greenlets = []
+
+        def spawn(*args):
+            self.greenlets.append(self._spawn(*args))
+            return self.greenlets[-1]
+        models.spawn = spawn
+        self.cluster = models.Cluster(slug="stale",
+                                      hostname="stale.example.org")
+        self.fetches = 0
+
+    def tearDown(self):
+        models.cache = self._cache
+        models.spawn = self._spawn
+
+    def _fetch(self):
+        self.fetches += 1
+        sleep(0.02)
+        return ["node%d" % self.fetches]
+
+    def _cached(self):
+        return self.cluster._cached(self.key, self._fetch, 45, 600)
+
+    def test_fresh_snapshot_is_served(self):
+        self.cluster._cache_snapshot(self.key, ["node0"], 45, 600)
+        self.assertEqual(self._cached(), ["node0"])
+        self.assertEqual(self.greenlets, [])
+
+    def test_stale_snapshot_is_served_while_refreshed_once(self):
+        self.cluster._cache_snapshot(self.key, ["node0"], 45, 600)
+        models.cache.delete("%s:fresh" % self.key)
+        for i in range(3):
+            self.assertEqual(self._cached(), ["node0"])
+        # The refresh holds the lease
+        self.assertEqual(len(self.greenlets), 1)
+        lease_ttl = models.cache._cache.ttl("%s:lease" % self.key)
+        self.assertTrue(0 < lease_ttl <= models.RAPI_TIMEOUT)
+        joinall(self.greenlets)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self._cached(), ["node1"])
+        self.assertEqual(models.cache.get("%s:lease" % self.key), None)
+        self.assertTrue(models.cache.get("%s:fresh" % self.key))
+        self.assertTrue(45 < models.cache._cache.ttl(self.key) <= 600)
+
+    def test_missing_snapshot_is_not_refreshed(self):
+        self.assertEqual(self._cached(), None)
+        self.assertEqual(self.greenlets, [])
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class OwnersIndexTest(TestCase):
+    host = "owners.example.org"
+    fields = models.INSTANCE_LISTING_FIELDS
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = fake_redis_cache()
+        self.rapi = FakeRapi(instances=40, users=5, groups=2)
+        self.pool = FakeRapiPool(self.rapi, self.host)
+        ganeti_client._connection_pools[(self.host, 5080)] = self.pool
+        self.cluster = models.Cluster(slug="owners", hostname=self.host)
+        self.user = User.objects.create(username="user0001")
+        self.tag = "ganetimgr:user:user0001"
+        self.owned = sorted([name for name, info in
+                             self.rapi.get_cluster(self.host).instances.items()
+                             if self.tag in info["tags"]])
+        self.assertTrue(self.owned)
+
+    def tearDown(self):
+        del ganeti_client._connection_pools[(self.host, 5080)]
+        models.cache = self._cache
+
+    def _owners_key(self):
+        return self.cluster._owners_key(
+            self.cluster._instances_cache_key(self.fields))
+
+    def _user_instances(self):
+        return sorted([i.name for i in
+                       self.cluster.get_user_instances(self.user,
+                                                       self.fields, [])])
+
+    def test_is_cached_along_with_the_listing(self):
+        infos = [i.raw for i in self.cluster.get_instances(self.fields)]
+        owners = models.cache.get(self._owners_key())
+        for pos, info in enumerate(infos):
+            for tag in info["tags"]:
+                if ":user:" in tag or ":group:" in tag:
+                    self.assertTrue((pos, info["name"]) in
+                                    [tuple(e) for e in owners[tag]])
+        self.assertEqual(sorted([e[1] for e in owners[self.tag]]),
+                         self.owned)
+
+    def test_serves_the_user_listing(self):
+        self.cluster.get_instances(self.fields)
+        requests = self.pool.requests
+        # Without going through the listing
+        self.cluster.get_tagged_instances = None
+        self.assertEqual(self._user_instances(), self.owned)
+        self.assertEqual(self.pool.requests, requests)
+
+    def test_index_not_matching_the_listing_is_ignored(self):
+        self.cluster.get_instances(self.fields)
+        owners = models.cache.get(self._owners_key())
+        owners[self.tag] = [(0, "renamed.example.org")]
+        models.cache.set(self._owners_key(), owners)
+        self.assertEqual(self._user_instances(), self.owned)
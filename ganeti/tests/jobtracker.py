@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+from django.test import SimpleTestCase
+from gevent import spawn, joinall, sleep
+
+from util import jobtracker
+from util.ganeti_client import GanetiApiError
+
+
+class FakeCluster(object):
+    '''Knows the jobs in statuses, which end after polls polls. The query
+    misses the jobs in archived, the jobs in errors fail on their own.
+    Waiting for a job takes wait seconds, or fails with can_wait False.
+    '''
+    slug = "fake"
+
+    def __init__(self, statuses, polls=2, archived=(), errors=None,
+                 wait=0.01, can_wait=True):
+        self.statuses = statuses
+        self.polls = polls
+        self.archived = archived
+        self.errors = errors or {}
+        self.wait = wait
+        self.can_wait = can_wait
+        self.calls = []
+        self.queries = 0
+        self.waits = 0
+
+    def _status(self, job_id):
+        self.calls.append(job_id)
+        done = self.calls.count(job_id) >= self.polls
+        return {"id": job_id, "status": self.statuses[job_id],
+                "end_ts": done and [1, 0] or None}
+
+    def get_jobs_status(self, job_ids, fields):
+        self.queries += 1
+        return dict((job_id, self._status(job_id)) for job_id in job_ids
+                    if job_id in self.statuses
+                    and job_id not in self.archived)
+
+    def get_job_status(self, job_id):
+        if job_id in self.errors:
+            raise GanetiApiError("Job %d" % job_id, code=self.errors[job_id])
+        if job_id not in self.statuses:
+            raise GanetiApiError("Job %d not found" % job_id, code=404)
+        return self._status(job_id)
+
+    def wait_for_job_change(self, job_id, fields, prev_job_info=None,
+                            prev_log_serial=None):
+        self.waits += 1
+        if not self.can_wait:
+            raise GanetiApiError("Not implemented", code=501)
+        if job_id in self.errors:
+            raise GanetiApiError("Job %d" % job_id, code=self.errors[job_id])
+        if job_id not in self.statuses:
+            raise GanetiApiError("Job %d not found" % job_id, code=404)
+        sleep(self.wait)
+        status = self._status(job_id)
+        return {"job_info": [status[f] for f in fields], "log_entries": []}
+
+
+class JobTrackerTest(SimpleTestCase):
+
+    def setUp(self):
+        self._intervals = jobtracker.POLL_INTERVALS
+        jobtracker.POLL_INTERVALS = [0.01]
+        jobtracker.logger.disabled = True
+
+    def tearDown(self):
+        jobtracker.POLL_INTERVALS = self._intervals
+        jobtracker.logger.disabled = False
+
+    def _watch(self, tracker, job_ids, timeout=5):
+        greenlets = [spawn(list, tracker.watch(job_id)) for job_id in job_ids]
+        joinall(greenlets, timeout=timeout)
+        return [g.value for g in greenlets]
+
+    def test_jobs_end(self):
+        cluster = FakeCluster({1: "success", 2: "error"}, archived=(2,))
+        tracker = jobtracker.JobTracker(cluster)
+        first, second = self._watch(tracker, [1, 2])
+        self.assertEqual([s["end_ts"] for s in first], [None, [1, 0]])
+        self.assertEqual(second[-1]["status"], "error")
+        self.assertEqual(tracker._watchers, {})
+
+    def test_unknown_job_does_not_block_the_others(self):
+        cluster = FakeCluster({2: "success", 3: "success"})
+        tracker = jobtracker.JobTracker(cluster)
+        gone, second, third = self._watch(tracker, [1, 2, 3])
+        self.assertEqual([s["status"] for s in gone],
+                         [jobtracker.JOB_STATUS_GONE])
+        self.assertTrue(gone[0]["end_ts"])
+        self.assertTrue(second[-1]["end_ts"])
+        self.assertTrue(third[-1]["end_ts"])
+        self.assertEqual(tracker._watchers, {})
+        self.assertFalse(1 in cluster.calls)
+
+    def test_failing_job_does_not_block_the_others(self):
+        cluster = FakeCluster({1: "running", 2: "success"}, archived=(1,),
+                              errors={1: 502})
+        tracker = jobtracker.JobTracker(cluster)
+        greenlet = spawn(list, tracker.watch(1))
+        second, = self._watch(tracker, [2])
+        self.assertTrue(second[-1]["end_ts"])
+        # The failing job is still watched, until the cluster answers
+        self.assertEqual(tracker._watchers.keys(), [1])
+        greenlet.kill()
+
+    def test_single_job_is_long_polled(self):
+        cluster = FakeCluster({1: "success"}, polls=3)
+        tracker = jobtracker.JobTracker(cluster)
+        statuses, = self._watch(tracker, [1])
+        self.assertEqual([s["end_ts"] for s in statuses],
+                         [None, None, [1, 0]])
+        self.assertEqual((cluster.waits, cluster.queries), (3, 0))
+
+    def test_unknown_single_job(self):
+        cluster = FakeCluster({})
+        tracker = jobtracker.JobTracker(cluster)
+        statuses, = self._watch(tracker, [1])
+        self.assertEqual([s["status"] for s in statuses],
+                         [jobtracker.JOB_STATUS_GONE])
+        self.assertTrue(tracker._can_wait)
+
+    def test_new_job_stops_the_long_poll(self):
+        cluster = FakeCluster({1: "running", 2: "success"}, wait=2)
+        tracker = jobtracker.JobTracker(cluster)
+        greenlet = spawn(list, tracker.watch(1))
+        sleep(0.05)
+        second, = self._watch(tracker, [2], timeout=1)
+        self.assertTrue(second and second[-1]["end_ts"])
+        self.assertTrue(cluster.queries)
+        greenlet.kill()
+
+    def test_cluster_that_cannot_wait_is_polled(self):
+        cluster = FakeCluster({1: "success"}, can_wait=False)
+        tracker = jobtracker.JobTracker(cluster)
+        statuses, = self._watch(tracker, [1])
+        self.assertTrue(statuses[-1]["end_ts"])
+        self.assertFalse(tracker._can_wait)
+        self.assertEqual(cluster.waits, 1)
@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+import random
+import socket
+from datetime import datetime
+
+import ipaddr
+from django.contrib.auth.models import Group, User
+from django.core.cache import get_cache
+from django.test import SimpleTestCase, TestCase
+from django.utils import unittest
+from gevent import joinall
+
+from ganetimgr.ganeti import models
+from ganetimgr.ganeti.tests.rapi_client import FakeRapiPool
+from redis_cache.cache import CacheClass
+from util import ganeti_client
+from util.ganeti_client import GanetiApiError
+from util.fakerapi import FakeRapi
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def string_eui64_address(prefix, mac):
+    '''The string based implementation eui64_address replaced.'''
+    try:
+        prefix = ipaddr.IPv6Network(prefix)
+        mac_parts = mac.split(":")
+        prefix_parts = prefix.network.exploded.split(':')
+        eui64 = mac_parts[:3] + ["ff", "fe"] + mac_parts[3:]
+        eui64[0] = "%02x" % (int(eui64[0], 16) ^ 0x02)
+        ip = ":".join(prefix_parts[:4])
+        for l in range(0, len(eui64), 2):
+            ip += ":%s" % "".join(eui64[l:l+2])
+        return ipaddr.IPAddress(ip).compressed
+    except:
+        return False
+
+
+class EUI64AddressTest(SimpleTestCase):
+    prefixes = ['2001:db8:1::/64', '2001:db8::/48', '::/64',
+                '2001:db8:0:0:1::/80', 'fe80::/10', '2001:0:0:1::/64',
+                '2001:db8:1:2:3:4:5:6', '2001:db8::/129', '10.0.0.0/8',
+                'bogus', None]
+    macs = ['aa:00:04:00:0a:01', '02:00:00:00:00:00', '00:00:00:00:00:00',
+            '02:00:ff:00:00:00', '02:00:00:00:00:01', 'AA:BB:CC:DD:EE:FF',
+            'zz:00:00:00:00:00', 'aa:bb', None]
+
+    def setUp(self):
+        models._ipv6_prefixes.clear()
+        models._ipv6_addresses.clear()
+
+    def assertMatches(self, prefixes, macs):
+        for prefix in prefixes:
+            for mac in macs:
+                self.assertEqual(models.eui64_address(prefix, mac),
+                                 string_eui64_address(prefix, mac),
+                                 "%s %s" % (prefix, mac))
+
+    def test_matches_string_implementation(self):
+        self.assertMatches(self.prefixes, self.macs)
+
+    def test_matches_string_implementation_on_random_macs(self):
+        r = random.Random(1)
+        macs = [':'.join(['%02x' % r.randrange(256) for _ in range(6)])
+                for _ in range(500)]
+        self.assertMatches(self.prefixes[:3], macs)
+
+    def test_memoized_results_match(self):
+        self.assertMatches(self.prefixes, self.macs)
+        self.assertTrue(models._ipv6_addresses)
+        self.assertMatches(self.prefixes, self.macs)
+
+    def test_memo_is_bounded(self):
+        size = models.IPV6_MEMO_SIZE
+        models.IPV6_MEMO_SIZE = 10
+        try:
+            for i in range(25):
+                models.eui64_address('2001:db8:1::/64',
+                                     '02:00:00:00:00:%02x' % i)
+                self.assertTrue(len(models._ipv6_addresses) <= 10)
+        finally:
+            models.IPV6_MEMO_SIZE = size
+        self.assertEqual(models.eui64_address('2001:db8:1::/64',
+                                              'aa:00:04:00:0a:01'),
+                         '2001:db8:1:0:a800:4ff:fe00:a01')
+
+
+class InstanceTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cluster = models.Cluster(slug="inst", hostname="inst.example.org")
+        self.info = {
+            "name": "vm1.example.org", "admin_state": "up",
+            "oper_state": True, "ctime": 1300000000.5, "mtime": None,
+            "tags": ["ganetimgr:user:alice", "ganetimgr:user:gone",
+                     "ganetimgr:group:ops", "ganetimgr:org:grnet",
+                     "ganetimgr:service:web", "ganetimgr:adminlock",
+                     "ganetimgr:whitelist_ip:192.0.2.1"],
+            "nic.links": ["br0", "br1"], "nic.modes": ["routed", "bridged"],
+            "nic.ips": ["192.0.2.10", "192.0.2.11"],
+            "nic.macs": ["aa:00:04:00:0a:01", "aa:00:04:00:0a:02"],
+            "disk.sizes": [10240], "disk_template": "drbd",
+        }
+
+    def _instance(self):
+        return models.Instance(self.cluster, self.info["name"], self.info,
+                               listusers={"alice": "ALICE", "gone": None},
+                               listorganizations={"grnet": "GRNET"},
+                               listgroups={"ops": "OPS"},
+                               listinstanceapplications={},
+                               networks={"br0": "2001:db8:1::/64"})
+
+    def test_fields_are_kept_in_slots(self):
+        instance = self._instance()
+        self.assertFalse(hasattr(instance, "__dict__"))
+        self.assertRaises(AttributeError, setattr, instance, "bogus", 1)
+        self.assertEqual(instance.nic_links, ["br0", "br1"])
+        self.assertEqual(instance.disk_sizes, [10240])
+        # Other RAPI fields come from the info dict
+        self.assertEqual(instance.disk_template, "drbd")
+        self.assertTrue(instance.raw is self.info)
+        # Fields that were not fetched
+        self.assertFalse(hasattr(instance, "pnode"))
+        self.assertFalse(hasattr(instance, "bogus"))
+
+    def test_derived_fields(self):
+        instance = self._instance()
+        self.assertEqual(instance.admin_state, True)
+        self.assertEqual(instance.ctime, datetime.fromtimestamp(1300000000.5))
+        self.assertEqual(instance.mtime, None)
+        self.assertEqual(instance.nic_ips, ["192.0.2.10", None])
+        self.assertEqual(instance.users, ["ALICE"])
+        self.assertEqual(instance.groups, ["OPS"])
+        self.assertEqual(instance.organization, "GRNET")
+        self.assertEqual(instance.application, None)
+        self.assertEqual(instance.services, ["web"])
+        self.assertEqual((instance.adminlock, instance.isolate,
+                          instance.whitelistip), (True, False, "192.0.2.1"))
+        self.assertEqual(instance.links, ["2001:db8:1::/64"])
+        self.assertEqual(instance.ipv6s, ["2001:db8:1:0:a800:4ff:fe00:a01"])
+        # The shared info dict is left as it is
+        self.assertEqual(self.info["nic.ips"], ["192.0.2.10", "192.0.2.11"])
+
+    def test_derived_fields_are_computed_on_first_access(self):
+        hydrators = models.Instance._hydrators
+        calls = []
+
+        def counted(name, hydrate):
+            def _counted(instance):
+                calls.append(name)
+                hydrate(instance)
+            return _counted
+        models.Instance._hydrators = dict(
+            (slot, counted(hydrate.__name__, hydrate))
+            for slot, hydrate in hydrators.items())
+        try:
+            instance = self._instance()
+            self.assertEqual(calls, [])
+            instance.users
+            instance.groups
+            instance.adminlock
+            self.assertEqual(calls, ["_hydrate_tags"])
+            instance.ipv6s
+            instance.ipv6s
+            self.assertEqual(calls, ["_hydrate_tags", "_hydrate_ipv6s",
+                                     "_hydrate_links"])
+        finally:
+            models.Instance._hydrators = hydrators
+
+    def test_derived_fields_need_their_rapi_fields(self):
+        del self.info["ctime"], self.info["tags"]
+        instance = self._instance()
+        self.assertFalse(hasattr(instance, "ctime"))
+        self.assertFalse(hasattr(instance, "users"))
+        self.assertEqual(instance.admin_state, True)
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class InstanceLookupTest(TestCase):
+    host = "lookup.example.org"
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = CacheClass('127.0.0.1:6379', {'timeout': 60})
+        models.cache._cache = fakeredis.FakeRedis()
+        models.cache._cache.flushall()
+        self.rapi = FakeRapi(instances=3)
+        self.pool = FakeRapiPool(self.rapi, self.host)
+        ganeti_client._connection_pools[(self.host, 5080)] = self.pool
+        models.Cluster.objects.create(slug="lookup", hostname=self.host)
+        self.name = sorted(self.rapi.get_cluster(self.host).instances)[0]
+        models.cache.hset(models.INSTANCE_CLUSTERS_KEY, self.name, "lookup")
+
+    def tearDown(self):
+        del ganeti_client._connection_pools[(self.host, 5080)]
+        models.cache = self._cache
+
+    def _indexed(self, name):
+        return models.cache.hget(models.INSTANCE_CLUSTERS_KEY, name)
+
+    def test_finds_indexed_instance(self):
+        instances = models.Instance.objects._named(self.name)
+        self.assertEqual([i.name for i in instances], [self.name])
+        self.assertEqual(self.pool.requests, 1)
+
+    def test_missing_instance_is_dropped_from_the_index(self):
+        del self.rapi.get_cluster(self.host).instances[self.name]
+        self.assertEqual(models.Instance.objects._named(self.name), [])
+        self.assertEqual(self._indexed(self.name), None)
+
+    def test_failing_cluster_falls_back_to_the_scan(self):
+        self.rapi.get_cluster(self.host).error_rate = 1
+        self.assertEqual(models.Instance.objects._named(self.name), None)
+        self.assertEqual(self._indexed(self.name), "lookup")
+
+
+class UserInstancesTest(TestCase):
+    hosts = ["one.example.org", "two.example.org"]
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = get_cache('locmem://')
+        self.rapi = FakeRapi(instances=20, users=4, groups=2, group_ratio=1)
+        self.clusters = []
+        for host in self.hosts:
+            ganeti_client._connection_pools[(host, 5080)] = \
+                FakeRapiPool(self.rapi, host)
+            self.clusters.append(models.Cluster.objects.create(
+                slug=host.split(".")[0], hostname=host))
+        self.user = User.objects.create(username="user0000")
+        self.user.groups.add(Group.objects.create(name="group000"))
+
+    def tearDown(self):
+        for host in self.hosts:
+            del ganeti_client._connection_pools[(host, 5080)]
+        models.cache = self._cache
+
+    def test_groups_are_resolved_once(self):
+        tags = set(["ganetimgr:user:user0000", "ganetimgr:group:group000"])
+        groups = models.user_group_names(self.user)
+        self.assertEqual(groups, ["group000"])
+        user_group_names = models.user_group_names
+        models.user_group_names = None
+        try:
+            for cluster in self.clusters:
+                instances = cluster.get_user_instances(self.user, None, groups)
+                owned = [i["name"] for i in self.rapi.get_cluster(
+                         cluster.hostname).instances.values()
+                         if tags.intersection(i["tags"])]
+                self.assertTrue(owned)
+                self.assertEqual(sorted([i.name for i in instances]),
+                                 sorted(owned))
+        finally:
+            models.user_group_names = user_group_names
+
+
+class TaggedInstancesTest(TestCase):
+    host = "tagged.example.org"
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = get_cache('locmem://')
+        models.cache.clear()
+        self.rapi = FakeRapi(instances=30)
+        self.pool = FakeRapiPool(self.rapi, self.host)
+        ganeti_client._connection_pools[(self.host, 5080)] = self.pool
+        self.cluster = models.Cluster(slug="tagged", hostname=self.host)
+        self.tags = ["ganetimgr:user:user0000"]
+        self.owned = sorted([name for name, info in
+                             self.rapi.get_cluster(self.host).instances.items()
+                             if self.tags[0] in info["tags"]])
+
+    def tearDown(self):
+        del ganeti_client._connection_pools[(self.host, 5080)]
+        models.cache = self._cache
+
+    def _tagged(self):
+        return sorted([i.name for i in self.cluster.get_tagged_instances(
+                       self.tags, models.INSTANCE_LISTING_FIELDS)])
+
+    def test_queries_only_the_tagged_instances(self):
+        self.assertEqual(self._tagged(), self.owned)
+
+    def test_falls_back_to_the_listing_without_the_query_resource(self):
+        self.rapi._routes = [r for r in self.rapi._routes
+                             if r[2] != self.rapi.query]
+        self.assertEqual(len(self._tagged()), 30)
+        requests = self.pool.requests
+        self.cluster.clear_instances_cache()
+        self.assertEqual(len(self._tagged()), 30)
+        # The cluster is not queried again
+        self.assertEqual(self.pool.requests, requests + 1)
+
+
+class PrincipalResolverTest(TestCase):
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = get_cache('locmem://')
+        models.cache.clear()
+        alice = User.objects.create(username="alice")
+        User.objects.create(username="bob")
+        alice.groups.add(Group.objects.create(name="ops"))
+        self.infos = [{"name": "vm1", "tags": ["ganetimgr:user:alice",
+                                               "ganetimgr:group:ops"]},
+                      {"name": "vm2", "tags": ["ganetimgr:user:nobody",
+                                               "ganetimgr:service:web"]}]
+
+    def tearDown(self):
+        models.cache = self._cache
+
+    def test_resolves_only_the_named_principals(self):
+        resolver = models.PrincipalResolver()
+        # The users, the groups and their members, and the networks
+        with self.assertNumQueries(4):
+            users, orgs, groups, apps, networks = \
+                resolver.resolve(self.infos)
+        self.assertEqual(sorted(users), ["alice", "nobody"])
+        self.assertEqual(users["nobody"], None)
+        self.assertEqual([u.username for u in groups["ops"].userset],
+                         ["alice"])
+        self.assertEqual((orgs, apps, networks), ({}, {}, {}))
+        with self.assertNumQueries(0):
+            resolver.resolve(self.infos)
+        with self.assertNumQueries(1):
+            users = resolver.resolve([{"name": "vm3", "tags":
+                                       ["ganetimgr:user:bob"]}])[0]
+        self.assertEqual(sorted(users), ["alice", "bob", "nobody"])
+
+
+class InstanceLockTests(object):
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = self.make_cache()
+        self.cluster = models.Cluster(slug="locks",
+                                      hostname="locks.example.org")
+
+    def tearDown(self):
+        models.cache = self._cache
+
+    def test_lock_and_unlock(self):
+        self.cluster._lock_instance("vm1", "reboot", 30)
+        self.cluster._lock_instance("vm2", "shutdown", 30)
+        self.cluster._lock_instance("vm1", "reboot", 30)
+        self.assertEqual(self.cluster.is_instance_locked("vm1"), "reboot")
+        self.assertEqual(self.cluster.get_locked_instances(),
+                         {"vm1": "reboot", "vm2": "shutdown"})
+        self.cluster.unlock_instance("vm1")
+        self.assertEqual(self.cluster.is_instance_locked("vm1"), None)
+        self.assertEqual(self.cluster.get_locked_instances(),
+                         {"vm2": "shutdown"})
+
+
+class LocMemInstanceLockTest(InstanceLockTests, SimpleTestCase):
+
+    def make_cache(self):
+        return get_cache('locmem://')
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class RedisInstanceLockTest(InstanceLockTests, SimpleTestCase):
+
+    def make_cache(self):
+        cache = CacheClass('127.0.0.1:6379', {'timeout': 60})
+        cache._cache = fakeredis.FakeRedis()
+        cache._cache.flushall()
+        return cache
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class InstanceIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = CacheClass('127.0.0.1:6379', {'timeout': 60})
+        models.cache._cache = fakeredis.FakeRedis()
+        models.cache._cache.flushall()
+        self.cluster = models.Cluster(slug="index",
+                                      hostname="index.example.org")
+        self.writes = 0
+        hset_many = models.cache.hset_many
+
+        def counting_hset_many(*args):
+            self.writes += 1
+            return hset_many(*args)
+        models.cache.hset_many = counting_hset_many
+
+    def tearDown(self):
+        models.cache = self._cache
+
+    def _index(self, *names):
+        self.cluster._index_instances("listing",
+                                      [{"name": name} for name in names])
+
+    def _indexed(self):
+        return models.cache.hgetall(models.INSTANCE_CLUSTERS_KEY)
+
+    def test_drops_instances_no_longer_listed(self):
+        models.cache.hset(models.INSTANCE_CLUSTERS_KEY, "other", "elsewhere")
+        self._index("vm1", "vm2", "vm3")
+        self._index("vm1", "vm3", "vm4")
+        self.assertEqual(self._indexed(),
+                         {"vm1": "index", "vm3": "index", "vm4": "index",
+                          "other": "elsewhere"})
+
+    def test_writes_only_changes(self):
+        for i in range(3):
+            self._index("vm1", "vm2")
+        self.assertEqual(self.writes, 1)
+        self._index("vm1")
+        self.assertEqual(self.writes, 2)
+
+
+class LocMemInstanceIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = get_cache('locmem://')
+        self.cluster = models.Cluster(slug="index",
+                                      hostname="index.example.org")
+
+    def tearDown(self):
+        models.cache = self._cache
+
+    def test_no_index_without_hashes(self):
+        infos = [{"name": "vm1", "tags": ["ganetimgr:user:alice"]}]
+        self.assertEqual(self.cluster._index_instances("listing", infos),
+                         self.cluster._owners_index("listing", infos))
+        self.assertEqual(models.Instance.objects._named("vm1"), None)
+
+
+class GenerationTests(object):
+
+    def setUp(self):
+        self._cache = models.cache
+        models.cache = self.make_cache()
+        self.cluster = models.Cluster(slug="gen", hostname="gen.example.org")
+
+    def tearDown(self):
+        models.cache = self._cache
+
+    def test_bump_changes_the_user_index_key(self):
+        from ganetimgr.ganeti.views import user_index_cache_key
+        seen = [user_index_cache_key("alice", [self.cluster])]
+        self.assertEqual(user_index_cache_key("alice", [self.cluster]),
+                         seen[0])
+        self.cluster.bump_generation()
+        seen.append(user_index_cache_key("alice", [self.cluster]))
+        # An evicted generation does not bring back an earlier one
+        models.cache.delete(self.cluster._generation_key())
+        seen.append(user_index_cache_key("alice", [self.cluster]))
+        self.cluster.bump_generation()
+        seen.append(user_index_cache_key("alice", [self.cluster]))
+        self.assertEqual(len(set(seen)), 4)
+
+    def test_user_index_key_covers_every_cluster(self):
+        from ganetimgr.ganeti.views import user_index_cache_key
+        other = models.Cluster(slug="gen2", hostname="gen2.example.org")
+        clusters = [self.cluster, other]
+        alice = user_index_cache_key("alice", clusters)
+        bob = user_index_cache_key("bob", clusters)
+        self.assertNotEqual(alice, bob)
+        other.bump_generation()
+        self.assertNotEqual(user_index_cache_key("alice", clusters), alice)
+        self.assertNotEqual(user_index_cache_key("bob", clusters), bob)
+        # Only a single cluster
+        key = user_index_cache_key("alice", [self.cluster])
+        other.bump_generation()
+        self.assertEqual(user_index_cache_key("alice", [self.cluster]), key)
+
+    def test_invalidate_reaches_other_resolvers(self):
+        resolver = models.PrincipalResolver()
+        other = models.PrincipalResolver()
+        other._fresh()['user']['alice'] = None
+        resolver.invalidate()
+        self.assertEqual(other._fresh()['user'], {})
+        other._fresh()['user']['alice'] = None
+        models.cache.delete(models.PRINCIPALS_GENERATION_KEY)
+        self.assertEqual(other._fresh()['user'], {})
+        other._fresh()['user']['alice'] = None
+        resolver.invalidate()
+        self.assertEqual(other._fresh()['user'], {})
+
+
+class LocMemGenerationTest(GenerationTests, SimpleTestCase):
+
+    def make_cache(self):
+        return get_cache('locmem://')
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class RedisGenerationTest(GenerationTests, SimpleTestCase):
+
+    def make_cache(self):
+        cache = CacheClass('127.0.0.1:6379', {'timeout': 60})
+        cache._cache = fakeredis.FakeRedis()
+        cache._cache.flushall()
+        return cache
+
+
+class RevalidateTest(SimpleTestCase):
+
+    def setUp(self):
+        self._cache = models.cache
+        self._spawn = models.spawn
+        models.cache = get_cache('locmem://')
+        models.logger.disabled = True
+        self.greenlets = []
+
+        def spawn(*args):
+            self.greenlets.append(self._spawn(*args))
+            return self.greenlets[-1]
+        models.spawn = spawn
+        self.cluster = models.Cluster(slug="stale",
+                                      hostname="stale.example.org")
+
+    def tearDown(self):
+        models.cache = self._cache
+        models.spawn = self._spawn
+        models.logger.disabled = False
+
+    def _revalidate(self, fetch):
+        self.cluster._revalidate("snapshot", fetch, 45, 600)
+        joinall(self.greenlets)
+
+    def test_unexpected_errors_are_handled(self):
+        for error in (GanetiApiError("down"), socket.error("refused"),
+                      AttributeError("no client")):
+            def fetch():
+                raise error
+            self._revalidate(fetch)
+            self.assertTrue(self.greenlets[-1].successful())
+            self.assertEqual(models.cache.get("snapshot:lease"), None)
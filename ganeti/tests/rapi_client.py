@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*- vim:encoding=utf-8:
+# vim: tabstop=4:shiftwidth=4:softtabstop=4:expandtab
+import simplejson
+import socket
+import time
+from datetime import datetime
+from StringIO import StringIO
+
+from django.test import SimpleTestCase
+from gevent import spawn, joinall, sleep
+from gevent.timeout import Timeout
+
+from util import ganeti_client
+from util.fakerapi import FakeRapi
+from util.ganeti_client import GanetiRapiClient, GanetiApiError, \
+    RapiConnectionPool, CircuitBreaker, CircuitOpenError, SingleFlight, \
+    FanOut, BREAKER_CLOSED, BREAKER_OPEN, BREAKER_HALF_OPEN, QFILTER_OR, \
+    QFILTER_CONTAINS, _LocalBreakerStore
+
+
+class FakePool(object):
+    '''Stands in for the connection pool of a client, answering every
+    request with the same response after a delay.
+    '''
+
+    def __init__(self, status=200, content='{}', delay=0.05):
+        self.status = status
+        self.content = content
+        self.delay = delay
+        self.requests = 0
+
+    def Request(self, method, url, body, headers):
+        self.requests += 1
+        sleep(self.delay)
+        return (self.status, self.content)
+
+
+class FakeResponse(object):
+    '''Stands in for httplib.HTTPResponse, its body read in the given
+    chunks.
+    '''
+
+    def __init__(self, status=200, chunks=('{}',), will_close=False):
+        self.status = status
+        self.will_close = will_close
+        self._chunks = list(chunks)
+
+    def read(self, amt=None):
+        if amt is None:
+            content = "".join(self._chunks)
+            self._chunks = []
+            return content
+        if self._chunks:
+            return self._chunks.pop(0)
+        return ""
+
+
+class FakeConnection(object):
+    '''Stands in for httplib.HTTPSConnection. The connections answer in
+    turn with the responses queued in responses, raising the exceptions
+    among them, after a delay.
+    '''
+    responses = []
+    delay = 0
+    opened = []
+    active = 0
+    peak = 0
+
+    def __init__(self, host, port, timeout=None):
+        self.requests = 0
+        self.closed = False
+        FakeConnection.opened.append(self)
+
+    def request(self, method, url, body, headers):
+        self.requests += 1
+        FakeConnection.active += 1
+        FakeConnection.peak = max(FakeConnection.peak, FakeConnection.active)
+        try:
+            sleep(FakeConnection.delay)
+        finally:
+            FakeConnection.active -= 1
+        self._response = FakeConnection.responses.pop(0)
+        if isinstance(self._response, Exception):
+            raise self._response
+
+    def getresponse(self):
+        return self._response
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnectionTest(SimpleTestCase):
+    '''Makes the connection pools open FakeConnections.'''
+
+    def setUp(self):
+        self._connection = ganeti_client.httplib.HTTPSConnection
+        ganeti_client.httplib.HTTPSConnection = FakeConnection
+        FakeConnection.responses = []
+        FakeConnection.opened = []
+        FakeConnection.peak = 0
+        FakeConnection.delay = 0
+
+    def tearDown(self):
+        ganeti_client.httplib.HTTPSConnection = self._connection
+
+
+class FakeRapiPool(object):
+    '''Stands in for the connection pool of a client, serving requests
+    from a fake RAPI application (see util.fakerapi) in-process.
+    '''
+
+    def __init__(self, app, host):
+        self.app = app
+        self.host = host
+        self.requests = 0
+
+    def Open(self, method, url, body, headers):
+        self.requests += 1
+        path, _, query = url.partition("?")
+        environ = {"HTTP_HOST": self.host, "REQUEST_METHOD": method,
+                   "PATH_INFO": path, "QUERY_STRING": query,
+                   "CONTENT_LENGTH": str(len(body or "")),
+                   "wsgi.input": StringIO(body or "")}
+        status = []
+        chunks = self.app(environ,
+                          lambda line, headers: status.append(line))
+        return (None, FakeResponse(int(status[0].split()[0]), list(chunks)))
+
+    def Release(self, conn, reusable):
+        pass
+
+    def Request(self, method, url, body, headers):
+        conn, resp = self.Open(method, url, body, headers)
+        return (resp.status, resp.read())
+
+
+class RapiConnectionPoolTest(FakeConnectionTest):
+
+    def test_reuses_keep_alive_connections(self):
+        pool = RapiConnectionPool("pool.example.org", 5080)
+        FakeConnection.responses = [FakeResponse() for i in range(3)]
+        for i in range(3):
+            self.assertEqual(pool.Request("GET", "/2/info", None, {}),
+                             (200, "{}"))
+        self.assertEqual(len(FakeConnection.opened), 1)
+        stats = pool.GetStats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["idle"]),
+                         (2, 1, 1))
+
+    def test_closes_connections_the_server_closes(self):
+        pool = RapiConnectionPool("pool.example.org", 5080)
+        FakeConnection.responses = [FakeResponse(will_close=True),
+                                    FakeResponse()]
+        pool.Request("GET", "/2/info", None, {})
+        pool.Request("GET", "/2/info", None, {})
+        first, second = FakeConnection.opened
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+
+    def test_retries_reads_over_stale_connections(self):
+        pool = RapiConnectionPool("pool.example.org", 5080)
+        FakeConnection.responses = [FakeResponse(),
+                                    socket.error("connection reset"),
+                                    FakeResponse(chunks=['"ok"'])]
+        pool.Request("GET", "/2/info", None, {})
+        self.assertEqual(pool.Request("GET", "/2/info", None, {}),
+                         (200, '"ok"'))
+        first, second = FakeConnection.opened
+        self.assertTrue(first.closed)
+        self.assertEqual(pool.GetStats()["idle"], 1)
+
+    def test_does_not_retry_writes(self):
+        pool = RapiConnectionPool("pool.example.org", 5080)
+        FakeConnection.responses = [FakeResponse(),
+                                    socket.error("connection reset")]
+        pool.Request("GET", "/2/info", None, {})
+        self.assertRaises(socket.error, pool.Request, "POST",
+                          "/2/instances", "{}", {})
+        self.assertEqual(len(FakeConnection.opened), 1)
+        self.assertEqual(pool.GetStats()["idle"], 0)
+
+    def test_limits_concurrent_connections(self):
+        pool = RapiConnectionPool("pool.example.org", 5080, size=2)
+        FakeConnection.responses = [FakeResponse() for i in range(6)]
+        FakeConnection.delay = 0.01
+        workers = [spawn(pool.Request, "GET", "/2/info", None, {})
+                   for i in range(6)]
+        joinall(workers, raise_error=True)
+        self.assertEqual(FakeConnection.peak, 2)
+        self.assertEqual(len(FakeConnection.opened), 2)
+
+    def test_clients_of_a_host_share_its_pool(self):
+        client = GanetiRapiClient("shared-pool.example.org")
+        self.assertTrue(client._pool is
+                        GanetiRapiClient("shared-pool.example.org")._pool)
+        self.assertFalse(client._pool is
+                         GanetiRapiClient("shared-pool.example.org",
+                                          port=5081)._pool)
+
+
+class RapiListingTest(SimpleTestCase):
+    host = "listing.example.org"
+
+    def setUp(self):
+        self.rapi = FakeRapi(instances=30)
+        self.instances = self.rapi.get_cluster(self.host).instances
+        self.client = GanetiRapiClient(self.host)
+        self.client._pool = FakeRapiPool(self.rapi, self.host)
+
+    def test_bulk_listing_is_projected(self):
+        infos = self.client.GetInstances(bulk=True, fields=["name", "tags"])
+        self.assertEqual(sorted([i["name"] for i in infos]),
+                         sorted(self.instances))
+        for info in infos:
+            self.assertEqual(sorted(info), ["name", "tags"])
+            self.assertEqual(info["tags"],
+                             self.instances[info["name"]]["tags"])
+
+    def test_streamed_listing_is_projected(self):
+        infos = list(self.client.GetInstances(bulk=True, fields=["name"],
+                                              stream=True))
+        self.assertEqual(sorted(infos),
+                         sorted([{"name": name} for name in self.instances]))
+
+    def test_query_filters_on_the_cluster(self):
+        tags = ["ganetimgr:user:user0000", "ganetimgr:user:user0001"]
+        qfilter = [QFILTER_OR] + [[QFILTER_CONTAINS, "tags", tag]
+                                  for tag in tags]
+        infos = self.client.QueryInstances(["name", "tags", "bogus"],
+                                           qfilter=qfilter)
+        owned = [name for name, info in self.instances.items()
+                 if set(tags).intersection(info["tags"])]
+        self.assertTrue(0 < len(owned) < len(self.instances))
+        self.assertEqual(sorted([i["name"] for i in infos]), sorted(owned))
+        for info in infos:
+            # Fields the cluster cannot answer are None
+            self.assertEqual(info["bogus"], None)
+
+
+class StreamingTest(FakeConnectionTest):
+    listing = [{"name": "vm1", "tags": ["a", "b"], "nic.ips": [None]},
+               {"name": "vm\u00e92", "disk.sizes": [10240, 2048],
+                "oper_ram": 1024.5, "note": "[1, 2] \\\"quoted\\\""},
+               12345, "vm3", [], {}, True, None]
+
+    def setUp(self):
+        FakeConnectionTest.setUp(self)
+        self.client = GanetiRapiClient("stream.example.org")
+        self.client._pool = RapiConnectionPool("stream.example.org", 5080)
+
+    def _stream(self, *chunks):
+        FakeConnection.responses.append(FakeResponse(chunks=chunks))
+        return self.client._StreamRequest("/2/instances", [("bulk", 1)])
+
+    def test_decodes_across_chunk_boundaries(self):
+        body = " \n" + simplejson.dumps(self.listing) + " \n"
+        for i in range(1, len(body)):
+            self.assertEqual(list(self._stream(body[:i], body[i:])),
+                             self.listing, "split at %d" % i)
+        self.assertEqual(list(self._stream(*body)), self.listing)
+        # Every listing was read to its end, over the same connection
+        self.assertEqual(len(FakeConnection.opened), 1)
+
+    def test_stopping_early_closes_the_connection(self):
+        infos = self._stream(simplejson.dumps(self.listing))
+        self.assertEqual(infos.next(), self.listing[0])
+        infos.close()
+        self.assertTrue(FakeConnection.opened[0].closed)
+        self.assertEqual(self.client.GetConnectionPoolStats()["idle"], 0)
+
+    def test_invalid_listings(self):
+        for body in ['{"name": "vm1"}', '[{"name": "vm1"}, {"na', '[1, 2',
+                     '[1, }]']:
+            self.assertRaises(GanetiApiError, list, self._stream(body))
+
+    def test_errors_are_raised_before_streaming(self):
+        FakeConnection.responses.append(FakeResponse(
+            status=404, chunks=['{"code": 404, "message": "Not Found",'
+                                ' "explain": "no such resource"}']))
+        try:
+            self.client._StreamRequest("/2/instances", [])
+        except GanetiApiError, err:
+            self.assertEqual(err.code, 404)
+        else:
+            self.fail("no error raised")
+        self.assertEqual(self.client.GetConnectionPoolStats()["idle"], 1)
+
+
+class FailingPool(object):
+
+    def Request(self, method, url, body, headers):
+        raise socket.error("connection refused")
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def _open(self, breaker):
+        for i in range(breaker.threshold):
+            self.assertEqual(breaker.GetState()["state"], BREAKER_CLOSED)
+            breaker.Failure(breaker.Enter())
+        self.assertEqual(breaker.GetState()["state"], BREAKER_OPEN)
+        self.assertRaises(CircuitOpenError, breaker.Enter)
+        sleep(breaker.cooldown)
+        self.assertEqual(breaker.GetState()["state"], BREAKER_HALF_OPEN)
+
+    def test_successful_probe_closes_it(self):
+        breaker = CircuitBreaker("probe-up", cooldown=0.05)
+        self._open(breaker)
+        probe = breaker.Enter()
+        # A single request probes the endpoint
+        self.assertRaises(CircuitOpenError, breaker.Enter)
+        breaker.Success(probe)
+        self.assertEqual(breaker.GetState(),
+                         {"state": BREAKER_CLOSED, "failures": 0,
+                          "opened": None})
+        breaker.Success(breaker.Enter())
+
+    def test_failed_probe_reopens_it(self):
+        breaker = CircuitBreaker("probe-down", cooldown=0.05)
+        self._open(breaker)
+        breaker.Failure(breaker.Enter())
+        self.assertEqual(breaker.GetState()["state"], BREAKER_OPEN)
+        self.assertRaises(CircuitOpenError, breaker.Enter)
+        sleep(breaker.cooldown)
+        breaker.Success(breaker.Enter())
+        self.assertEqual(breaker.GetState()["state"], BREAKER_CLOSED)
+
+    def test_abandoned_probe_lets_another_one_through(self):
+        breaker = CircuitBreaker("probe-abandoned", cooldown=0.05)
+        self._open(breaker)
+        breaker.Abandon(breaker.Enter())
+        breaker.Success(breaker.Enter())
+        self.assertEqual(breaker.GetState()["state"], BREAKER_CLOSED)
+
+    def test_success_resets_the_failures(self):
+        breaker = CircuitBreaker("flaky", threshold=2)
+        breaker.Failure(breaker.Enter())
+        breaker.Success(breaker.Enter())
+        breaker.Failure(breaker.Enter())
+        self.assertEqual(breaker.GetState()["state"], BREAKER_CLOSED)
+
+    def test_state_is_shared_through_the_store(self):
+        store = _LocalBreakerStore()
+        breaker = CircuitBreaker("shared", store=store, cooldown=0.05)
+        other = CircuitBreaker("shared", store=store, cooldown=0.05)
+        self._open(breaker)
+        self.assertEqual(other.GetState()["state"], BREAKER_HALF_OPEN)
+        probe = breaker.Enter()
+        self.assertRaises(CircuitOpenError, other.Enter)
+        breaker.Success(probe)
+        other.Success(other.Enter())
+
+    def test_connection_failures_open_it(self):
+        client = GanetiRapiClient("breaker-down.example.org")
+        client._pool = FailingPool()
+        for i in range(2):
+            self.assertRaises(GanetiApiError, client.GetInfo)
+        self.assertEqual(client.GetCircuitBreakerState()["state"],
+                         BREAKER_OPEN)
+
+    def test_local_timeouts_do_not_open_it(self):
+        client = GanetiRapiClient("breaker-busy.example.org", pool_size=1)
+        # A slow request holds the only connection of the pool
+        client._pool._slots.acquire()
+        try:
+            for i in range(3):
+                self.assertRaises(Timeout, self._get_info, client, 0.05)
+        finally:
+            client._pool._slots.release()
+        state = client.GetCircuitBreakerState()
+        self.assertEqual(state["state"], BREAKER_CLOSED)
+        self.assertEqual(state["failures"], 0)
+        client._pool = FakePool(content='{"name": "c1"}', delay=0)
+        self.assertEqual(client.GetInfo(), {"name": "c1"})
+
+    def _get_info(self, client, timeout):
+        with Timeout(timeout):
+            return client.GetInfo()
+
+
+class SingleFlightTest(SimpleTestCase):
+
+    def test_coalesces_concurrent_calls(self):
+        flight = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            sleep(0.05)
+            return 42
+        workers = [spawn(flight.Do, "key", fetch) for i in range(3)]
+        joinall(workers, raise_error=True)
+        self.assertEqual([w.value for w in workers], [42, 42, 42])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.coalesced, 2)
+
+    def test_shares_errors(self):
+        flight = SingleFlight()
+
+        def fetch():
+            sleep(0.05)
+            raise ValueError("down")
+
+        def call():
+            try:
+                flight.Do("key", fetch)
+            except ValueError, err:
+                return err
+        workers = [spawn(call) for i in range(2)]
+        joinall(workers, raise_error=True)
+        for worker in workers:
+            self.assertTrue(isinstance(worker.value, ValueError))
+
+    def test_followers_retry_when_the_leader_is_abandoned(self):
+        flight = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            sleep(0.05)
+            return len(calls)
+        leader = spawn(flight.Do, "key", fetch)
+        sleep(0)
+        follower = spawn(flight.Do, "key", fetch)
+        sleep(0.01)
+        leader.kill()
+        self.assertEqual(follower.get(), 2)
+        self.assertEqual(flight._inflight, {})
+
+    def test_coalesced_rapi_reads_are_isolated(self):
+        client = GanetiRapiClient("single-flight.example.org")
+        pool = client._pool = FakePool(
+            content='{"name": "c1", "ctime": 1300000000.5}')
+
+        def get_info():
+            # As Cluster.get_cluster_info does
+            info = client.GetInfo()
+            info['ctime'] = datetime.fromtimestamp(info['ctime'])
+            return info
+        workers = [spawn(get_info) for i in range(2)]
+        joinall(workers, raise_error=True)
+        self.assertEqual(pool.requests, 1)
+        self.assertEqual(workers[0].value, workers[1].value)
+        self.assertFalse(workers[0].value is workers[1].value)
+
+
+class FanOutTest(SimpleTestCase):
+
+    def test_limits_concurrent_calls(self):
+        fanout = FanOut(size=3, per_key=2)
+        active = {}
+        peaks = {}
+
+        def call(item):
+            key = item % 2
+            active[key] = active.get(key, 0) + 1
+            peaks[key] = max(peaks.get(key, 0), active[key])
+            sleep(0.01)
+            active[key] -= 1
+            return item * 10
+        results, failed = fanout.Map(call, range(8), key=lambda i: i % 2)
+        self.assertEqual(results, [i * 10 for i in range(8)])
+        self.assertEqual(failed, [])
+        self.assertEqual(fanout.peak, 3)
+        self.assertEqual(peaks, {0: 2, 1: 2})
+        stats = fanout.GetStats()
+        self.assertEqual((stats["calls"], stats["active"],
+                          stats["active_keys"]), (8, 0, {}))
+        self.assertTrue(stats["waited"])
+
+    def test_returns_the_calls_done_by_the_deadline(self):
+        fanout = FanOut()
+
+        def call(delay):
+            sleep(delay)
+            return delay
+        start = time.time()
+        results, failed = fanout.Map(call, [0.01, 1, 0], timeout=0.1)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual((results, failed), ([0.01, 0], [1]))
+        self.assertEqual(fanout.GetStats()["timeouts"], 1)
+
+    def test_failed_calls_are_left_out(self):
+        fanout = FanOut()
+
+        def call(item):
+            if item == "down":
+                raise GanetiApiError("down", code=502)
+            return item
+        results, failed = fanout.Map(call, ["up", "down", "up"],
+                                     errors=(GanetiApiError,))
+        self.assertEqual((results, failed), (["up", "up"], ["down"]))
+        self.assertEqual(fanout.GetStats()["failed"], 1)
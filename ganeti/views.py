@@ -34,7 +34,6 @@ from ganetimgr.ganeti.forms import *
 from operator import itemgetter
 from django.template.defaultfilters import filesizeformat
 
-from gevent.pool import Pool
 from gevent.timeout import Timeout
 
 from util.ganeti_client import GanetiApiError
@@ -146,26 +145,52 @@ def user_index(request):
 def clear_cache(request):
     if request.user.is_superuser or request.user.has_perm('ganeti.view_instances'):
         username = request.user.username
-        keys_pattern = ["user:%s:index:*" %username , 
-                        "cluster:*",
-                        "pendingapplications", 
-                        "allclusternodes", 
-                        "bad*", 
-                        "len*",
-                        "%s:ajax*" %username,
-                        "locked_instances",
-                        "*list",               
-                        ]
-        for key in keys_pattern:
-            cache_keys = cache.keys(pattern=key)
-            if cache_keys:
-                for cache_key in cache_keys:
-                    if not cache_key.endswith('lock'):
-                        cache.delete(cache_key)
+        cache.delete_family("cluster")
+        cache.delete_family("instances")
+        principals.invalidate()
+        cache_keys = [user_index_cache_key(username),
+                      "user:%s:index:instance:light" % username,
+                      "user:%s:index:users:instance:stats" % username,
+                      "pendingapplications",
+                      "allclusternodes",
+                      "badclusters",
+                      "badnodes",
+                      "leninstances",
+                      "lenusers",
+                      "lengroups",
+                      "leninstapps",
+                      "lenorgs",
+                      "%s:ajaxinstances" %username,
+                      "%s:ajaxapplist" %username,
+                      ]
+        cache_keys.extend(["%s:ajaxvmscluster:%s" %(username, c.slug)
+                           for c in Cluster.objects.all()])
+        cache.delete_many(cache_keys)
         result = {'result': "Success"}
     else:
         result = {'error': "Violation"}
     return HttpResponse(json.dumps(result), mimetype='application/json')
+
+@login_required
+def cache_stats_json(request):
+    if request.user.is_superuser or request.user.has_perm('ganeti.view_instances'):
+        # Cache statistics are shared by all processes, RAPI client
+        # statistics are those of the process serving the request
+        rapi = {}
+        for cluster in Cluster.objects.all():
+            rapi[cluster.slug] = {
+                'pool': cluster._client.GetConnectionPoolStats(),
+                'breaker': cluster._client.GetCircuitBreakerState(),
+            }
+        result = {'cache': getattr(cache, 'get_stats', lambda: None)(),
+                  'rapi': rapi,
+                  'fanout': cluster_fanout.GetStats(),
+                  'instances_flight': {'calls': instances_flight.calls,
+                                       'coalesced': instances_flight.coalesced},
+                  }
+    else:
+        result = {'error': "Violation"}
+    return HttpResponse(json.dumps(result), mimetype='application/json')
     
 @login_required
 def user_index_json(request):
@@ -173,51 +198,44 @@ def user_index_json(request):
     if request.user.is_anonymous():
         action = {'error':_("Permissions' violation. This action has been logged and our admins will be notified about it")}
         return HttpResponse(json.dumps(action), mimetype='application/json')
-    p = Pool(20)
     instances = []
     bad_clusters = []
     bad_instances = []
+    groups = user_group_names(request.user)
     def _get_instances(cluster):
-        t = Timeout(RAPI_TIMEOUT)
-        t.start()
-        try:
-            instances.extend(cluster.get_user_instances(request.user))
-        except (GanetiApiError, Timeout):
-            bad_clusters.append(cluster)
-        finally:
-            t.cancel()
+        return cluster.get_user_instances(request.user, INSTANCE_LISTING_FIELDS,
+                                          groups)
 
+    clusters = Cluster.objects.all()
+    # Before fetching, so that changes meanwhile invalidate the result
+    cache_key = user_index_cache_key(request.user.username, clusters)
     if not request.user.is_anonymous():
-        p.imap(_get_instances, Cluster.objects.all())
-        p.join()
+        results, bad_clusters = map_clusters(_get_instances, clusters)
+        for result in results:
+            instances.extend(result)
     if bad_clusters:
         messages = "Some instances may be missing because the" \
                              " following clusters are unreachable: %s" \
                              %(", ".join([c.description for c in bad_clusters]))
     jresp = {}
-    cache_key = "user:%s:index:instances" %request.user.username
     res = cache.get(cache_key)
     instancedetails = []
-    j = Pool(80)
     user = request.user
-    locked_instances = cache.get('locked_instances')
+    locks = {}
     def _get_instance_details(instance):
-        t = Timeout(RAPI_TIMEOUT)
-        t.start()
         try:
-            if locked_instances is not None and locked_instances.has_key('%s'%instance.name):
-                instance.joblock = locked_instances['%s'%instance.name]
-            else:
-                instance.joblock = False
+            instance.joblock = locks.get(instance.cluster.slug,
+                                         {}).get(instance.name, False)
             instancedetails.extend(generate_json(instance, user))
-        except (Exception, Timeout):
+        except Exception:
             bad_instances.append(instance)
-        finally:
-            t.cancel()
 
     if res is None:
-        j.imap(_get_instance_details, instances)
-        j.join()
+        for cluster in clusters:
+            locks[cluster.slug] = cluster.get_locked_instances()
+        # Building the JSON makes no RAPI calls, no need for greenlets
+        for instance in instances:
+            _get_instance_details(instance)
         
         if bad_instances:
             bad_inst_text = "Could not get details for " + str(len(bad_instances)) + " instances.<br>" \
@@ -240,23 +258,18 @@ def user_sum_stats(request):
     if request.user.is_anonymous():
         action = {'error':_("Permissions' violation. This action has been logged and our admins will be notified about it")}
         return HttpResponse(json.dumps(action), mimetype='application/json')
-    p = Pool(20)
     instances = []
     bad_clusters = []
+    groups = user_group_names(request.user)
 
     def _get_instances(cluster):
-        t = Timeout(RAPI_TIMEOUT)
-        t.start()
-        try:
-            instances.extend(cluster.get_user_instances(request.user))
-        except (GanetiApiError, Timeout):
-            bad_clusters.append(cluster)
-        finally:
-            t.cancel()
+        return cluster.get_user_instances(request.user, INSTANCE_STATS_FIELDS,
+                                          groups)
 
     if not request.user.is_anonymous():
-        p.imap(_get_instances, Cluster.objects.all())
-        p.join()
+        results, bad_clusters = map_clusters(_get_instances)
+        for result in results:
+            instances.extend(result)
 
     if bad_clusters:
         messages.add_message(request, messages.WARNING,
@@ -267,21 +280,16 @@ def user_sum_stats(request):
     cache_key = "user:%s:index:instance:light" %request.user.username
     res = cache.get(cache_key)
     instancedetails = []
-    j = Pool(80)
     user = request.user
     def _get_instance_details(instance):
-        t = Timeout(RAPI_TIMEOUT)
-        t.start()
         try:
             instancedetails.extend(generate_json_light(instance, user))
-        except (Exception, Timeout):
+        except Exception:
             pass
-        finally:
-            t.cancel()
     
     if res is None:
-        j.imap(_get_instance_details, instances)
-        j.join()
+        for instance in instances:
+            _get_instance_details(instance)
         jresp['aaData'] = instancedetails
         cache.set(cache_key, jresp, 125)
         res = jresp
@@ -470,7 +478,7 @@ def shutdown(request, cluster_slug, instance):
     cluster = get_object_or_404(Cluster, slug=cluster_slug)
     cluster.shutdown_instance(instance)
     action = {'action': _("Please wait... shutting-down")}
-    clear_cluster_user_cache(request.user.username, cluster_slug)
+    clear_cluster_user_cache(request.user.username, cluster)
     return HttpResponse(json.dumps(action))
 
 @login_required
@@ -623,7 +631,7 @@ def startup(request, cluster_slug, instance):
     cluster = get_object_or_404(Cluster, slug=cluster_slug)
     cluster.startup_instance(instance)
     action = {'action': _("Please wait... starting-up")}
-    clear_cluster_user_cache(request.user.username, cluster_slug)
+    clear_cluster_user_cache(request.user.username, cluster)
     return HttpResponse(json.dumps(action))
 
 @login_required
@@ -634,7 +642,7 @@ def reboot(request, cluster_slug, instance):
     cluster = get_object_or_404(Cluster, slug=cluster_slug)
     cluster.reboot_instance(instance)
     action = {'action': _("Please wait... rebooting")}
-    clear_cluster_user_cache(request.user.username, cluster_slug)
+    clear_cluster_user_cache(request.user.username, cluster)
     return HttpResponse(json.dumps(action))
 
 @csrf_exempt
@@ -956,9 +964,11 @@ def tagInstance(request, instance):
 @login_required
 def get_clusternodes(request):
     if (request.user.is_superuser or request.user.has_perm('ganeti.view_instances')):
-        nodes = cache.get('allclusternodes')
-        bad_clusters = cache.get('badclusters')
-        bad_nodes = cache.get('badnodes')
+        cached = cache.get_many(['allclusternodes', 'badclusters',
+                                 'badnodes'])
+        nodes = cached.get('allclusternodes')
+        bad_clusters = cached.get('badclusters')
+        bad_nodes = cached.get('badnodes')
         if nodes is None:
             nodes, bad_clusters, bad_nodes = prepare_clusternodes()
             cache.set('allclusternodes', nodes, 90)
@@ -999,26 +1009,20 @@ def get_clusternodes(request):
 
 def prepare_clusternodes():
     clusters = Cluster.objects.all()
-    p = Pool(20)
     nodes = []
-    bad_clusters = []
     bad_nodes = []
     servermon_url = None
     def _get_nodes(cluster):
-        t = Timeout(RAPI_TIMEOUT)
-        t.start()
-        try:
-            nodes.extend(cluster.get_node_info(node) for node in cluster.get_cluster_nodes())
-            bad_nodes.extend(cluster.get_node_info(node)['name'] for node in cluster.get_cluster_nodes() if cluster.get_node_info(node)['offline'] == True)
-        except (GanetiApiError, Timeout):
-            # Maybe we should look if this is the proper way of doing this
-            cluster._client = None
-            bad_clusters.append(cluster)
-        finally:
-            t.cancel()
-    
-    p.imap(_get_nodes, clusters)
-    p.join()
+        cnodes = [cluster.get_node_info(node) for node in cluster.get_cluster_nodes()]
+        return cnodes, [n['name'] for n in cnodes if n['offline'] == True]
+
+    results, bad_clusters = map_clusters(_get_nodes, clusters)
+    for cnodes, cbad_nodes in results:
+        nodes.extend(cnodes)
+        bad_nodes.extend(cbad_nodes)
+    for cluster in bad_clusters:
+        # Maybe we should look if this is the proper way of doing this
+        cluster._client = None
     return nodes, bad_clusters, bad_nodes
             
         
@@ -1041,40 +1045,35 @@ def stats(request):
     if (request.user.is_superuser or request.user.has_perm('ganeti.view_instances')):
         instances = cache.get('leninstances')
         if instances is None:
-            p = Pool(20)
-            instances = []
-            bad_clusters = []
+            instances = 0
+            groups = user_group_names(request.user)
 
             def _get_instances(cluster):
-                t = Timeout(RAPI_TIMEOUT)
-                t.start()
-                try:
-                    instances.extend(cluster.get_user_instances(request.user))
-                except (GanetiApiError, Timeout):
-                    exclude_pks.append(cluster.pk)
-                finally:
-                    t.cancel()
+                return cluster.get_user_instances(request.user,
+                                                  INSTANCE_STATS_FIELDS, groups)
             if not request.user.is_anonymous():
-                p.imap(_get_instances, clusters)
-                p.join()
-            instances = len(instances)
+                results, bad_clusters = map_clusters(_get_instances, clusters)
+                instances = sum([len(result) for result in results])
+                exclude_pks.extend([cluster.pk for cluster in bad_clusters])
             cache.set('leninstances', instances, 90)
-        users = cache.get('lenusers')
+        cached = cache.get_many(['lenusers', 'lengroups', 'leninstapps',
+                                 'lenorgs'])
+        missing = {}
+        users = cached.get('lenusers')
         if users is None:
-            users = len(User.objects.all())
-            cache.set('lenusers', users, 90)
-        groups = cache.get('lengroups')
+            users = missing['lenusers'] = len(User.objects.all())
+        groups = cached.get('lengroups')
         if groups is None:
-            groups = len(Group.objects.all())
-            cache.set('lengroups', groups, 90)
-        instance_apps = cache.get('leninstapps')
+            groups = missing['lengroups'] = len(Group.objects.all())
+        instance_apps = cached.get('leninstapps')
         if instance_apps is None:
-            instance_apps = len(InstanceApplication.objects.all())
-            cache.set('leninstapps', instance_apps, 90)
-        orgs = cache.get('lenorgs')
+            instance_apps = missing['leninstapps'] = \
+                len(InstanceApplication.objects.all())
+        orgs = cached.get('lenorgs')
         if orgs is None:
-            orgs = len(Organization.objects.all())
-            cache.set('lenorgs', orgs, 90)
+            orgs = missing['lenorgs'] = len(Organization.objects.all())
+        if missing:
+            cache.set_many(missing, 90)
         if exclude_pks:
             clusters = clusters.exclude(pk__in=exclude_pks)
         return render_to_response('statistics.html', {
@@ -1100,6 +1099,7 @@ def stats_ajax_instances(request):
         ret = []
         i = 0
         cluster_list = []
+        groups = user_group_names(request.user)
         for cluster in clusters:
             cinstances = []
             i = 0
@@ -1110,7 +1110,7 @@ def stats_ajax_instances(request):
                 cluster_dict['name'] = cluster.description
             cluster_dict['instances'] = []
             try:
-                cinstances.extend(cluster.get_user_instances(request.user))
+                cinstances.extend(cluster.get_user_instances(request.user, INSTANCE_STATS_FIELDS, groups))
             except (GanetiApiError, Timeout):
                 cinstances = []
             for instance in cinstances:
@@ -1140,7 +1140,7 @@ def stats_ajax_vms_per_cluster(request, cluster_slug):
         cluster_dict['instances'] = {'up':0,'down':0}
         cinstances = []
         try:
-            cinstances.extend(cluster.get_user_instances(request.user))
+            cinstances.extend(cluster.get_user_instances(request.user, INSTANCE_STATS_FIELDS))
         except (GanetiApiError, Timeout):
             return HttpResponse(json.dumps([]), mimetype='application/json')
         for instance in cinstances:
@@ -1241,17 +1241,22 @@ def idle_accounts(request):
                                   context_instance=RequestContext(request))
 
 
-def clear_cluster_user_cache(username, cluster_slug):
-    cache.delete("user:%s:index:instances" %username)
-    cache.delete("cluster:%s:instances" % cluster_slug)
+def user_index_cache_key(username, clusters=None):
+    if clusters is None:
+        clusters = Cluster.objects.all()
+    return "user:%s:index:instances:%s" %(username,
+                                          clusters_generation(clusters))
+
+
+def clear_cluster_user_cache(username, cluster):
+    cache.delete(user_index_cache_key(username))
+    cluster.clear_instances_cache()
 
 
 def refresh_cluster_cache(cluster, instance):
     cluster.force_cluster_cache_refresh(instance)
-    for u in User.objects.all():
-        cache.delete("user:%s:index:instances" %u.username)
+    cluster.bump_generation()
     nodes , bc, bn = prepare_clusternodes()
-    cache.set('allclusternodes', nodes, 90)
-    cache.set('badclusters', bc, 90)
-    cache.set('badnodes', bn, 90)
+    cache.set_many({'allclusternodes': nodes, 'badclusters': bc,
+                    'badnodes': bn}, 90)
 
@@ -30,13 +30,6 @@ from django.contrib import messages
 import json
 from django.core.mail.message import EmailMessage
 
-from gevent.pool import Pool
-from gevent.timeout import Timeout
-
-from util.ganeti_client import GanetiApiError
-
-RAPI_TIMEOUT = settings.RAPI_TIMEOUT
-
 @csrf_exempt
 @login_required
 def notify(request, instance=None):
@@ -105,7 +98,7 @@ def get_mails(itemlist):
             mails.extend([u.email for u in users])
         if i.startswith('c'):
             cluster = Cluster.objects.get(pk=i.replace('c_',''))
-            instances = cluster.get_instances()
+            instances = cluster.get_instances(INSTANCE_STATS_FIELDS)
             for instance in instances:
                 mails.extend([u.email for u in instance.users])
     return list(set(mails))
@@ -123,21 +116,15 @@ def get_user_group_list(request):
         groups = Group.objects.all()
         instances = []
         clusters = Cluster.objects.all()
-        p = Pool(20)
-        bad_clusters = []
+        groups = user_group_names(request.user)
 
         def _get_instances(cluster):
-            t = Timeout(RAPI_TIMEOUT)
-            t.start()
-            try:
-                instances.extend(cluster.get_user_instances(request.user))
-            except (GanetiApiError, Timeout):
-                bad_clusters.append(cluster)
-            finally:
-                t.cancel()
+            return cluster.get_user_instances(request.user,
+                                              INSTANCE_STATS_FIELDS, groups)
         if not request.user.is_anonymous():
-            p.imap(_get_instances, Cluster.objects.all())
-            p.join()
+            results, bad_clusters = map_clusters(_get_instances)
+            for result in results:
+                instances.extend(result)
         if q_params:
             users = users.filter(username__icontains=q_params)
             groups = groups.filter(name__icontains=q_params)
@@ -13,67 +13,341 @@ __license__ = 'BSD'
 __version__ = 0.1
 __updated__ = '2010-05-16 15:55:34 nik'
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
+import os
 import redis
-import zlib
+import time
+import atexit
 import logging
+import threading
+from fnmatch import fnmatchcase
+from collections import OrderedDict
 from django.core.cache.backends.base import BaseCache
 from django.utils.encoding import smart_unicode, smart_str
 
+from redis_cache.codecs import Codec, DEFAULT_SERIALIZER, \
+    DEFAULT_COMPRESSOR, DEFAULT_COMPRESS_LEVEL, DEFAULT_COMPRESS_MIN
+
+# Keys kept in the in-process cache by default, when it is enabled
+DEFAULT_L1_KEYS = "cluster:*:instances*"
+DEFAULT_L1_TTL = 10
+
+# Key families, by key pattern; the first matching pattern wins. The keys of
+# each family are indexed in a Redis sorted set, scored by their expiry, so
+# that a whole family can be deleted (see CacheClass.delete_family) without
+# scanning the keyspace. Expired keys are pruned from it on every write.
+KEY_FAMILIES = (
+    ("locks", "cluster:*:lock*"),
+    ("instances", "cluster:*:instances*"),
+    ("cluster", "cluster:*"),
+    ("user-index", "user:*:index:*"),
+    ("ajax", "*:ajax*"),
+)
+FAMILY_INDEX_TTL = 86400
+
+# Families whose values are plain data (decoded RAPI responses), which are
+# encoded with the configured serializer instead of pickle
+DEFAULT_PLAIN_FAMILIES = "instances,cluster"
+
+
+def key_family(key):
+    """Returns the family of a key, or None."""
+    for family, pattern in KEY_FAMILIES:
+        if fnmatchcase(key, pattern):
+            return family
+    return None
+
+
+def family_index_key(family):
+    return "cache:families:%s" % family
+
+
+# Statistics are grouped by these families first, then by KEY_FAMILIES.
+# More can be given in the stats_families backend parameter.
+DEFAULT_STATS_FAMILIES = "nodes=allclusternodes,health=bad*,counters=len*," \
+                         "applications=pendingapplications"
+STATS_FLUSH_INTERVAL = 10
+STATS_FAMILIES_KEY = "cache:stats:families"
+# Round trips and their latency are recorded under this family
+REDIS_STATS_FAMILY = "redis"
+
+
+def stats_key(family):
+    return "cache:stats:%s" % family
+
+
+class CacheStats(object):
+    """Counts cache hits, misses, bytes and (de)serialization time by key
+    family.
+
+    Counters are kept in process and added to a Redis hash per family
+    (see ``stats_key``) every ``STATS_FLUSH_INTERVAL`` seconds, so that the
+    totals of all processes can be read with ``read``.
+    """
+
+    def __init__(self, redis_client, families):
+        self._redis = redis_client
+        self.families = families
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._flushed = time.time()
+        atexit.register(self.flush)
+
+    def family(self, key):
+        for family, pattern in self.families:
+            if fnmatchcase(key, pattern):
+                return family
+        return key_family(key) or "other"
+
+    def record(self, family, **counts):
+        with self._lock:
+            counters = self._counters.setdefault(family, {})
+            for name, count in counts.items():
+                counters[name] = counters.get(name, 0) + count
+            due = time.time() - self._flushed > STATS_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            self._flushed = time.time()
+        if not counters:
+            return
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.sadd(STATS_FAMILIES_KEY, *counters.keys())
+            for family, counts in counters.items():
+                for name, count in counts.items():
+                    if isinstance(count, float):
+                        pipe.hincrbyfloat(stats_key(family), name, count)
+                    else:
+                        pipe.hincrby(stats_key(family), name, count)
+            pipe.execute()
+        except redis.RedisError, e:
+            logging.warning("Unable to save cache statistics: %s", str(e))
+
+    def read(self):
+        """Returns the counters of all processes, by family, along with
+        the hit ratio and average value sizes.
+        """
+        self.flush()
+        families = sorted(self._redis.smembers(STATS_FAMILIES_KEY))
+        pipe = self._redis.pipeline(transaction=False)
+        for family in families:
+            pipe.hgetall(stats_key(family))
+        result = {}
+        for family, counts in zip(families, pipe.execute()):
+            counts = dict((name, float(count)
+                           if name.endswith("_time") else int(count))
+                          for name, count in counts.items())
+            hits = counts.get("hits", 0)
+            lookups = hits + counts.get("misses", 0)
+            if lookups:
+                counts["hit_ratio"] = float(hits) / lookups
+            remote_hits = hits - counts.get("local_hits", 0)
+            if remote_hits and family != REDIS_STATS_FAMILY:
+                counts["avg_bytes_read"] = \
+                    counts.get("bytes_read", 0) / remote_hits
+            if counts.get("writes") and family != REDIS_STATS_FAMILY:
+                counts["avg_bytes_written"] = \
+                    counts.get("bytes_written", 0) / counts["writes"]
+            result[family] = counts
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+        families = self._redis.smembers(STATS_FAMILIES_KEY)
+        self._redis.delete(STATS_FAMILIES_KEY,
+                           *[stats_key(f) for f in families])
+
+
+class LocalCache(object):
+    """Bounded in-process LRU cache of unpacked values.
+
+    Values are shared between all callers and must not be modified. Entries
+    expire after ``ttl`` seconds, and are evicted on every invalidation
+    message other processes publish on Redis when they change a key, see
+    ``CacheClass``. Nothing is cached while the subscription is down.
+    """
+
+    def __init__(self, redis_client, channel, size, ttl, patterns):
+        self._redis = redis_client
+        self.channel = channel
+        self.size = size
+        self.ttl = ttl
+        self.patterns = patterns
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._listener = None
+        self._listening = False
+        self._pid = None
+
+    def handles(self, key):
+        for pattern in self.patterns:
+            if fnmatchcase(key, pattern):
+                return True
+        return False
+
+    def _ensure_listener(self):
+        # A forked worker does not inherit the listening thread
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._listening = False
+            self.clear()
+            self._listener = threading.Thread(target=self._listen)
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self._listening = True
+                    elif message['type'] == 'message':
+                        if message['data']:
+                            self.evict(message['data'].split('\n'))
+                        else:
+                            self.clear()
+            except redis.RedisError, e:
+                logging.warning("Cache invalidation channel lost: %s",
+                                str(e))
+            # Invalidations may have been missed
+            self._listening = False
+            self.clear()
+            time.sleep(1)
+
+    def generation(self):
+        """Returns a token to pass to ``put`` after fetching a value."""
+        self._ensure_listener()
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+            # Mark as most recently used
+            self._entries[key] = entry
+            return entry[1]
+
+    def put(self, key, value, generation):
+        """Caches a value, unless keys were invalidated since generation."""
+        if not self._listening:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def evict(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def publish(self, keys=None):
+        """Evicts keys here and tells the other processes to do the same.
+
+        Without keys, the whole cache is cleared everywhere.
+        """
+        if keys is None:
+            self.clear()
+            keys = []
+        else:
+            keys = [k for k in keys if self.handles(k)]
+            if not keys:
+                return
+            self.evict(keys)
+        try:
+            self._redis.publish(self.channel, "\n".join(keys))
+        except redis.RedisError, e:
+            logging.warning("Unable to publish cache invalidation: %s",
+                            str(e))
+
 
 class CacheClass(BaseCache):
 
     def __init__(self, server, params):
-        "Connect to Redis, and set up cache backend."
+        """Connect to Redis, and set up cache backend.
+
+        An in-process cache in front of Redis is enabled by setting
+        ``l1_size`` (max entries) in the backend parameters. ``l1_ttl``
+        limits the age of its entries and ``l1_keys`` lists the key patterns
+        it holds, e.g.::
+
+            redis_cache.cache://127.0.0.1:6379/?db=8&l1_size=32&l1_ttl=10
+
+        Values of the ``plain_families`` key families are serialized with
+        ``serializer`` (marshal, msgpack or pickle), the rest with pickle.
+        Values longer than ``compress_min`` bytes are compressed with
+        ``compressor`` (zlib or lz4) at ``compress_level``.
+
+        Setting ``stats=1`` records statistics by key family, see
+        ``get_stats``. ``stats_families`` adds comma separated
+        ``name=pattern`` families to group them by.
+        """
         BaseCache.__init__(self, params)
         if 'db' in params:
             db = int(params['db'])
         else:
             db = 1
         self._cache = redis.Redis(server.split(':')[0], db=db)
-        self._headers = {'zlib': '!zlib!',
-                         'pickle': '!pickle!'}
+        self._codec = Codec(
+            params.get('serializer', DEFAULT_SERIALIZER),
+            params.get('compressor', DEFAULT_COMPRESSOR),
+            int(params.get('compress_level', DEFAULT_COMPRESS_LEVEL)),
+            int(params.get('compress_min', DEFAULT_COMPRESS_MIN)))
+        self._plain_families = \
+            params.get('plain_families', DEFAULT_PLAIN_FAMILIES).split(',')
+        self._stats = None
+        if int(params.get('stats', 0)):
+            families = "%s,%s" % (params.get('stats_families', ''),
+                                  DEFAULT_STATS_FAMILIES)
+            self._stats = CacheStats(
+                self._cache, [f.split('=', 1) for f in families.split(',')
+                              if '=' in f])
+        self._local = None
+        if int(params.get('l1_size', 0)):
+            self._local = LocalCache(
+                self._cache, "ganetimgr:l1:invalidate:%d" % db,
+                int(params['l1_size']),
+                int(params.get('l1_ttl', DEFAULT_L1_TTL)),
+                params.get('l1_keys', DEFAULT_L1_KEYS).split(','))
 
     def _prepare_key(self, raw_key):
         "``smart_str``-encode the key."
         return smart_str(raw_key)
 
-    def _check_header(self, header, value):
-        """Check whether this value has this header"""
-        header_marker = self._headers.get(header)
-        if header_marker and \
-               isinstance(value, str) and \
-               value[:len(header_marker)] == header_marker:
-            value = value[len(header_marker):]
-            if header == 'zlib':
-                value = zlib.decompress(value)
-            if header == 'pickle':
-                value = pickle.loads(value)
-        return value
-
-    def _pack_value(self, value):
-        """Pack value, use pickle and/or zlib if necessary"""
-        if isinstance(value, str):
-            pass
-        elif isinstance(value, unicode):
-            value = value.encode('utf-8')
-        #elif isinstance(value, int) or isinstance(value, float):
-        #    value = str(value)
-        else:
-            value = self._headers['pickle'] + pickle.dumps(value)
-        # zlib.compress if value is long enough
-        if len(value) > 1000:
-            value = self._headers['zlib'] + zlib.compress(value)
+    def _pack_value(self, value, key=None):
+        """Pack value, see redis_cache.codecs"""
+        plain = key is not None and key_family(key) in self._plain_families
+        if self._stats is None or key is None:
+            return self._codec.encode(value, plain)
+        start = time.time()
+        value = self._codec.encode(value, plain)
+        self._stats.record(self._stats.family(key), writes=1,
+                           bytes_written=len(value),
+                           encode_time=time.time() - start)
         return value
 
     def _unpack_value(self, value):
-        """unpack value, use pickle and/or zlib if necessary"""
-        value = self._check_header('zlib', value)
-        value = self._check_header('pickle', value)
+        """Unpack value, see redis_cache.codecs"""
+        value = self._codec.decode(value)
         if isinstance(value, basestring):
             return smart_unicode(value)
         else:
@@ -83,52 +357,275 @@ class CacheClass(BaseCache):
         """Add a value to the cache, failing if the key already exists.
         Returns ``True`` if the object was added, ``False`` if not.
         """
-        if self._cache.exists(key):
+        key = self._prepare_key(key)
+        expire = None
+        if timeout != -1:
+            expire = timeout or self.default_timeout
+        try:
+            # SET NX makes sure only one client ever adds the key, and sets
+            # its expiry along with it, so that a lease is never left behind
+            if not self._cache.set(key, self._pack_value(value, key),
+                                   nx=True, ex=expire):
+                return False
+        except redis.RedisError, e:
+            logging.warning("Unable to add key to cache: %s", str(e))
             return False
-        return self.set(key, value, timeout)
+        try:
+            pipe = self._cache.pipeline(transaction=False)
+            self._index_keys(pipe, [key], expire or -1)
+            pipe.execute()
+        except redis.RedisError, e:
+            # The key is added all the same
+            logging.warning("Unable to index key: %s", str(e))
+        return True
 
     def set(self, key, value, timeout=None):
         "Persist a value to the cache, and set an optional expiration time."
+        return self.set_many({key: value}, timeout)
 
-        key = self._prepare_key(key)
+    def set_many(self, data, timeout=None):
+        """Persist several values to the cache in a single round trip.
 
+        Every value is stored together with its expiration time, in one
+        transaction.
+        """
+        keys = [self._prepare_key(k) for k in data]
         try:
-            # store the key/value pair
-            result = self._cache.set(key, self._pack_value(value))
-            # set content expiration, if necessary
-            if timeout != -1:
-                self._cache.expire(key, timeout or self.default_timeout)
+            pipe = self._cache.pipeline(transaction=True)
+            for key, value in zip(keys, data.values()):
+                # store the key/value pair
+                pipe.set(key, self._pack_value(value, key))
+                # set content expiration, if necessary
+                if timeout != -1:
+                    pipe.expire(key, timeout or self.default_timeout)
+            self._index_keys(pipe, keys, timeout)
+            start = time.time()
+            results = pipe.execute()
+            if self._stats is not None:
+                self._stats.record(REDIS_STATS_FAMILY, writes=1,
+                                   write_time=time.time() - start)
+            step = timeout != -1 and 2 or 1
+            result = all(results[:len(keys) * step:step])
         except redis.RedisError, e:
-            logging.warning("Unable to write key to cache: %s", str(e))
+            logging.warning("Unable to write keys to cache: %s", str(e))
             result = None
 
+        if self._local is not None:
+            self._local.publish(keys)
         return result
 
-    def get(self, key, default=None, version=None):
-        """Retrieve a value from the cache.
-        Returns unpicked value if key is found, ``None`` if not.
+    def _index_keys(self, pipe, keys, timeout=None):
+        """Queues adding keys, expiring after ``timeout`` seconds, to the
+        index of their family and pruning the expired ones from it."""
+        families = {}
+        for key in keys:
+            family = key_family(key)
+            if family is not None:
+                families.setdefault(family, []).append(key)
+        if not families:
+            return
+        now = time.time()
+        if timeout == -1:
+            expires = float('inf')
+        else:
+            expires = now + (timeout or self.default_timeout)
+        for family, members in families.items():
+            index = family_index_key(family)
+            pipe.zadd(index, **dict((key, expires) for key in members))
+            pipe.zremrangebyscore(index, '-inf', now)
+            pipe.expire(index, FAMILY_INDEX_TTL)
+
+    def delete_family(self, family):
+        """Remove all the keys of a family (see KEY_FAMILIES)."""
+        index = family_index_key(family)
+        # Detach the index first, so that keys added meanwhile are kept
+        detached = "%s:deleting:%s" % (index, os.urandom(8).encode('hex'))
+        try:
+            self._cache.rename(index, detached)
+        except redis.ResponseError:
+            # No such index, nothing to delete
+            return
+        except redis.RedisError, e:
+            logging.warning("Unable to delete key family: %s", str(e))
+            return
+        try:
+            keys = self._cache.zrange(detached, 0, -1)
+        except redis.RedisError, e:
+            logging.warning("Unable to delete key family: %s", str(e))
+            keys = []
+        self.delete_many(keys + [detached])
+
+    def hset(self, key, field, value, timeout=None):
+        """Set a field of a hash to a string, expiring after ``timeout``
+        seconds. The hash itself expires with the default timeout, or the
+        field's if longer, after the last change.
+        """
+        return self.hset_many(key, {field: value}, timeout)
+
+    def hset_many(self, key, mapping, timeout=None):
+        """Set several fields of a hash at once, see hset.
         """
+        if not mapping:
+            return True
         key = self._prepare_key(key)
+        timeout = timeout or self.default_timeout
+        expiry = int(time.time() + timeout)
+        fields = dict((self._prepare_key(field),
+                       "%d:%s" % (expiry, smart_str(value)))
+                      for field, value in mapping.iteritems())
+        try:
+            pipe = self._cache.pipeline(transaction=True)
+            pipe.hmset(key, fields)
+            pipe.expire(key, max(timeout, self.default_timeout))
+            pipe.execute()
+        except redis.RedisError, e:
+            logging.warning("Unable to write hash field: %s", str(e))
+            return False
+        return True
 
+    def hget(self, key, field):
+        """Retrieve a field of a hash, ``None`` if missing or expired."""
         try:
-            # get the value from the cache
-            value = self._cache.get(key)
+            value = self._cache.hget(self._prepare_key(key),
+                                     self._prepare_key(field))
         except redis.RedisError, e:
-            logging.warning("Unable to connect to cache: %s", str(e))
-            value = None
+            logging.warning("Unable to read hash field: %s", str(e))
+            return None
+        if value is None:
+            return None
+        expires, value = value.split(":", 1)
+        if int(expires) < time.time():
+            return None
+        return smart_unicode(value)
+
+    def hgetall(self, key):
+        """Retrieve the fields of a hash that have not expired, as a dict.
+        Expired fields are left to go away with the hash, removing them here
+        could race with a new value.
+        """
+        key = self._prepare_key(key)
+        try:
+            fields = self._cache.hgetall(key)
+        except redis.RedisError, e:
+            logging.warning("Unable to read hash: %s", str(e))
+            return {}
+        result = {}
+        now = time.time()
+        for field, value in fields.items():
+            expires, value = value.split(":", 1)
+            if int(expires) >= now:
+                result[smart_unicode(field)] = smart_unicode(value)
+        return result
+
+    def hdel(self, key, *fields):
+        "Remove fields from a hash."
+        if not fields:
+            return
+        try:
+            self._cache.hdel(self._prepare_key(key),
+                             *[self._prepare_key(f) for f in fields])
+        except redis.RedisError, e:
+            logging.warning("Unable to delete hash fields: %s", str(e))
+
+    def incr(self, key, delta=1, version=None):
+        """Atomically increment a counter, starting from 0 if missing.
+        Returns the new value, or ``None`` if the cache is unreachable.
+        """
+        key = self._prepare_key(key)
+        try:
+            value = self._cache.incr(key, delta)
+        except redis.RedisError, e:
+            logging.warning("Unable to increment key: %s", str(e))
+            return None
+        if self._local is not None:
+            self._local.publish([key])
+        return value
 
+    def get(self, key, default=None, version=None):
+        """Retrieve a value from the cache.
+        Returns unpicked value if key is found, ``None`` if not.
+        """
+        value = self.get_many([key]).get(key)
         if value is None:
             return default
         else:
-            return self._unpack_value(value)
+            return value
+
+    def get_many(self, keys, version=None):
+        """Retrieve several values from the cache in a single round trip.
+        Returns a dict of the keys found and their unpickled values.
+        """
+        result = {}
+        missing = []
+        local = self._local
+        generation = None
+        if local is not None:
+            generation = local.generation()
+        for key in keys:
+            value = None
+            if local is not None and local.handles(self._prepare_key(key)):
+                value = local.get(self._prepare_key(key))
+            if value is None:
+                missing.append(key)
+            else:
+                result[key] = value
+                if self._stats is not None:
+                    self._stats.record(
+                        self._stats.family(self._prepare_key(key)),
+                        hits=1, local_hits=1)
+        if not missing:
+            return result
+
+        stats = self._stats
+        start = time.time()
+        try:
+            values = self._cache.mget([self._prepare_key(k) for k in missing])
+        except redis.RedisError, e:
+            logging.warning("Unable to connect to cache: %s", str(e))
+            return result
+        if stats is not None:
+            stats.record(REDIS_STATS_FAMILY, reads=1,
+                         read_time=time.time() - start)
+
+        for key, value in zip(missing, values):
+            if value is None:
+                if stats is not None:
+                    stats.record(stats.family(self._prepare_key(key)),
+                                 misses=1)
+            else:
+                start = time.time()
+                try:
+                    result[key] = self._unpack_value(value)
+                except Exception, e:
+                    # e.g. written with a compressor missing here
+                    logging.warning("Unable to decode cache key %s: %s",
+                                    key, str(e))
+                    continue
+                if stats is not None:
+                    stats.record(stats.family(self._prepare_key(key)),
+                                 hits=1, bytes_read=len(value),
+                                 decode_time=time.time() - start)
+                if local is not None and \
+                        local.handles(self._prepare_key(key)):
+                    local.put(self._prepare_key(key), result[key],
+                              generation)
+        return result
 
     def delete(self, key):
         "Remove a key from the cache."
-        key = self._prepare_key(key)
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        "Remove several keys from the cache in a single round trip."
+        keys = [self._prepare_key(k) for k in keys]
+        if not keys:
+            return
         try:
-            self._cache.delete(key)
+            self._cache.delete(*keys)
         except redis.RedisError, e:
-            logging.warning("Unable to delete key: %s", str(e))
+            logging.warning("Unable to delete keys: %s", str(e))
+        if self._local is not None:
+            self._local.publish(keys)
     
     def keys(self, pattern="*"):
         "Fetch all keys from the cache."
@@ -149,6 +646,24 @@ class CacheClass(BaseCache):
             self._cache.flush(all_dbs)
         except redis.RedisError, e:
             logging.warning("Unable to flush cache: %s", str(e))
+        if self._local is not None:
+            self._local.publish()
+
+    def get_stats(self):
+        """Returns the statistics of all processes, by key family, or
+        ``None`` if they are not enabled.
+        """
+        if self._stats is None:
+            return None
+        try:
+            return self._stats.read()
+        except redis.RedisError, e:
+            logging.warning("Unable to read cache statistics: %s", str(e))
+            return {}
+
+    def reset_stats(self):
+        if self._stats is not None:
+            self._stats.reset()
 
     def close(self, **kwargs):
         "Disconnect from the cache."
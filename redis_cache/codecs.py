@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Serialization and compression of cache values.
+
+Every value written by the Redis cache backend is prefixed with a header
+naming the serializer and the compressor it was encoded with, e.g.
+``!v1:marshal:zlib!``, so that the backend can be reconfigured, and values
+written by other versions decoded, without flushing the cache. Plain strings
+are stored as they are, unless they are compressed or look like a header.
+"""
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import zlib
+import marshal
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+HEADER_VERSION = "v1"
+LEGACY_HEADERS = {'zlib': '!zlib!',
+                  'pickle': '!pickle!'}
+
+DEFAULT_SERIALIZER = "marshal"
+DEFAULT_COMPRESSOR = "zlib"
+DEFAULT_COMPRESS_LEVEL = 1
+DEFAULT_COMPRESS_MIN = 1000
+
+
+def _marshal_dumps(value):
+    # Version 2 is the newest format Python 2 understands
+    return marshal.dumps(value, 2)
+
+
+def _pickle_dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _msgpack_dumps(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+# name: (dumps, loads). Serializers other than pickle only handle plain,
+# JSON-like data, and raise ValueError or TypeError on anything else.
+SERIALIZERS = {
+    "pickle": (_pickle_dumps, pickle.loads),
+    "marshal": (_marshal_dumps, marshal.loads),
+}
+if msgpack is not None:
+    SERIALIZERS["msgpack"] = (_msgpack_dumps, _msgpack_loads)
+
+# name: (compress(data, level), decompress)
+COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress),
+}
+if lz4 is not None:
+    COMPRESSORS["lz4"] = (lambda data, level: lz4.block.compress(data),
+                          lz4.block.decompress)
+
+
+class Codec(object):
+    """Encodes cache values to strings and back.
+
+    ``serializer`` is used for the values that are known to be plain data
+    (see ``encode``), pickle for everything else. Encoded values longer than
+    ``compress_min`` bytes are compressed with ``compressor`` at
+    ``compress_level`` (zlib only).
+    """
+
+    def __init__(self, serializer=DEFAULT_SERIALIZER,
+                 compressor=DEFAULT_COMPRESSOR,
+                 compress_level=DEFAULT_COMPRESS_LEVEL,
+                 compress_min=DEFAULT_COMPRESS_MIN):
+        if serializer not in SERIALIZERS:
+            raise ValueError("Unknown or unavailable cache serializer: %s" %
+                             serializer)
+        if compressor not in COMPRESSORS:
+            raise ValueError("Unknown or unavailable cache compressor: %s" %
+                             compressor)
+        self.serializer = serializer
+        self.compressor = compressor
+        self.compress_level = compress_level
+        self.compress_min = compress_min
+        self._headers = {}
+
+    def _header(self, serializer, compressor):
+        header = self._headers.get((serializer, compressor))
+        if header is None:
+            header = "!%s:%s:%s!" % (HEADER_VERSION, serializer,
+                                     compressor or "")
+            self._headers[(serializer, compressor)] = header
+        return header
+
+    def encode(self, value, plain=False):
+        """Encodes a value. Set ``plain`` when the value holds nothing but
+        builtin types, such as decoded RAPI responses, to use the configured
+        serializer instead of pickle.
+        """
+        if isinstance(value, str):
+            serializer = "raw"
+            data = value
+        elif isinstance(value, unicode):
+            serializer = "raw"
+            data = value.encode('utf-8')
+        else:
+            serializer = "pickle"
+            data = None
+            if plain and self.serializer != "pickle":
+                try:
+                    data = SERIALIZERS[self.serializer][0](value)
+                    serializer = self.serializer
+                except (ValueError, TypeError):
+                    pass
+            if data is None:
+                data = _pickle_dumps(value)
+        if len(data) > self.compress_min:
+            compress = COMPRESSORS[self.compressor][0]
+            return self._header(serializer, self.compressor) + \
+                compress(data, self.compress_level)
+        if serializer == "raw" and not data.startswith("!"):
+            return data
+        return self._header(serializer, None) + data
+
+    def decode(self, value):
+        """Decodes a value encoded by any version of the backend. Strings
+        are returned as they were stored.
+        """
+        if not isinstance(value, str) or not value.startswith("!"):
+            return value
+        if value.startswith("!%s:" % HEADER_VERSION):
+            end = value.find("!", len(HEADER_VERSION) + 2)
+            if end == -1:
+                return value
+            try:
+                serializer, compressor = \
+                    value[len(HEADER_VERSION) + 2:end].split(":")
+            except ValueError:
+                return value
+            data = value[end + 1:]
+            if compressor:
+                data = COMPRESSORS[compressor][1](data)
+            if serializer == "raw":
+                return data
+            return SERIALIZERS[serializer][1](data)
+        if value.startswith(LEGACY_HEADERS['zlib']):
+            value = zlib.decompress(value[len(LEGACY_HEADERS['zlib']):])
+        if value.startswith(LEGACY_HEADERS['pickle']):
+            value = pickle.loads(value[len(LEGACY_HEADERS['pickle']):])
+        return value
@@ -19,33 +19,22 @@ from django.template.context import RequestContext
 from django.contrib.auth.decorators import user_passes_test
 from django.http import HttpResponseRedirect
 
-from ganetimgr.ganeti.models import Cluster
-from gevent.pool import Pool
-from gevent.timeout import Timeout
-from django.conf import settings
-from util.ganeti_client import GanetiApiError
-
-RAPI_TIMEOUT = settings.RAPI_TIMEOUT
+from ganetimgr.ganeti.models import INSTANCE_LISTING_FIELDS, map_clusters, \
+    user_group_names
 
 def instance_owners(request):
     if request.user.is_superuser or request.user.has_perm('ganeti.view_instances'):
-        p = Pool(20)
         instancesall = []
-        bad_clusters = []
+        groups = user_group_names(request.user)
 
         def _get_instances(cluster):
-            t = Timeout(RAPI_TIMEOUT)
-            t.start()
-            try:
-                instancesall.extend(cluster.get_user_instances(request.user))
-            except (GanetiApiError, Timeout):
-                bad_clusters.append(cluster)
-            finally:
-                t.cancel()
+            return cluster.get_user_instances(request.user,
+                                              INSTANCE_LISTING_FIELDS, groups)
 
         if not request.user.is_anonymous():
-            p.imap(_get_instances, Cluster.objects.all())
-            p.join()
+            results, bad_clusters = map_clusters(_get_instances)
+            for result in results:
+                instancesall.extend(result)
         instances = [i for i in instancesall if i.users]
         def cmp_users(x, y):
             return cmp(",".join([ u.username for u in x.users]),
@@ -0,0 +1,681 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+#
+
+# Copyright (c) 2014 GRNET SA
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Fake Ganeti RAPI server, for load testing without real clusters.
+
+Serves the RAPI resources used by L{util.ganeti_client.GanetiRapiClient}
+from synthetic fleets kept in memory. Every hostname the server is reached
+as (taken from the Host header) is a separate cluster, generated on first
+use from its name, so any number of clusters can be emulated by a single
+server, e.g. by registering clusters 127.0.0.1 ... 127.0.0.20 and binding
+to 0.0.0.0.
+
+Run it as a process::
+
+    python util/fakerapi.py --port 5080 --instances 10000 \\
+        --latency 0.5 --certfile cert.pem --keyfile key.pem
+
+or start it in-process::
+
+    server = start_fake_rapi(port=0, instances=500, certfile=..., keyfile=...)
+    cluster = server.application.get_cluster("127.0.0.1")
+    cluster.latency = 5  # a slow master
+    ...
+    server.stop()
+
+The RAPI client only speaks HTTPS and verifies certificates, so it has to
+trust the certificate served (e.g. through SSL_CERT_FILE).
+
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import re
+import sys
+import time
+import random
+import urlparse
+
+from gevent import sleep
+from gevent.pywsgi import WSGIServer
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+DEFAULT_INSTANCES = 1000
+DEFAULT_NODES = 20
+DEFAULT_USERS = 500
+DEFAULT_GROUPS = 50
+DEFAULT_ORGS = 20
+DEFAULT_TAG_PREFIX = "ganetimgr"
+DEFAULT_JOB_DURATION = 3
+
+# Bulk listings are sent in chunks of this many items
+LISTING_CHUNK = 500
+
+JOB_WAIT_TIMEOUT = 10
+
+HTTP_STATUS = {
+    200: "200 OK",
+    400: "400 Bad Request",
+    404: "404 Not Found",
+    405: "405 Method Not Allowed",
+    500: "500 Internal Server Error",
+    502: "502 Bad Gateway",
+}
+
+
+class RapiError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def _pick_owner(rng, count, skew):
+    """Picks an index in [0, count) following a power law.
+
+    With skew 0 all owners are equally likely, the higher the skew the more
+    instances go to the first few owners, like on real clusters.
+    """
+    return min(int(count * rng.random() ** (1 + skew)), count - 1)
+
+
+def generate_instances(cluster, count=DEFAULT_INSTANCES, nodes=None,
+                       users=DEFAULT_USERS, groups=DEFAULT_GROUPS,
+                       orgs=DEFAULT_ORGS, group_ratio=0.3, org_ratio=0.5,
+                       skew=1.2, links=("br0",),
+                       tag_prefix=DEFAULT_TAG_PREFIX, seed=None):
+    """Generates the instances of a synthetic cluster.
+
+    Every instance is owned by one user, picked so that a few users own
+    most instances, and possibly by a group and an organization.
+
+    @type cluster: str
+    @param cluster: the cluster name, used in instance names
+    @type count: int
+    @param count: the number of instances
+    @type nodes: list of str
+    @param nodes: the node names to spread the instances on
+    @param seed: seed for the generator, the cluster name by default
+
+    @rtype: list of dict
+    @return: the instances, as returned by a bulk /2/instances
+    """
+    rng = random.Random(cluster if seed is None else seed)
+    nodes = nodes or ["node1.%s" % cluster]
+    short = cluster.replace(".", "-")
+    now = int(time.time())
+    net = rng.randint(0, 255)
+    instances = []
+    for i in range(count):
+        tags = ["%s:user:user%04d" % (tag_prefix,
+                                      _pick_owner(rng, users, skew))]
+        if groups and rng.random() < group_ratio:
+            tags.append("%s:group:group%03d" %
+                        (tag_prefix, _pick_owner(rng, groups, skew)))
+        if orgs and rng.random() < org_ratio:
+            tags.append("%s:org:org%02d" % (tag_prefix, rng.randrange(orgs)))
+        if rng.random() < 0.1:
+            tags.append("%s:service:web" % tag_prefix)
+        up = rng.random() < 0.9
+        memory = rng.choice([512, 1024, 2048, 4096, 8192])
+        vcpus = rng.choice([1, 1, 2, 2, 4, 8])
+        ctime = now - rng.randint(86400, 86400 * 1000)
+        instances.append({
+            "name": "%s-vm%05d.example.org" % (short, i),
+            "uuid": "%08x-0000-4000-8000-%012x" % (net, i),
+            "tags": tags,
+            "admin_state": up and "up" or "down",
+            "oper_state": up,
+            "status": up and "running" or "ADMIN_down",
+            "ctime": ctime,
+            "mtime": rng.randint(ctime, now),
+            "serial_no": rng.randint(1, 50),
+            "os": "debootstrap+default",
+            "hypervisor": "kvm",
+            "disk_template": "plain",
+            "pnode": nodes[i % len(nodes)],
+            "snodes": [],
+            "network_port": 11000 + i,
+            "nic.links": [rng.choice(links)],
+            "nic.modes": ["routed"],
+            "nic.ips": ["10.%d.%d.%d" % (net, i / 250, i % 250 + 1)],
+            "nic.macs": ["aa:00:%02x:%02x:%02x:%02x" %
+                         (net, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)],
+            "nic.bridges": [None],
+            "disk.sizes": [rng.choice([5120, 10240, 20480, 40960])],
+            "oper_ram": up and memory or None,
+            "oper_vcpus": up and vcpus or None,
+            "beparams": {"memory": memory, "maxmem": memory,
+                         "minmem": memory, "vcpus": vcpus,
+                         "auto_balance": True, "always_failover": False},
+            "hvparams": {"boot_order": "disk", "cdrom_image_path": "",
+                         "kernel_path": "", "vnc_bind_address": "0.0.0.0",
+                         "nic_type": "paravirtual",
+                         "disk_type": "paravirtual"},
+        })
+    return instances
+
+
+def generate_nodes(cluster, count=DEFAULT_NODES):
+    """Generates the nodes of a synthetic cluster, the first one the master.
+    """
+    nodes = []
+    for i in range(count):
+        nodes.append({
+            "name": "node%d.%s" % (i + 1, cluster),
+            "role": i == 0 and "M" or (i < 3 and "C" or "R"),
+            "offline": False,
+            "drained": False,
+            "master_candidate": i < 3,
+            "mtotal": 262144,
+            "mfree": 65536,
+            "dtotal": 4194304,
+            "dfree": 1048576,
+            "ctotal": 32,
+            "pinst_cnt": 0,
+            "sinst_cnt": 0,
+            "pinst_list": [],
+            "sinst_list": [],
+            "tags": [],
+        })
+    return nodes
+
+
+def _eval_filter(qfilter, info):
+    """Evaluates a query filter (Ganeti 2.6 syntax) against an instance."""
+    if not qfilter:
+        return True
+    op = qfilter[0]
+    if op == "|":
+        return any(_eval_filter(f, info) for f in qfilter[1:])
+    if op == "&":
+        return all(_eval_filter(f, info) for f in qfilter[1:])
+    if op == "!":
+        return not _eval_filter(qfilter[1], info)
+    field, value = qfilter[1], qfilter[2]
+    if op == "=[]":
+        return value in (info.get(field) or [])
+    if op in ("=", "=="):
+        return info.get(field) == value
+    if op == "!=":
+        return info.get(field) != value
+    if op == "=~":
+        return re.search(value, info.get(field) or "") is not None
+    raise RapiError(400, "Unknown filter operator '%s'" % op)
+
+
+class FakeCluster(object):
+    """A synthetic Ganeti cluster.
+
+    latency (plus up to jitter) seconds are spent before answering each
+    request and a fraction error_rate of the requests fail with HTTP 502.
+    All three can be changed while the server is running.
+    """
+    def __init__(self, name, instances=DEFAULT_INSTANCES,
+                 nodes=DEFAULT_NODES, latency=0, jitter=0, error_rate=0,
+                 job_duration=DEFAULT_JOB_DURATION, **fleet):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.job_duration = job_duration
+        self.nodes = generate_nodes(name, nodes)
+        self.instances = {}
+        for info in generate_instances(name, instances,
+                                       [n["name"] for n in self.nodes],
+                                       **fleet):
+            self.instances[info["name"]] = info
+        for node in self.nodes:
+            node["pinst_list"] = [i["name"] for i in self.instances.values()
+                                  if i["pnode"] == node["name"]]
+            node["pinst_cnt"] = len(node["pinst_list"])
+        self.tags = []
+        self.jobs = {}
+        self.ctime = int(time.time())
+        self._rng = random.Random(name)
+
+    def info(self):
+        return {
+            "name": self.name,
+            "master": self.nodes[0]["name"],
+            "architecture": ["64bit", "x86_64"],
+            "default_hypervisor": "kvm",
+            "enabled_hypervisors": ["kvm"],
+            "software_version": "2.10.0",
+            "protocol_version": 2100000,
+            "ctime": self.ctime,
+            "mtime": self.ctime,
+            "tags": self.tags,
+        }
+
+    def delay(self):
+        sleep(self.latency + self._rng.uniform(0, self.jitter))
+        if self.error_rate and self._rng.random() < self.error_rate:
+            raise RapiError(502, "Injected failure")
+
+    def instance(self, name):
+        try:
+            return self.instances[name]
+        except KeyError:
+            raise RapiError(404, "Instance '%s' not known" % name)
+
+    def node(self, name):
+        for node in self.nodes:
+            if node["name"] == name:
+                return node
+        raise RapiError(404, "Node '%s' not known" % name)
+
+    def submit(self, summary):
+        """Records a job and returns its id."""
+        job_id = len(self.jobs) + 1
+        self.jobs[job_id] = {"id": job_id, "summary": [summary],
+                             "received_ts": time.time()}
+        return job_id
+
+    def job(self, job_id):
+        try:
+            job = self.jobs[int(job_id)]
+        except (KeyError, ValueError):
+            raise RapiError(404, "Job '%s' not found" % job_id)
+        received = job["received_ts"]
+        done = time.time() - received >= self.job_duration
+        status = done and "success" or "running"
+        end_ts = done and [int(received + self.job_duration), 0] or None
+        return {
+            "id": job["id"],
+            "status": status,
+            "summary": job["summary"],
+            "ops": [],
+            "opstatus": [status],
+            "opresult": [None],
+            "oplog": [[]],
+            "received_ts": [int(received), 0],
+            "start_ts": [int(received), 0],
+            "end_ts": end_ts,
+        }
+
+
+def _select(info, fields):
+    if not fields:
+        return info
+    return dict((f, info.get(f)) for f in fields)
+
+
+def _listing(items, bulk, fields, resource):
+    """Returns a (possibly bulk) listing as chunks of JSON."""
+    if not bulk:
+        items = [{"id": i["name"], "uri": "/2/%s/%s" % (resource, i["name"])}
+                 for i in items]
+    else:
+        items = [_select(i, fields) for i in items]
+    yield "["
+    for start in range(0, len(items), LISTING_CHUNK):
+        if start:
+            yield ", "
+        yield ", ".join(json.dumps(i) for i in
+                        items[start:start + LISTING_CHUNK])
+    yield "]"
+
+
+class FakeRapi(object):
+    """WSGI application serving the fake clusters.
+
+    Clusters not created explicitly through add_cluster are generated on
+    first use with the keyword arguments given here, see L{FakeCluster}.
+    """
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self.clusters = {}
+        self._routes = []
+        for method, pattern, handler in [
+            ("GET", r"/version", self.get_version),
+            ("GET", r"/2/features", self.get_features),
+            ("GET", r"/2/info", self.get_info),
+            ("GET", r"/2/tags", self.get_cluster_tags),
+            ("PUT", r"/2/tags", self.add_cluster_tags),
+            ("DELETE", r"/2/tags", self.delete_cluster_tags),
+            ("GET", r"/2/instances", self.get_instances),
+            ("POST", r"/2/instances", self.create_instance),
+            ("PUT", r"/2/query/(instance|node|job)", self.query),
+            ("GET", r"/2/instances/([^/]+)", self.get_instance),
+            ("DELETE", r"/2/instances/([^/]+)", self.delete_instance),
+            ("GET", r"/2/instances/([^/]+)/info", self.get_instance_info),
+            ("GET", r"/2/instances/([^/]+)/tags", self.get_instance_tags),
+            ("PUT", r"/2/instances/([^/]+)/tags", self.add_instance_tags),
+            ("DELETE", r"/2/instances/([^/]+)/tags",
+             self.delete_instance_tags),
+            ("GET", r"/2/instances/([^/]+)/console", self.get_console),
+            ("PUT", r"/2/instances/([^/]+)/shutdown", self.shutdown),
+            ("PUT", r"/2/instances/([^/]+)/startup", self.startup),
+            ("PUT", r"/2/instances/([^/]+)/rename", self.rename),
+            ("POST", r"/2/instances/([^/]+)/([a-z-]+)", self.instance_job),
+            ("PUT", r"/2/instances/([^/]+)/([a-z-]+)", self.instance_job),
+            ("GET", r"/2/nodes", self.get_nodes),
+            ("GET", r"/2/nodes/([^/]+)", self.get_node),
+            ("GET", r"/2/nodes/([^/]+)/role", self.get_node_role),
+            ("GET", r"/2/jobs/(\d+)", self.get_job),
+            ("GET", r"/2/jobs/(\d+)/wait", self.wait_job),
+            ("DELETE", r"/2/jobs/(\d+)", self.get_job),
+        ]:
+            self._routes.append((method, re.compile("^%s$" % pattern),
+                                 handler))
+
+    def add_cluster(self, name, **kwargs):
+        options = dict(self.defaults)
+        options.update(kwargs)
+        self.clusters[name] = FakeCluster(name, **options)
+        return self.clusters[name]
+
+    def get_cluster(self, name):
+        if name not in self.clusters:
+            self.add_cluster(name)
+        return self.clusters[name]
+
+    def __call__(self, environ, start_response):
+        host = environ.get("HTTP_HOST") or environ["SERVER_NAME"]
+        # Strip the port, minding IPv6 addresses
+        host = re.sub(r":\d+$", "", host).strip("[]")
+        method = environ["REQUEST_METHOD"]
+        path = environ["PATH_INFO"].rstrip("/") or "/"
+        query = urlparse.parse_qs(environ.get("QUERY_STRING", ""))
+        body = None
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        if length:
+            body = json.loads(environ["wsgi.input"].read(length))
+
+        try:
+            cluster = self.get_cluster(host)
+            cluster.delay()
+            handler, args = self._route(method, path)
+            result = handler(cluster, query, body, *args)
+            code = 200
+        except RapiError, err:
+            code = err.code
+            result = {"code": err.code, "message": HTTP_STATUS[code][4:],
+                      "explain": str(err)}
+        except ValueError, err:
+            code = 400
+            result = {"code": code, "message": "Bad Request",
+                      "explain": str(err)}
+
+        start_response(HTTP_STATUS[code],
+                       [("Content-Type", "application/json")])
+        if isinstance(result, dict) or not hasattr(result, "next"):
+            return [json.dumps(result)]
+        return result
+
+    def _route(self, method, path):
+        allowed = False
+        for rmethod, regex, handler in self._routes:
+            match = regex.match(path)
+            if match is None:
+                continue
+            if rmethod == method:
+                return handler, match.groups()
+            allowed = True
+        if allowed:
+            raise RapiError(405, "Method %s not supported" % method)
+        raise RapiError(404, "Resource %s not found" % path)
+
+    # Cluster
+
+    def get_version(self, cluster, query, body):
+        return 2
+
+    def get_features(self, cluster, query, body):
+        return ["instance-create-reqv1", "instance-reinstall-reqv1"]
+
+    def get_info(self, cluster, query, body):
+        return cluster.info()
+
+    def get_cluster_tags(self, cluster, query, body):
+        return cluster.tags
+
+    def add_cluster_tags(self, cluster, query, body):
+        cluster.tags.extend(query.get("tag", []))
+        return cluster.submit("TAGS_SET")
+
+    def delete_cluster_tags(self, cluster, query, body):
+        for tag in query.get("tag", []):
+            if tag in cluster.tags:
+                cluster.tags.remove(tag)
+        return cluster.submit("TAGS_DEL")
+
+    # Instances
+
+    def get_instances(self, cluster, query, body):
+        fields = query.get("fields", [""])[0].split(",")
+        return _listing(cluster.instances.values(), query.get("bulk"),
+                        [f for f in fields if f], "instances")
+
+    def query(self, cluster, query, body, what):
+        body = body or {}
+        fields = body.get("fields") or ["name"]
+        qfilter = body.get("qfilter", body.get("filter"))
+        if what == "instance":
+            items = cluster.instances.values()
+        elif what == "job":
+            items = [cluster.job(job_id) for job_id in sorted(cluster.jobs)]
+        else:
+            items = cluster.nodes
+        data = []
+        for info in items:
+            if _eval_filter(qfilter, info):
+                # 1 is RS_UNKNOWN, for fields the fake does not know about
+                data.append([f in info and [0, info[f]] or [1, None]
+                             for f in fields])
+        return {"fields": [{"name": f, "title": f, "kind": "other",
+                            "doc": f} for f in fields],
+                "data": data}
+
+    def create_instance(self, cluster, query, body):
+        body = body or {}
+        name = body.get("instance_name") or body.get("name")
+        if not name:
+            raise RapiError(400, "Missing instance name")
+        if name in cluster.instances:
+            raise RapiError(400, "Instance '%s' already exists" % name)
+        info = generate_instances(cluster.name, 1,
+                                  [n["name"] for n in cluster.nodes],
+                                  seed=name)[0]
+        info.update({"name": name, "tags": body.get("tags", []),
+                     "ctime": int(time.time()), "mtime": int(time.time())})
+        cluster.instances[name] = info
+        return cluster.submit("INSTANCE_CREATE(%s)" % name)
+
+    def get_instance(self, cluster, query, body, name):
+        return cluster.instance(name)
+
+    def delete_instance(self, cluster, query, body, name):
+        cluster.instance(name)
+        del cluster.instances[name]
+        return cluster.submit("INSTANCE_REMOVE(%s)" % name)
+
+    def get_instance_info(self, cluster, query, body, name):
+        cluster.instance(name)
+        return cluster.submit("INSTANCE_QUERY_DATA(%s)" % name)
+
+    def get_instance_tags(self, cluster, query, body, name):
+        return cluster.instance(name)["tags"]
+
+    def add_instance_tags(self, cluster, query, body, name):
+        tags = cluster.instance(name)["tags"]
+        tags.extend(t for t in query.get("tag", []) if t not in tags)
+        return cluster.submit("TAGS_SET(%s)" % name)
+
+    def delete_instance_tags(self, cluster, query, body, name):
+        tags = cluster.instance(name)["tags"]
+        for tag in query.get("tag", []):
+            if tag in tags:
+                tags.remove(tag)
+        return cluster.submit("TAGS_DEL(%s)" % name)
+
+    def get_console(self, cluster, query, body, name):
+        info = cluster.instance(name)
+        return {"instance": name, "kind": "vnc", "host": info["pnode"],
+                "port": info["network_port"], "display": 0}
+
+    def _set_state(self, cluster, name, up):
+        info = cluster.instance(name)
+        info["admin_state"] = up and "up" or "down"
+        info["oper_state"] = up
+        info["status"] = up and "running" or "ADMIN_down"
+        info["oper_ram"] = up and info["beparams"]["memory"] or None
+        info["mtime"] = int(time.time())
+
+    def shutdown(self, cluster, query, body, name):
+        self._set_state(cluster, name, False)
+        return cluster.submit("INSTANCE_SHUTDOWN(%s)" % name)
+
+    def startup(self, cluster, query, body, name):
+        self._set_state(cluster, name, True)
+        return cluster.submit("INSTANCE_STARTUP(%s)" % name)
+
+    def rename(self, cluster, query, body, name):
+        new_name = (body or {}).get("new_name")
+        if not new_name:
+            raise RapiError(400, "Missing new_name")
+        info = cluster.instances.pop(cluster.instance(name)["name"])
+        info["name"] = new_name
+        cluster.instances[new_name] = info
+        return cluster.submit("INSTANCE_RENAME(%s)" % name)
+
+    def instance_job(self, cluster, query, body, name, action):
+        cluster.instance(name)
+        return cluster.submit("INSTANCE_%s(%s)" %
+                              (action.upper().replace("-", "_"), name))
+
+    # Nodes
+
+    def get_nodes(self, cluster, query, body):
+        return _listing(cluster.nodes, query.get("bulk"), None, "nodes")
+
+    def get_node(self, cluster, query, body, name):
+        return cluster.node(name)
+
+    def get_node_role(self, cluster, query, body, name):
+        return {"M": "master", "C": "master-candidate", "R": "regular",
+                "D": "drained", "O": "offline"}[cluster.node(name)["role"]]
+
+    # Jobs
+
+    def get_job(self, cluster, query, body, job_id):
+        return cluster.job(job_id)
+
+    def wait_job(self, cluster, query, body, job_id):
+        body = body or {}
+        fields = body.get("fields") or ["status"]
+        deadline = time.time() + JOB_WAIT_TIMEOUT
+        while True:
+            job = cluster.job(job_id)
+            job_info = [job.get(f) for f in fields]
+            if (job_info != body.get("previous_job_info") or
+                    job["end_ts"] or time.time() > deadline):
+                return {"job_info": job_info, "log_entries": []}
+            sleep(0.1)
+
+
+def start_fake_rapi(address="127.0.0.1", port=0, certfile=None,
+                    keyfile=None, **defaults):
+    """Starts a fake RAPI server in the background and returns it.
+
+    The port actually used is server.server_port, the application (to
+    reach the clusters) server.application.
+    """
+    ssl_args = {}
+    if certfile:
+        ssl_args = {"certfile": certfile, "keyfile": keyfile}
+    server = WSGIServer((address, port), FakeRapi(**defaults), log=None,
+                        **ssl_args)
+    server.start()
+    return server
+
+
+def parse_arguments(args):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-b", "--bind", dest="address", default="127.0.0.1",
+                      help="Address to listen on (default: 127.0.0.1)")
+    parser.add_option("-p", "--port", dest="port", type="int", default=5080,
+                      help="Port to listen on (default: 5080)")
+    parser.add_option("--certfile", dest="certfile", metavar="FILE",
+                      help="Serve HTTPS with this certificate")
+    parser.add_option("--keyfile", dest="keyfile", metavar="FILE",
+                      help="The private key of the certificate")
+    parser.add_option("-i", "--instances", dest="instances", type="int",
+                      default=DEFAULT_INSTANCES,
+                      help="Instances per cluster (default: %d)" %
+                           DEFAULT_INSTANCES)
+    parser.add_option("-n", "--nodes", dest="nodes", type="int",
+                      default=DEFAULT_NODES,
+                      help="Nodes per cluster (default: %d)" % DEFAULT_NODES)
+    parser.add_option("--users", dest="users", type="int",
+                      default=DEFAULT_USERS,
+                      help="Distinct owners (default: %d)" % DEFAULT_USERS)
+    parser.add_option("--groups", dest="groups", type="int",
+                      default=DEFAULT_GROUPS,
+                      help="Distinct owner groups (default: %d)" %
+                           DEFAULT_GROUPS)
+    parser.add_option("--group-ratio", dest="group_ratio", type="float",
+                      default=0.3,
+                      help="Fraction of instances owned by a group")
+    parser.add_option("--skew", dest="skew", type="float", default=1.2,
+                      help="How unevenly instances are spread among owners,"
+                           " 0 is uniform (default: 1.2)")
+    parser.add_option("--tag-prefix", dest="tag_prefix",
+                      default=DEFAULT_TAG_PREFIX,
+                      help="GANETI_TAG_PREFIX of the ownership tags")
+    parser.add_option("-l", "--latency", dest="latency", type="float",
+                      default=0, help="Seconds to wait before answering")
+    parser.add_option("-j", "--jitter", dest="jitter", type="float",
+                      default=0, help="Random extra latency, up to seconds")
+    parser.add_option("-e", "--error-rate", dest="error_rate", type="float",
+                      default=0, help="Fraction of requests failing")
+    parser.add_option("--job-duration", dest="job_duration", type="float",
+                      default=DEFAULT_JOB_DURATION,
+                      help="Seconds every job runs (default: %d)" %
+                           DEFAULT_JOB_DURATION)
+    return parser.parse_args(args)
+
+
+def main():
+    opts, args = parse_arguments(sys.argv[1:])
+    server = start_fake_rapi(opts.address, opts.port,
+                             certfile=opts.certfile, keyfile=opts.keyfile,
+                             instances=opts.instances, nodes=opts.nodes,
+                             users=opts.users, groups=opts.groups,
+                             group_ratio=opts.group_ratio, skew=opts.skew,
+                             tag_prefix=opts.tag_prefix,
+                             latency=opts.latency, jitter=opts.jitter,
+                             error_rate=opts.error_rate,
+                             job_duration=opts.job_duration)
+    sys.stderr.write("Fake RAPI listening on %s:%d\n" %
+                     (opts.address, server.server_port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
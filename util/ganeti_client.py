@@ -29,11 +29,19 @@
 from gevent import monkey
 monkey.patch_all()
 
+import base64
+import httplib
 import logging
 import simplejson
 import socket
+import threading
+import time
 import urllib
-import urllib2
+import Queue
+
+from gevent import spawn, joinall
+from gevent.event import AsyncResult
+from gevent.timeout import Timeout
 
 GANETI_RAPI_PORT = 5080
 GANETI_RAPI_VERSION = 2
@@ -46,6 +54,24 @@ HTTP_OK = 200
 HTTP_NOT_FOUND = 404
 HTTP_APP_JSON = "application/json"
 
+# Maximum number of concurrent connections kept towards a single RAPI endpoint
+DEFAULT_POOL_SIZE = 10
+
+# Bytes read from the socket at a time when streaming a response
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of concurrent fan-out calls per process, and per key (e.g.
+# per cluster), see FanOut
+DEFAULT_FANOUT_SIZE = 50
+DEFAULT_FANOUT_PER_KEY = DEFAULT_POOL_SIZE
+
+# Circuit breaker states and defaults
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half-open"
+DEFAULT_BREAKER_THRESHOLD = 2
+DEFAULT_BREAKER_COOLDOWN = 30
+
 REPLACE_DISK_PRI = "replace_on_primary"
 REPLACE_DISK_SECONDARY = "replace_on_secondary"
 REPLACE_DISK_CHG = "replace_new_secondary"
@@ -57,6 +83,12 @@ NODE_ROLE_MASTER = "master"
 NODE_ROLE_OFFLINE = "offline"
 NODE_ROLE_REGULAR = "regular"
 
+# Query filter operators and result status, see Ganeti's qlang and query2
+QFILTER_OR = "|"
+QFILTER_EQUAL = "="
+QFILTER_CONTAINS = "=[]"
+QRS_NORMAL = 0
+
 # Internal constants
 _REQ_DATA_VERSION_FIELD = "__version__"
 _INST_CREATE_REQV1 = "instance-create-reqv1"
@@ -93,20 +125,525 @@ class GanetiApiError(Error):
     self.code = code
 
 
-class GanetiRapiRequest(urllib2.Request):
-  def __init__(self, url, data=None, headers={},
-               origin_req_host=None, unverifiable=False, method=None):
-     headers["Accept"] = HTTP_APP_JSON
-     headers["Content-type"] = HTTP_APP_JSON
+class CircuitOpenError(GanetiApiError):
+  """Raised instead of contacting a RAPI endpoint known to be unreachable.
+
+  """
+  pass
+
+
+class RapiConnectionPool(object):
+  """Pool of persistent HTTP/1.1 connections to a single RAPI endpoint.
+
+  Idle connections are handed out most-recently-used first, so that the
+  socket most likely to still be alive is reused. At most C{size}
+  connections are open at any time; further callers block until one is
+  released. The pool relies on the threading primitives monkey-patched by
+  gevent and is therefore safe to share between greenlets.
+
+  """
+  def __init__(self, host, port, size=DEFAULT_POOL_SIZE,
+               timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    """Initializes this class.
+
+    @type host: string
+    @param host: the RAPI host to connect to
+    @type port: int
+    @param port: the RAPI port to connect to
+    @type size: int
+    @param size: maximum number of connections to keep open
+    @param timeout: socket timeout for new connections
+
+    """
+    self.host = host
+    self.port = port
+    self.size = size
+    self._timeout = timeout
+    self._idle = Queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(size)
+    self.hits = 0
+    self.misses = 0
+
+  def _Acquire(self):
+    """Returns a connection and whether it was reused from the pool.
+
+    """
+    self._slots.acquire()
+    try:
+      conn = self._idle.get_nowait()
+    except Queue.Empty:
+      self.misses += 1
+      return (httplib.HTTPSConnection(self.host, self.port,
+                                      timeout=self._timeout), False)
+    self.hits += 1
+    return (conn, True)
+
+  def Release(self, conn, reusable):
+    """Returns a connection to the pool, or closes it if not reusable.
+
+    """
+    if reusable:
+      self._idle.put(conn)
+    else:
+      conn.close()
+    self._slots.release()
+
+  def Open(self, method, url, body, headers):
+    """Sends a request over a pooled connection, leaving the body unread.
+
+    A reused keep-alive connection may have been closed by the server in the
+    meantime. In that case the request is retried over another connection,
+    provided it is a GET or the server never sent a status line.
+
+    The caller must hand the connection back through L{Release} once the
+    response has been consumed.
+
+    @rtype: tuple of (httplib.HTTPConnection, httplib.HTTPResponse)
+    @return: the connection used and its response
+
+    """
+    while True:
+      conn, reused = self._Acquire()
+      try:
+        conn.request(method, url, body, headers)
+        resp = conn.getresponse()
+      except (socket.error, httplib.HTTPException), err:
+        self.Release(conn, False)
+        if reused and (method == HTTP_GET or
+                       isinstance(err, httplib.BadStatusLine)):
+          continue
+        raise
+      except:
+        self.Release(conn, False)
+        raise
+      return (conn, resp)
+
+  def Request(self, method, url, body, headers):
+    """Performs a request over a pooled connection.
+
+    @rtype: tuple of (int, str)
+    @return: HTTP status code and response body
+
+    """
+    conn, resp = self.Open(method, url, body, headers)
+    reusable = False
+    try:
+      content = resp.read()
+      reusable = not resp.will_close
+    finally:
+      self.Release(conn, reusable)
+    return (resp.status, content)
+
+  def GetStats(self):
+    """Returns usage statistics for this pool.
+
+    @rtype: dict
+    @return: pool size, idle connections, reuse hits/misses and hit rate
+
+    """
+    total = self.hits + self.misses
+    if total:
+      hit_rate = float(self.hits) / total
+    else:
+      hit_rate = 0.0
+    return {
+      "host": self.host,
+      "port": self.port,
+      "size": self.size,
+      "idle": self._idle.qsize(),
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": hit_rate,
+      }
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def GetConnectionPool(host, port, size=DEFAULT_POOL_SIZE):
+  """Returns the connection pool shared by all clients of an endpoint.
+
+  @type host: string
+  @param host: the RAPI host
+  @type port: int
+  @param port: the RAPI port
+  @type size: int
+  @param size: pool size, used only when the pool is first created
+
+  """
+  key = (host, port)
+  with _connection_pools_lock:
+    pool = _connection_pools.get(key)
+    if pool is None:
+      pool = RapiConnectionPool(host, port, size=size)
+      _connection_pools[key] = pool
+  return pool
+
+
+class _LocalBreakerStore(object):
+  """Process-local store for circuit breaker state.
+
+  Implements the subset of the Django cache API used by L{CircuitBreaker}.
+
+  """
+  def __init__(self):
+    self._data = {}
+
+  def get(self, key, default=None):
+    value, expires = self._data.get(key, (default, None))
+    if expires is not None and expires <= time.time():
+      del self._data[key]
+      return default
+    return value
+
+  def set(self, key, value, timeout=None):
+    if timeout:
+      self._data[key] = (value, time.time() + timeout)
+    else:
+      self._data[key] = (value, None)
+
+  def add(self, key, value, timeout=None):
+    if self.get(key) is not None:
+      return False
+    self.set(key, value, timeout)
+    return True
+
+  def delete(self, key):
+    self._data.pop(key, None)
+
+
+class CircuitBreaker(object):
+  """Circuit breaker guarding a single RAPI endpoint.
+
+  After C{threshold} consecutive connection failures or socket timeouts
+  talking to the endpoint the breaker opens and requests fail immediately
+  with L{CircuitOpenError}. Once C{cooldown} seconds have passed, a single
+  request is let through (half-open); its outcome closes or re-opens the
+  breaker.
+
+  State is kept in C{store}, which can be a Django cache so that all
+  processes share it. The open state is additionally remembered in-process,
+  so that an open breaker rejects requests without touching the store.
+
+  """
+  def __init__(self, name, store=None, threshold=DEFAULT_BREAKER_THRESHOLD,
+               cooldown=DEFAULT_BREAKER_COOLDOWN):
+    """Initializes this class.
+
+    @type name: string
+    @param name: name of the guarded endpoint, used in store keys
+    @param store: object implementing get/set/add/delete like a Django cache
+    @type threshold: int
+    @param threshold: consecutive failures before opening
+    @type cooldown: int
+    @param cooldown: seconds to stay open before allowing a probe
+
+    """
+    if store is None:
+      store = _LocalBreakerStore()
+    self.name = name
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self._store = store
+    self._key = "rapi:breaker:%s" % name
+    self._probe_key = "rapi:breaker:%s:probe" % name
+    self._open_until = 0
+
+  def GetState(self):
+    """Returns the current state of the breaker.
+
+    @rtype: dict
+    @return: state, consecutive failures and the time it was opened
+
+    """
+    state = self._store.get(self._key)
+    if state is None:
+      state = {"state": BREAKER_CLOSED, "failures": 0, "opened": None}
+    elif (state["state"] == BREAKER_OPEN and
+          state["opened"] + self.cooldown <= time.time()):
+      state = dict(state, state=BREAKER_HALF_OPEN)
+    return state
+
+  def Enter(self):
+    """Checks whether a request may be sent.
+
+    @rtype: dict
+    @return: the breaker state the request was admitted in
+
+    @raises CircuitOpenError: If the breaker is open
+
+    """
+    if self._open_until > time.time():
+      raise CircuitOpenError("%s is unreachable" % self.name)
+
+    state = self.GetState()
+    if state["state"] == BREAKER_OPEN:
+      self._open_until = state["opened"] + self.cooldown
+      raise CircuitOpenError("%s is unreachable" % self.name)
+    elif state["state"] == BREAKER_HALF_OPEN:
+      # Only one request, across all processes, probes the endpoint
+      if not self._store.add(self._probe_key, True, self.cooldown):
+        raise CircuitOpenError("%s is unreachable" % self.name)
+    return state
+
+  def Success(self, state):
+    """Records a successful request.
+
+    """
+    self._open_until = 0
+    if state["state"] != BREAKER_CLOSED or state["failures"]:
+      self._store.delete(self._key)
+      self._store.delete(self._probe_key)
+
+  def Abandon(self, state):
+    """Records a request given up by its caller before the cluster
+    replied, neither as a success nor as a failure.
+
+    """
+    if state["state"] == BREAKER_HALF_OPEN:
+      # Let another request probe the endpoint
+      self._store.delete(self._probe_key)
+
+  def Failure(self, state):
+    """Records a failed request.
+
+    """
+    failures = state["failures"] + 1
+    if state["state"] == BREAKER_HALF_OPEN or failures >= self.threshold:
+      now = time.time()
+      self._open_until = now + self.cooldown
+      self._store.set(self._key, {"state": BREAKER_OPEN,
+                                  "failures": failures,
+                                  "opened": now}, self.cooldown * 10)
+      self._store.delete(self._probe_key)
+    else:
+      self._store.set(self._key, {"state": BREAKER_CLOSED,
+                                  "failures": failures,
+                                  "opened": None}, self.cooldown * 10)
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def GetCircuitBreaker(host, port, store=None,
+                      threshold=DEFAULT_BREAKER_THRESHOLD,
+                      cooldown=DEFAULT_BREAKER_COOLDOWN):
+  """Returns the circuit breaker shared by all clients of an endpoint.
+
+  @type host: string
+  @param host: the RAPI host
+  @type port: int
+  @param port: the RAPI port
+  @param store: see L{CircuitBreaker}, used only when first created
+
+  """
+  key = (host, port)
+  with _circuit_breakers_lock:
+    breaker = _circuit_breakers.get(key)
+    if breaker is None:
+      breaker = CircuitBreaker("%s:%s" % key, store=store,
+                               threshold=threshold, cooldown=cooldown)
+      _circuit_breakers[key] = breaker
+  return breaker
+
+
+class _Abandoned(Exception):
+  """The caller performing a coalesced call was interrupted.
+
+  """
+
+
+class SingleFlight(object):
+  """Coalesces concurrent identical calls.
+
+  While a call for a key is in progress, further callers for the same key
+  wait for it and get its result (or exception) instead of repeating it.
+  The result object is shared between all of them and must not be
+  modified.
+
+  """
+  def __init__(self):
+    self._inflight = {}
+    self.calls = 0
+    self.coalesced = 0
+
+  def Do(self, key, fn, *args, **kwargs):
+    """Calls fn, unless a call for the same key is already in progress.
+
+    """
+    while key in self._inflight:
+      self.coalesced += 1
+      try:
+        return self._inflight[key].get()
+      except _Abandoned:
+        # The leader timed out or was killed, try on our own
+        pass
+
+    result = self._inflight[key] = AsyncResult()
+    self.calls += 1
+    try:
+      value = fn(*args, **kwargs)
+    except Exception, err:
+      result.set_exception(err)
+      raise
+    except:
+      result.set_exception(_Abandoned())
+      raise
+    else:
+      result.set(value)
+      return value
+    finally:
+      if self._inflight.get(key) is result:
+        del self._inflight[key]
+
+
+_single_flight = SingleFlight()
+
+
+class FanOut(object):
+  """Runs a call per item concurrently, e.g. one per cluster, within limits
+  shared by all callers in the process.
 
-     urllib2.Request.__init__(self, url, data, headers,
-                              origin_req_host, unverifiable)
-     self.method = method
+  At most C{size} calls run at any time, and at most C{per_key} of them for
+  the same key; further calls wait for a slot. Each L{Map} has a deadline.
+  Calls still waiting or running when it passes are abandoned and the
+  results of the others are returned.
 
-  def get_method(self):
-    if self.method:
-      return self.method
-    return urllib2.Request.get_method(self)
+  """
+  def __init__(self, size=DEFAULT_FANOUT_SIZE,
+               per_key=DEFAULT_FANOUT_PER_KEY):
+    """Initializes this class.
+
+    @type size: int
+    @param size: maximum number of concurrent calls
+    @type per_key: int
+    @param per_key: maximum number of concurrent calls for the same key
+
+    """
+    self.size = size
+    self.per_key = per_key
+    self._slots = threading.BoundedSemaphore(size)
+    self._key_slots = {}
+    self._key_active = {}
+    self.calls = 0
+    self.failed = 0
+    self.timeouts = 0
+    self.waited = 0
+    self.wait_time = 0.0
+    self.active = 0
+    self.peak = 0
+
+  def _Call(self, fn, item, key):
+    """Calls fn(item) once a slot, and a slot for its key, are free.
+
+    """
+    slots = [self._slots]
+    if key is not None:
+      if key not in self._key_slots:
+        self._key_slots[key] = threading.BoundedSemaphore(self.per_key)
+      # The key first, so that no slot is held while waiting for it
+      slots.insert(0, self._key_slots[key])
+    start = time.time()
+    waited = False
+    acquired = []
+    try:
+      for slot in slots:
+        if not slot.acquire(False):
+          waited = True
+          slot.acquire()
+        acquired.append(slot)
+      if waited:
+        self.waited += 1
+        self.wait_time += time.time() - start
+      self.calls += 1
+      self.active += 1
+      self.peak = max(self.peak, self.active)
+      self._key_active[key] = self._key_active.get(key, 0) + 1
+      try:
+        return fn(item)
+      finally:
+        self.active -= 1
+        self._key_active[key] -= 1
+        if not self._key_active[key]:
+          del self._key_active[key]
+    finally:
+      for slot in acquired:
+        slot.release()
+
+  def Map(self, fn, items, key=None, timeout=None, errors=(Exception,)):
+    """Calls fn(item) for each item concurrently.
+
+    @param key: function returning the key of an item, calls for the same
+        key are limited to C{per_key} at a time
+    @type timeout: number
+    @param timeout: seconds until the deadline of all calls
+    @param errors: expected exceptions of fn, others are logged as well
+    @rtype: tuple of (list, list)
+    @return: the results of the calls completed in time, in the order of
+        the items, and the items whose call failed or timed out
+
+    """
+    items = list(items)
+    outcomes = [None] * len(items)
+    if timeout is not None:
+      deadline = time.time() + timeout
+
+    def _Run(pos, item):
+      if timeout is None:
+        t = Timeout(None)
+      else:
+        t = Timeout(max(deadline - time.time(), 0))
+      t.start()
+      try:
+        if key is None:
+          outcomes[pos] = (self._Call(fn, item, None),)
+        else:
+          outcomes[pos] = (self._Call(fn, item, key(item)),)
+      except Timeout, err:
+        if err is not t:
+          raise
+        self.timeouts += 1
+      except errors:
+        self.failed += 1
+      except Exception:
+        self.failed += 1
+        logging.exception("Unexpected error in fan-out call for %r", item)
+      finally:
+        t.cancel()
+
+    joinall([spawn(_Run, pos, item) for pos, item in enumerate(items)])
+    results = []
+    failed = []
+    for item, outcome in zip(items, outcomes):
+      if outcome is None:
+        failed.append(item)
+      else:
+        results.append(outcome[0])
+    return (results, failed)
+
+  def GetStats(self):
+    """Returns usage statistics for this executor.
+
+    @rtype: dict
+    @return: limits, calls, failures, timeouts, calls that had to wait for
+        a slot and the time they waited, running calls overall and per key
+        and the peak of running calls
+
+    """
+    return {
+      "size": self.size,
+      "per_key": self.per_key,
+      "calls": self.calls,
+      "failed": self.failed,
+      "timeouts": self.timeouts,
+      "waited": self.waited,
+      "wait_time": self.wait_time,
+      "active": self.active,
+      "active_keys": dict(self._key_active),
+      "peak": self.peak,
+      }
 
 
 class GanetiRapiClient(object): # pylint: disable-msg=R0904
@@ -118,7 +655,10 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
 
   def __init__(self, host, port=GANETI_RAPI_PORT,
                username=None, password=None, logger=logging,
-               curl_config_fn=None, curl_factory=None):
+               curl_config_fn=None, curl_factory=None,
+               pool_size=DEFAULT_POOL_SIZE, breaker_store=None,
+               breaker_threshold=DEFAULT_BREAKER_THRESHOLD,
+               breaker_cooldown=DEFAULT_BREAKER_COOLDOWN):
     """Initializes this class.
 
     @type host: string
@@ -132,6 +672,16 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
     @type curl_config_fn: callable
     @param curl_config_fn: Function to configure C{pycurl.Curl} object
     @param logger: Logging object
+    @type pool_size: int
+    @param pool_size: maximum number of keep-alive connections to the host,
+        shared by every client talking to the same host and port
+    @param breaker_store: where to keep the circuit breaker state, e.g. a
+        Django cache; defaults to process-local memory
+    @type breaker_threshold: int
+    @param breaker_threshold: consecutive failures before the host is
+        considered unreachable
+    @type breaker_cooldown: int
+    @param breaker_cooldown: seconds before an unreachable host is retried
 
     """
     self._username = username
@@ -147,6 +697,10 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
       address = "%s:%s" % (host, port)
 
     self._base_url = "https://%s" % address
+    self._pool = GetConnectionPool(host, port, size=pool_size)
+    self._breaker = GetCircuitBreaker(host, port, store=breaker_store,
+                                      threshold=breaker_threshold,
+                                      cooldown=breaker_cooldown)
 
     if username is not None:
       if password is None:
@@ -154,6 +708,16 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
     elif password:
       raise Error("Specified password without username")
 
+    self._headers = {
+      "Accept": HTTP_APP_JSON,
+      "Content-type": HTTP_APP_JSON,
+      "User-Agent": self.USER_AGENT,
+      }
+    if username is not None:
+      # Send credentials up front instead of waiting for a 401 challenge
+      self._headers["Authorization"] = ("Basic %s" %
+        base64.b64encode("%s:%s" % (username, password)))
+
 
   @staticmethod
   def _EncodeQuery(query):
@@ -210,62 +774,237 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
     if content is not None:
       encoded_content = self._json_encoder.encode(content)
     else:
-      encoded_content = ""
+      encoded_content = None
 
     # Build URL
-    urlparts = [self._base_url, path]
+    urlparts = [path]
     if query:
       urlparts.append("?")
       urlparts.append(urllib.urlencode(self._EncodeQuery(query)))
 
     url = "".join(urlparts)
 
-    self._logger.debug("Sending request %s %s (content=%r)",
-                       method, url, encoded_content)
+    self._logger.debug("Sending request %s %s%s (content=%r)",
+                       method, self._base_url, url, encoded_content)
+
+    if method == HTTP_GET:
+      # Identical reads of the same cluster share one request. Only the raw
+      # response is shared, every caller decodes its own copy of it and may
+      # modify that
+      http_code, response_content = _single_flight.Do(
+        (self._base_url, self._username, url, encoded_content),
+        self._DoRequest, method, url, encoded_content)
+    else:
+      http_code, response_content = self._DoRequest(method, url,
+                                                    encoded_content)
+    return self._DecodeResponse(http_code, response_content)
 
-    req = GanetiRapiRequest(str(url), data=str(encoded_content),
-                            method=method)
+  def _DoRequest(self, method, url, encoded_content):
+    """Performs a request.
 
-    if self._username is not None:
-      # create a password manager
-      password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-      password_mgr.add_password(None, str(url), self._username, self._password)
-      handler = urllib2.HTTPBasicAuthHandler(password_mgr)
-      opener = urllib2.build_opener(handler)
+    @see: L{_SendRequest}
 
-      # Now all calls to urllib2.urlopen use our opener.
-      urllib2.install_opener(opener)
+    @rtype: tuple of (int, str)
+    @return: HTTP status code and raw response body
 
+    """
+    breaker_state = self._breaker.Enter()
     try:
-      resp = urllib2.urlopen(req)
-    except urllib2.HTTPError, err:
-      raise GanetiApiError(str(err), code=err.code)
-    except IOError, err:
+      http_code, response_content = self._pool.Request(method, str(url),
+                                                       encoded_content,
+                                                       self._headers)
+    except (socket.error, httplib.HTTPException), err:
+      self._breaker.Failure(breaker_state)
       raise GanetiApiError(str(err))
+    except Timeout:
+      # The caller's own deadline, possibly while still waiting for a
+      # connection of the pool: says nothing about the cluster
+      self._breaker.Abandon(breaker_state)
+      raise
+    self._breaker.Success(breaker_state)
+    return (http_code, response_content)
+
+  def _DecodeResponse(self, http_code, response_content):
+    """Decodes a response, raising an error for unsuccessful ones.
 
-    # Get HTTP response code
-    http_code = resp.code
+    @see: L{_SendRequest}
 
-    response_content = resp.read()
+    """
     # Was anything written to the response buffer?
     if response_content:
-      response_content = simplejson.loads(response_content)
+      try:
+        response_content = simplejson.loads(response_content)
+      except ValueError:
+        if http_code == HTTP_OK:
+          raise GanetiApiError("Invalid JSON in response", code=http_code)
     else:
       response_content = None
 
     if http_code != HTTP_OK:
-      if isinstance(response_content, dict):
-        msg = ("%s %s: %s" %
-               (response_content["code"],
-                response_content["message"],
-                response_content["explain"]))
-      else:
-        msg = str(response_content)
-
-      raise GanetiApiError(msg, code=http_code)
+      raise self._MakeApiError(http_code, response_content)
 
     return response_content
 
+  @staticmethod
+  def _MakeApiError(http_code, response_content):
+    """Builds the exception for an unsuccessful response.
+
+    @type http_code: int
+    @param http_code: HTTP status code
+    @param response_content: JSON-decoded (if possible) response body
+
+    @rtype: L{GanetiApiError}
+
+    """
+    if isinstance(response_content, dict):
+      msg = ("%s %s: %s" %
+             (response_content["code"],
+              response_content["message"],
+              response_content["explain"]))
+    else:
+      msg = str(response_content)
+
+    return GanetiApiError(msg, code=http_code)
+
+  def _StreamRequest(self, path, query):
+    """Sends a GET request whose response is a JSON array, without
+    reading it all at once.
+
+    The request is sent and its status checked right away. The elements of
+    the array are decoded one at a time as they are iterated over, so the
+    raw body and the fully decoded list are never in memory together.
+
+    @type path: string
+    @param path: HTTP URL path
+    @type query: list of two-tuples
+    @param query: query arguments to pass to urllib.urlencode
+
+    @rtype: generator
+    @return: the JSON-decoded elements of the response array
+
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
+    assert path.startswith("/")
+
+    urlparts = [path]
+    if query:
+      urlparts.append("?")
+      urlparts.append(urllib.urlencode(self._EncodeQuery(query)))
+
+    url = "".join(urlparts)
+
+    self._logger.debug("Sending streaming request %s %s%s",
+                       HTTP_GET, self._base_url, url)
+
+    breaker_state = self._breaker.Enter()
+    try:
+      conn, resp = self._pool.Open(HTTP_GET, str(url), None, self._headers)
+    except (socket.error, httplib.HTTPException), err:
+      self._breaker.Failure(breaker_state)
+      raise GanetiApiError(str(err))
+    except Timeout:
+      # The caller's own deadline, possibly while still waiting for a
+      # connection of the pool: says nothing about the cluster
+      self._breaker.Abandon(breaker_state)
+      raise
+    self._breaker.Success(breaker_state)
+
+    if resp.status != HTTP_OK:
+      try:
+        response_content = resp.read()
+        reusable = not resp.will_close
+      except (socket.error, httplib.HTTPException), err:
+        self._pool.Release(conn, False)
+        raise GanetiApiError(str(err))
+      self._pool.Release(conn, reusable)
+      try:
+        response_content = simplejson.loads(response_content)
+      except ValueError:
+        pass
+      raise self._MakeApiError(resp.status, response_content)
+
+    return self._IterJsonArray(conn, resp)
+
+  def _IterJsonArray(self, conn, resp):
+    """Decodes a JSON array from a response one element at a time.
+
+    The connection is returned to the pool once the whole array has been
+    read, and closed if iteration stops early.
+
+    """
+    decoder = simplejson.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+    complete = False
+    try:
+      while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n":
+          pos += 1
+
+        end = None
+        if pos < len(buf):
+          char = buf[pos]
+          if not started:
+            if char != "[":
+              raise GanetiApiError("Expected a JSON array in response")
+            started = True
+            pos += 1
+            continue
+          elif char == ",":
+            pos += 1
+            continue
+          elif char == "]":
+            # Drain any trailing whitespace so the connection can be reused
+            resp.read()
+            complete = True
+            return
+
+          try:
+            element, end = decoder.raw_decode(buf, pos)
+          except ValueError:
+            end = None
+
+          # A scalar may continue in the next chunk
+          if end is not None and (end < len(buf) or eof):
+            yield element
+            pos = end
+            continue
+
+        if eof:
+          raise GanetiApiError("Invalid JSON in response")
+
+        try:
+          chunk = resp.read(STREAM_CHUNK_SIZE)
+        except (socket.error, httplib.HTTPException), err:
+          raise GanetiApiError(str(err))
+        if not chunk:
+          eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+    finally:
+      self._pool.Release(conn, complete and not resp.will_close)
+
+  def GetCircuitBreakerState(self):
+    """Gets the state of the circuit breaker for this host.
+
+    @rtype: dict
+    @return: see L{CircuitBreaker.GetState}
+
+    """
+    return self._breaker.GetState()
+
+  def GetConnectionPoolStats(self):
+    """Gets usage statistics of the connection pool for this host.
+
+    @rtype: dict
+    @return: see L{RapiConnectionPool.GetStats}
+
+    """
+    return self._pool.GetStats()
+
   def GetVersion(self):
     """Gets the Remote API version running on the cluster.
 
@@ -381,11 +1120,15 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
     return self._SendRequest(HTTP_DELETE, "/%s/tags" % GANETI_RAPI_VERSION,
                              query, None)
 
-  def GetInstances(self, bulk=False):
+  def GetInstances(self, bulk=False, fields=None, stream=False):
     """Gets information about instances on the cluster.
 
     @type bulk: bool
     @param bulk: whether to return all information about all instances
+    @type fields: list of str
+    @param fields: restrict bulk output to these instance fields
+    @type stream: bool
+    @param stream: decode the response incrementally and return a generator
 
     @rtype: list of dict or list of str
     @return: if bulk is True, info about the instances, else a list of instances
@@ -394,10 +1137,18 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
     query = []
     if bulk:
       query.append(("bulk", 1))
+    if fields:
+      query.append(("fields", ",".join(fields)))
+
+    path = "/%s/instances" % GANETI_RAPI_VERSION
+    if stream:
+      instances = self._StreamRequest(path, query)
+      if bulk:
+        return instances
+      else:
+        return (i["id"] for i in instances)
 
-    instances = self._SendRequest(HTTP_GET,
-                                  "/%s/instances" % GANETI_RAPI_VERSION,
-                                  query, None)
+    instances = self._SendRequest(HTTP_GET, path, query, None)
     if bulk:
       return instances
     else:
@@ -1026,11 +1777,13 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
                              "/%s/jobs/%s" % (GANETI_RAPI_VERSION, job_id),
                              query, None)
 
-  def GetNodes(self, bulk=False):
+  def GetNodes(self, bulk=False, stream=False):
     """Gets all nodes in the cluster.
 
     @type bulk: bool
     @param bulk: whether to return all information about all instances
+    @type stream: bool
+    @param stream: decode the response incrementally and return a generator
 
     @rtype: list of dict or str
     @return: if bulk is true, info about nodes in the cluster,
@@ -1041,8 +1794,15 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
     if bulk:
       query.append(("bulk", 1))
 
-    nodes = self._SendRequest(HTTP_GET, "/%s/nodes" % GANETI_RAPI_VERSION,
-                              query, None)
+    path = "/%s/nodes" % GANETI_RAPI_VERSION
+    if stream:
+      nodes = self._StreamRequest(path, query)
+      if bulk:
+        return nodes
+      else:
+        return (n["id"] for n in nodes)
+
+    nodes = self._SendRequest(HTTP_GET, path, query, None)
     if bulk:
       return nodes
     else:
@@ -1442,3 +2202,72 @@ class GanetiRapiClient(object): # pylint: disable-msg=R0904
     return self._SendRequest(HTTP_PUT,
                              ("/%s/groups/%s/assign-nodes" %
                              (GANETI_RAPI_VERSION, group)), query, body)
+
+  def Query(self, what, fields, qfilter=None):
+    """Retrieves information about resources through the query resource.
+
+    @type what: string
+    @param what: Resource name, e.g. "instance"
+    @type fields: list of string
+    @param fields: Requested fields
+    @type qfilter: None or list
+    @param qfilter: Query filter
+
+    @rtype: dict
+    @return: field definitions and result rows, as returned by RAPI
+
+    """
+    body = {
+      "fields": fields,
+      }
+
+    if qfilter is not None:
+      body["qfilter"] = qfilter
+      # Ganeti 2.5 and earlier only know about "filter"
+      body["filter"] = qfilter
+
+    return self._SendRequest(HTTP_PUT,
+                             ("/%s/query/%s" %
+                              (GANETI_RAPI_VERSION, what)), None, body)
+
+  def QueryInstances(self, fields, qfilter=None):
+    """Queries instances, returning one dict per instance.
+
+    Fields whose value could not be retrieved (e.g. the node is offline) are
+    set to None.
+
+    @type fields: list of string
+    @param fields: Requested fields
+    @type qfilter: None or list
+    @param qfilter: Query filter
+
+    @rtype: list of dict
+    @return: info about the matching instances, keyed like L{GetInstances}
+
+    """
+    return self._QueryRows("instance", fields, qfilter)
+
+  def QueryJobs(self, fields, qfilter=None):
+    """Queries jobs, returning one dict per job.
+
+    @see: L{QueryInstances}
+
+    """
+    return self._QueryRows("job", fields, qfilter)
+
+  def _QueryRows(self, what, fields, qfilter):
+    """Queries a resource, returning one dict per result row.
+
+    """
+    result = self.Query(what, fields, qfilter=qfilter)
+    names = [f["name"] for f in result["fields"]]
+    rows = []
+    for row in result["data"]:
+      info = {}
+      for name, (status, value) in zip(names, row):
+        if status == QRS_NORMAL:
+          info[name] = value
+        else:
+          info[name] = None
+      rows.append(info)
+    return rows
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+#
+# Copyright (c) 2014 GRNET SA
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Tracking of in-flight Ganeti jobs, for the watcher.
+
+"""
+
+import time
+import logging
+
+from gevent import sleep, spawn
+from gevent.event import Event
+from gevent.queue import Queue
+
+from util.ganeti_client import GanetiApiError
+
+logger = logging.getLogger("watcher.jobtracker")
+
+POLL_INTERVALS = [0.5, 1, 1, 2, 2, 2, 5]
+JOB_FIELDS = ["id", "status", "end_ts"]
+JOB_WAIT_FIELDS = ["status", "end_ts"]
+
+# Status of jobs the cluster does not know (any more), e.g. archived ones
+JOB_STATUS_GONE = "gone"
+
+
+def next_poll_interval():
+    for t in POLL_INTERVALS:
+        yield t
+
+    while True:
+        yield POLL_INTERVALS[-1]
+
+
+class JobTracker(object):
+    """Track the in-flight jobs of a cluster.
+
+    While a single job is watched on a cluster, it is followed through
+    RAPI's /2/jobs/<id>/wait long-poll, so its status is handed to the
+    greenlets watching it as soon as it changes.
+
+    Several jobs are refreshed together instead, with one query for just
+    these jobs per tick. Jobs the query misses (e.g. already archived) are
+    fetched one by one. Ticks start every POLL_INTERVALS[0] seconds and
+    back off along POLL_INTERVALS while no status changes. Clusters that
+    cannot wait for jobs are always polled this way.
+
+    A job the cluster does not know at all ends with a JOB_STATUS_GONE
+    status, the other jobs are unaffected by it.
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self._watchers = {}
+        self._greenlet = None
+        self._can_wait = True
+        # The job being long-polled, with its last job info and log serial
+        self._waited = (None, None, None)
+        # Set to stop long-polling when another job gets watched
+        self._woken = None
+
+    def watch(self, job_id):
+        """Yield the status of a job whenever it is refreshed, until it
+        ends."""
+        queue = Queue()
+        if job_id not in self._watchers and self._woken is not None:
+            self._woken.set()
+        self._watchers.setdefault(job_id, []).append(queue)
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = spawn(self._run)
+        try:
+            while True:
+                status = queue.get()
+                yield status
+                if status["end_ts"]:
+                    return
+        finally:
+            queues = self._watchers.get(job_id, [])
+            if queue in queues:
+                queues.remove(queue)
+                if not queues:
+                    del self._watchers[job_id]
+
+    def _refresh(self, job_ids):
+        statuses = self.cluster.get_jobs_status(job_ids, JOB_FIELDS)
+        for job_id in job_ids:
+            if job_id in statuses:
+                continue
+            try:
+                statuses[job_id] = self.cluster.get_job_status(job_id)
+            except Exception, err:
+                if not isinstance(err, GanetiApiError) or err.code != 404:
+                    logger.warn("Error polling job %d: %s" %
+                                (job_id, str(err)))
+                    continue
+                logger.warn("Job %d not found on %s, giving up on it" %
+                            (job_id, self.cluster.slug))
+                statuses[job_id] = {"id": job_id, "status": JOB_STATUS_GONE,
+                                    "end_ts": [int(time.time()), 0]}
+        return statuses
+
+    def _wait(self, job_id):
+        """Long-poll the only watched job.
+
+        Returns its status once it changes, or nothing once the server-side
+        wait expires. Gives up as soon as another job gets watched, leaving
+        the request to finish on its own, so that the jobs get polled
+        together.
+        """
+        if self._waited[0] != job_id:
+            self._waited = (job_id, None, None)
+        job_info, log_serial = self._waited[1:]
+        woken = self._woken = Event()
+
+        def wait():
+            try:
+                return (self.cluster.wait_for_job_change(job_id,
+                                                         JOB_WAIT_FIELDS,
+                                                         job_info,
+                                                         log_serial), None)
+            except Exception, err:
+                return (None, err)
+
+        waiter = spawn(wait)
+        waiter.link(lambda g: woken.set())
+        try:
+            woken.wait()
+        finally:
+            self._woken = None
+        if not waiter.ready():
+            return {}
+        result, err = waiter.value
+        if err is not None:
+            if not isinstance(err, GanetiApiError) or \
+                    err.code not in (404, 405, 501):
+                raise err
+            # Either the job is unknown or the cluster cannot wait for jobs
+            statuses = self._refresh(set([job_id]))
+            if (err.code != 404 or job_id in statuses and
+                    statuses[job_id]["status"] != JOB_STATUS_GONE):
+                logger.info("Cluster %s cannot wait for jobs, polling"
+                            " instead" % self.cluster.slug)
+                self._can_wait = False
+            return statuses
+        if not result:
+            return {}
+        job_info = result["job_info"]
+        if result["log_entries"]:
+            log_serial = result["log_entries"][-1][0]
+        self._waited = (job_id, job_info, log_serial)
+        status = dict(zip(JOB_WAIT_FIELDS, job_info))
+        status["id"] = job_id
+        return {job_id: status}
+
+    def _run(self):
+        pi = next_poll_interval()
+        last = None
+        while self._watchers:
+            job_ids = set(self._watchers.keys())
+            waiting = self._can_wait and len(job_ids) == 1
+            logger.debug("Polling %d jobs on %s" % (len(job_ids),
+                                                    self.cluster.slug))
+            try:
+                if waiting:
+                    statuses = self._wait(job_ids.pop())
+                else:
+                    statuses = self._refresh(job_ids)
+            except Exception, err:
+                logger.warn("Error polling jobs: %s" % str(err))
+                sleep(pi.next())
+                continue
+            logger.debug("Done")
+            current = dict((job_id, status["status"])
+                           for job_id, status in statuses.items())
+            if current != last:
+                # Poll again soon after a change, e.g. a new job
+                pi = next_poll_interval()
+                last = current
+            for job_id, status in statuses.items():
+                for queue in self._watchers.get(job_id, []):
+                    queue.put(status)
+                if status["end_ts"]:
+                    # Stop polling it, whether its watchers are done or not
+                    self._watchers.pop(job_id, None)
+            # Long-polls pace themselves
+            if not (waiting and self._can_wait):
+                sleep(pi.next())
+
+
+job_trackers = {}
+
+def watch_job(cluster, job_id):
+    """Yield the status of a Ganeti job whenever it is refreshed, until it
+    ends."""
+    tracker = job_trackers.get(cluster.slug)
+    if tracker is None:
+        tracker = job_trackers[cluster.slug] = JobTracker(cluster)
+    return tracker.watch(job_id)
@@ -40,10 +40,10 @@ from django.core.management import setup_environ
 setup_environ(settings)
 
 from ganeti.models import Cluster
+from util.jobtracker import watch_job, JOB_STATUS_GONE
 from apply.models import InstanceApplication, STATUS_FAILED, STATUS_SUCCESS
 from django.core.cache import cache
 from django.contrib.sites.models import Site
-from django.contrib.auth.models import User
 from django.utils.encoding import smart_str
 from django.core.mail import mail_admins, mail_managers, send_mail
 from django.core import urlresolvers
@@ -52,20 +52,11 @@ from django.core.exceptions import ObjectDoesNotExist
 
 logger = None
 
-POLL_INTERVALS = [0.5, 1, 1, 2, 2, 2, 5]
 DEFAULT_WORKERS = 10
 DEFAULT_PID_FILE = "/var/run/ganetimgr-watcher.pid"
 DEFAULT_LOG_FILE = "/var/log/ganetimgr/watcher.log"
 RESERVE_ERROR_THRESHOLD = 30
 
-def next_poll_interval():
-    for t in POLL_INTERVALS:
-        yield t
-
-    while True:
-        yield POLL_INTERVALS[-1]
-
-
 def monitor_jobs():
     # We have to open one socket per Greenlet, as currently socket sharing is
     # not allowed
@@ -105,74 +96,46 @@ def monitor_jobs():
         if "type" in data and data["type"] in DISPATCH_TABLE:
             DISPATCH_TABLE[data["type"]](job)
 
-def clear_cluster_users_cache(cluster_slug):
-    for user in User.objects.all():
-        cache.delete("user:%s:index:instances" %user.username)
-    cache.delete("cluster:%s:instances" % cluster_slug)
+def clear_cluster_users_cache(cluster):
+    cluster.bump_generation()
+    cluster.clear_instances_cache()
 
 def handle_job_lock(job):
     global logger
     data = json.loads(job.body)
-    lock_key = data["lock_key"]
     instance = data["instance"]
     job_id = int(data["job_id"])
-    logger.info("Handling lock key %s (job %d)" % (lock_key, job_id))
+    logger.info("Handling lock of instance %s (job %d)" % (instance, job_id))
 
     try:
         cluster = Cluster.objects.get(slug=data["cluster"])
     except ObjectDoesNotExist:
-        logger.warn("Got lock key %s for unknown cluster %s, burying" %
-                     (data["lock_key"], data["cluster"]))
+        logger.warn("Got lock of instance %s for unknown cluster %s, burying" %
+                     (instance, data["cluster"]))
         job.bury()
         return
 
-    pi = next_poll_interval()
-    while True:
-        logger.debug("Checking lock key %s (job: %d)" % (lock_key, job_id))
-        reason = cache.get(lock_key)
+    for status in watch_job(cluster, job_id):
+        logger.debug("Checking lock of instance %s (job: %d)" %
+                     (instance, job_id))
+        reason = cluster.is_instance_locked(instance)
         if reason is None:
-            logger.info("Lock key %s vanished, forgetting it" % lock_key)
+            logger.info("Lock of instance %s vanished, forgetting it" %
+                        instance)
             job.delete()
             return
 
-        logger.debug("Polling job %d" % job_id)
-        try:
-            status = cluster.get_job_status(job_id)
-        except Exception, err:
-            logger.warn("Error polling job: %s" % str(err))
-            sleep(pi.next())
-            continue
-        logger.debug("Done")
-
         if status["end_ts"]:
-            logger.info("Job %d finished, removing lock %s" %
-                         (job_id, lock_key))
-            if "flush_keys" in data:
-                for key in data["flush_keys"]:
-                    cache.delete(key)
-
-            cache.delete(lock_key)
-            locked_instances = cache.get('locked_instances')
-            # This should contain at least 1 instance
-            if locked_instances is not None:
-                try:
-                    locked_instances.pop("%s"%instance)
-                except KeyError:
-                    pass
-                if len(locked_instances.items()) == 0:
-                    cache.delete('locked_instances')
-                else:
-                    cache.set('locked_instances', locked_instances, 90)
-            else:
-                # This could be due to a cache fail or restart. For the time log it
-                logger.warn("Unable to find instance %s in locked instances cache key" %instance)
-            clear_cluster_users_cache(cluster.slug)
+            logger.info("Job %d finished, unlocking instance %s" %
+                         (job_id, instance))
+            cluster.unlock_instance(instance)
+            cache.delete_many(data.get("flush_keys", []))
+            clear_cluster_users_cache(cluster)
             job.delete()
             return
-        # Touch the key
-        cache.set(lock_key, reason, 30)
+        # Touch the lock
+        cluster._lock_instance(instance, reason, 30)
         job.touch()
-        sleep(pi.next())
 
 
 def handle_creation(job):
@@ -192,12 +155,19 @@ def handle_creation(job):
 
     logger.info("Handling %s (job: %d)",
                  application.hostname, application.job_id)
-    while True:
-        sleep(15)
+    for status in watch_job(application.cluster, application.job_id):
         logger.info("Checking %s (job: %d)",
                      application.hostname, application.job_id)
-        status = application.cluster.get_job_status(application.job_id)
+        if status["status"] == JOB_STATUS_GONE:
+            logger.warn("%s (job: %d) not found on the cluster, burying",
+                         application.hostname, application.job_id)
+            mail_admins("Burying job #%d" % job.jid,
+                        "Please inspect job #%d (application %d) manually" %
+                        (job.jid, application.id))
+            job.bury()
+            return
         if status["end_ts"]:
+            status = application.cluster.get_job_status(application.job_id)
             logger.info("%s (job: %d) done. Status: %s", application.hostname,
                          application.job_id, status["status"])
             if status["status"] == "error":